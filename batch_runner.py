@@ -1,101 +1,514 @@
-import json
 import os
+import statistics
 import torch
 from tqdm import tqdm
 from src.generator import CausalGenerator
 from src.data_loader import DataLoader
 from src.perturb import Perturber
-from src.metrics import compute_hsb
+from src.metrics import compute_hsb_batch, pad_answer_logits
 from src.entailment import EntailmentGrader
+from src.batching import token_budget_batches, bucket_batches, with_lengths, ThroughputTracker
+from src.pipeline import Pipeline, Stage
+from src.generation_cache import GenerationCache
+from src.token_cache import TokenCache
+from src.sinks import open_sink
+from src.instrumentation import Instrumentation, NOOP
+from src.service import ScoringClient
 
-def run_experiment(target_count=15000, output_file="final_thesis_results.jsonl"):
-    print(f"=== 🚀 Launching Production Run: Target {target_count} Items ===")
-    
-    # 1. Check for existing progress (Resume Capability)
-    processed_ids = set()
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            for line in f:
+# Short answers: stop at the first newline, never spend more than 64 decode steps
+GENERATION_KWARGS = {"max_new_tokens": 64, "stop_at_newline": True}
+
+def build_evidence(item):
+    # Simulated Perfect Retrieval
+    return f"The answer to the question '{item['question']}' is {item['gold_answer']}."
+
+def perturb_stage(items, attacker, instr=NOOP):
+    """A. Perturb (one nlp.pipe pass for the whole batch). Failed attacks are dropped."""
+    with instr.timer("perturb", items=len(items)):
+        evidences = [build_evidence(item) for item in items]
+        swaps = attacker.perturb_many(evidences, strategy="adversarial")
+
+    prepared = []
+    for item, evidence_E, swap in zip(items, evidences, swaps):
+        if swap["label"] is None:
+            instr.count("perturb_failed")
+            continue # Skip failed attacks
+        prepared.append({"item": item, "evidence_E": evidence_E, "evidence_E_prime": swap["text"]})
+    return prepared
+
+def generate_stage(prepared, gen, instr=NOOP):
+    """B + C. Generate under E, score the same answer under E', compute HSB."""
+    if not prepared:
+        return []
+    # gen records its own "generate" / "get_logits" model time and tokens inside this
+    with instr.timer("generate_stage", items=len(prepared)):
+        return _generate_stage(prepared, gen, instr)
+
+def _generate_stage(prepared, gen, instr):
+    questions = [work["item"]['question'] for work in prepared]
+
+    # B. Generate (keeping the answer logits conditioned on E)
+    generations = gen.generate_and_score_batch(
+        [work["evidence_E"] for work in prepared], questions, **GENERATION_KWARGS
+    )
+
+    # C. Metrics: logits_E come for free, only E' needs a forward pass
+    logits_E_prime_all = gen.get_answer_logits_batch(
+        [work["evidence_E_prime"] for work in prepared],
+        questions,
+        [generation["answer_ids"] for generation in generations]
+    )
+
+    # One vectorized HSB call for the whole batch (per_item == compute_hsb per item)
+    with instr.timer("hsb", items=len(prepared)):
+        logits_E, answer_mask = pad_answer_logits([generation["logits"] for generation in generations])
+        logits_E_prime, _ = pad_answer_logits(logits_E_prime_all)
+        hsb_scores = compute_hsb_batch(logits_E, logits_E_prime, answer_mask)["per_item"].tolist()
+
+    # Only the text survives this stage, the logits are released here
+    return [
+        dict(work, answer=generation["answer"], hsb_score=hsb_score)
+        for work, generation, hsb_score in zip(prepared, generations, hsb_scores)
+    ]
+
+def grade_stage(scored, grader, instr=NOOP):
+    """All NLI pairs of the batch in one padded, cached grading call -> result records."""
+    if not scored:
+        return []
+    with instr.timer("grade_stage", items=len(scored)):
+        delta_ents = grader.compute_delta_entailment_batch([
+            (work["evidence_E"], work["evidence_E_prime"], work["answer"]) for work in scored
+        ])
+
+    return [make_record(work, delta_ent) for work, delta_ent in zip(scored, delta_ents)]
+
+def make_record(work, delta_ent):
+    return {
+        "id": work["item"]['id'],
+        "question": work["item"]['question'],
+        "evidence_original": work["evidence_E"],
+        "evidence_attacked": work["evidence_E_prime"],
+        "model_answer": work["answer"],
+        "hsb_score": work["hsb_score"],
+        "delta_entailment": delta_ent
+    }
+
+def sweep_perturb_stage(items, attacker, k, instr=NOOP):
+    """A (sweep). Up to k distinct counterfactuals per evidence; items with none are dropped."""
+    with instr.timer("perturb", items=len(items)):
+        evidences = [build_evidence(item) for item in items]
+        swap_lists = attacker.counterfactuals_many(evidences, k=k)
+
+    prepared = []
+    for item, evidence_E, swaps in zip(items, evidences, swap_lists):
+        if not swaps:
+            instr.count("perturb_failed")
+            continue
+        instr.count("counterfactuals", len(swaps))
+        prepared.append({"item": item, "evidence_E": evidence_E, "counterfactuals": swaps})
+    return prepared
+
+def sweep_generate_stage(prepared, gen, instr=NOOP):
+    """
+    B + C (sweep). One generation under E per item; all of its counterfactuals are then
+    scored against that same answer in ONE batched teacher-forced pass.
+    """
+    if not prepared:
+        return []
+    with instr.timer("generate_stage", items=len(prepared)):
+        questions = [work["item"]['question'] for work in prepared]
+        generations = gen.generate_and_score_batch(
+            [work["evidence_E"] for work in prepared], questions, **GENERATION_KWARGS
+        )
+
+        scored = []
+        for work, question, generation in zip(prepared, questions, generations):
+            swaps = work["counterfactuals"]
+            logits_E_prime_all = gen.get_answer_logits_batch(
+                [swap["text"] for swap in swaps], [question] * len(swaps), [generation["answer_ids"]] * len(swaps)
+            )
+            with instr.timer("hsb", items=len(swaps)):
+                logits_E, answer_mask = pad_answer_logits([generation["logits"]] * len(swaps))
+                logits_E_prime, _ = pad_answer_logits(logits_E_prime_all)
+                hsb_scores = compute_hsb_batch(logits_E, logits_E_prime, answer_mask)["per_item"].tolist()
+            scored.append(dict(work, answer=generation["answer"], hsb_scores=hsb_scores))
+        return scored
+
+def summarize_sweep(swaps, hsb_scores, delta_ents):
+    """Per-item distribution of a sweep: overall stats, per entity label, and every counterfactual."""
+    by_label = {}
+    for swap, hsb in zip(swaps, hsb_scores):
+        by_label.setdefault(swap["label"], []).append(hsb)
+    graded = all(delta is not None for delta in delta_ents)
+
+    return {
+        # hsb_score / delta_entailment are the means, so analysis.py works on sweep outputs too
+        "hsb_score": statistics.fmean(hsb_scores),
+        "hsb_max": max(hsb_scores),
+        "hsb_min": min(hsb_scores),
+        "hsb_std": statistics.pstdev(hsb_scores),
+        # No NLI judge (e.g. a service run with --nli-model none): no deltas, like make_record
+        "delta_entailment": statistics.fmean(delta_ents) if graded else None,
+        "delta_entailment_max": max(delta_ents) if graded else None,
+        "num_counterfactuals": len(swaps),
+        # A list rather than a dict keyed by label, so the Parquet schema stays fixed
+        "hsb_by_label": [
+            {"label": label, "count": len(scores), "hsb_mean": statistics.fmean(scores), "hsb_max": max(scores)}
+            for label, scores in sorted(by_label.items())
+        ],
+        "counterfactuals": [
+            {
+                "text": swap["text"], "label": swap["label"], "original": swap["original"],
+                "replacement": swap["replacement"], "hsb_score": hsb, "delta_entailment": delta
+            }
+            for swap, hsb, delta in zip(swaps, hsb_scores, delta_ents)
+        ],
+    }
+
+def sweep_grade_stage(scored, grader, instr=NOOP):
+    """D (sweep). Every (E, E'_k, answer) triple of the batch in one NLI call -> one record per item."""
+    if not scored:
+        return []
+    with instr.timer("grade_stage", items=len(scored)):
+        # The (E, answer) pair repeats K times per item; the grader scores it only once
+        delta_ents = grader.compute_delta_entailment_batch([
+            (work["evidence_E"], swap["text"], work["answer"])
+            for work in scored for swap in work["counterfactuals"]
+        ])
+
+    results, offset = [], 0
+    for work in scored:
+        k = len(work["counterfactuals"])
+        results.append(make_sweep_record(work, delta_ents[offset:offset + k]))
+        offset += k
+    return results
+
+def make_sweep_record(work, delta_ents):
+    record = {
+        "id": work["item"]['id'],
+        "question": work["item"]['question'],
+        "evidence_original": work["evidence_E"],
+        "model_answer": work["answer"],
+    }
+    record.update(summarize_sweep(work["counterfactuals"], work["hsb_scores"], delta_ents))
+    return record
+
+def service_stage(prepared, client, instr=NOOP):
+    """
+    B + C + D through the scoring service (src/service.py): one request generates under E
+    and returns HSB and delta entailment, batched there with other workers' requests.
+    """
+    if not prepared:
+        return []
+    with instr.timer("service", items=len(prepared)):
+        responses = client.generate_many([
+            dict(GENERATION_KWARGS, context=work["evidence_E"], question=work["item"]['question'],
+                 counterfactual=work["evidence_E_prime"], entailment=True)
+            for work in prepared
+        ])
+    return [
+        make_record(dict(work, answer=response["answer"], hsb_score=response["hsb"]), response["delta_entailment"])
+        for work, response in zip(prepared, responses)
+    ]
+
+def service_sweep_stage(prepared, client, instr=NOOP):
+    """
+    Sweep through the scoring service: generate under E, then one /score request per item
+    with all its counterfactuals, so the service scores E once rather than once per E'.
+    """
+    if not prepared:
+        return []
+    with instr.timer("service", items=len(prepared)):
+        generations = client.generate_many([
+            dict(GENERATION_KWARGS, context=work["evidence_E"], question=work["item"]['question'])
+            for work in prepared
+        ])
+        responses = client.score_many([
+            {"context": work["evidence_E"], "counterfactuals": [swap["text"] for swap in work["counterfactuals"]],
+             "question": work["item"]['question'], "answer": generation["answer"],
+             "answer_ids": generation["answer_ids"], "entailment": True}
+            for work, generation in zip(prepared, generations)
+        ])
+
+    results = []
+    for work, generation, response in zip(prepared, generations, responses):
+        scores = response["scores"]
+        work = dict(work, answer=generation["answer"], hsb_scores=[score["hsb"] for score in scores])
+        results.append(make_sweep_record(work, [score["delta_entailment"] for score in scores]))
+    return results
+
+def process_items(items, gen, attacker, grader, instr=NOOP, sweep_k=None):
+    """
+    Runs perturb -> generate -> score -> grade for a list of items as ONE batch.
+    Items whose attack fails are dropped. Returns one result dict per kept item.
+    With sweep_k, every item is measured against up to sweep_k counterfactuals.
+    `gen` may be a ScoringClient, in which case the service does the model work.
+    """
+    if isinstance(gen, ScoringClient):
+        if sweep_k:
+            return service_sweep_stage(sweep_perturb_stage(items, attacker, sweep_k, instr), gen, instr)
+        return service_stage(perturb_stage(items, attacker, instr), gen, instr)
+    if sweep_k:
+        prepared = sweep_perturb_stage(items, attacker, sweep_k, instr)
+        return sweep_grade_stage(sweep_generate_stage(prepared, gen, instr), grader, instr)
+    return grade_stage(generate_stage(perturb_stage(items, attacker, instr), gen, instr), grader, instr)
+
+def with_item_fallback(fn, label, instr=NOOP):
+    """
+    Wraps a batch function: if the batch fails, retry its entries one by one and skip the bad ones.
+    Every failure is counted in instr by stage label and exception type.
+    """
+    def run(batch):
+        try:
+            return fn(batch)
+        except Exception as e:
+            instr.error(label, e)
+            if len(batch) > 1:
+                print(f"Batch of {len(batch)} failed in {label} ({e}), retrying items individually...")
+            results = []
+            for entry in batch:
                 try:
-                    data = json.loads(line)
-                    processed_ids.add(data['id'])
-                except:
-                    continue
+                    results.extend(fn([entry]))
+                except Exception as e:
+                    instr.error(label, e)
+                    instr.count("items_skipped")
+                    item = entry.get("item", entry)
+                    print(f"Skipping Item {item['id']} due to error: {e}")
+            return results
+    return run
+
+def run_experiment(target_count=15000, output_file="final_thesis_results.jsonl",
+                   max_batch_size=1, token_budget=None, num_shards=1, shard_index=0,
+                   pipelined=False, precision=None, metrics_file=None, metrics_interval=60,
+                   profile_items=0, profiler="cprofile",
+                   model_name="microsoft/Phi-3-mini-4k-instruct", nli_model_name="facebook/bart-large-mnli",
+                   spacy_model="en_core_web_sm", dataset_name="nq_open", data_dir="data",
+                   nli_cache_path="nli_cache.sqlite", sweep_k=None, service_url=None,
+                   token_cache_dir=None, bucket_width=None, generation_cache_dir=None):
+    """
+    Args:
+        max_batch_size: rows per generation batch (1 = the classic item-by-item loop)
+        token_budget: if set, items are bucketed by prompt length and each batch is
+                      sized so rows * (prompt + max_new_tokens) stays under this budget
+        num_shards, shard_index: only process ids with id % num_shards == shard_index
+                      (used by launch_workers.py; resume works per shard output file)
+        pipelined: run perturb / generate+score / grade / write as concurrent stages
+                      connected by bounded queues (see src/pipeline.py); its stages
+                      micro-batch in arrival order, so token_budget / bucket_width
+                      can't be combined with it
+        precision: inference precision for both models ("fp32", "bf16", "int8", ...;
+                      None keeps the defaults). Check precision_check.py drift first.
+        metrics_file: per-stage metrics written every metrics_interval seconds
+                      (default: <output>.metrics.jsonl; a *.prom path writes Prometheus text)
+        profile_items, profiler: profile the first N items' batches with "cprofile"
+                      or "torch" (written to profiles/)
+        model_name, nli_model_name, spacy_model, dataset_name: components (hub names or
+                      local paths; benchmark.py points them at tiny offline fixtures)
+        data_dir: holds the dataset Parquet cache (cache/)
+        nli_cache_path: sqlite file for NLI scores
+        sweep_k: if set, score up to sweep_k counterfactuals per item (every entity x
+                      replacement) against one generated answer and record the HSB
+                      distribution instead of a single swap
+        service_url: score through a running scoring service (python -m src.service)
+                      instead of loading the models in this process
+        token_cache_dir: prompt token ids are read from (and added to) this TokenCache;
+                      fill it ahead of the run with pretokenize.py
+        bucket_width: if set, batch items by prompt-length buckets of this many tokens
+                      (see bucket_batches) instead of sorting windows
+        generation_cache_dir: if set, answers and answer log-probs are cached there
+                      (content-addressed), so reruns that only change the metric or
+                      analysis never run the model again. Shards may share it.
+    """
+    if pipelined and (token_budget or bucket_width):
+        raise ValueError("token_budget / bucket_width only apply to the batched loop, not pipelined=True")
+
+    shard_note = f" (shard {shard_index + 1}/{num_shards})" if num_shards > 1 else ""
+    print(f"=== 🚀 Launching Production Run: Target {target_count} Items{shard_note} ===")
+
+    # 1. Check for existing progress (Resume Capability)
+    # The sink keeps a sidecar id index, so this is one small file read, not a full parse.
+    # `*.parquet` outputs get the columnar sink, anything else the buffered JSONL sink.
+    sink = open_sink(output_file)
+    processed_ids = set(sink.processed_ids)
     print(f"Found {len(processed_ids)} items already completed. Resuming...")
 
     # 2. Initialize Components
+    # Stage timers, token rates, peak RSS and error counters, flushed on an interval
+    instr = Instrumentation(
+        metrics_file or os.path.splitext(output_file.rstrip("/"))[0] + ".metrics.jsonl",
+        interval=metrics_interval,
+        labels={"shard": str(shard_index)},
+        profile_items=profile_items,
+        profiler=profiler
+    ).start()
+
     # Note: We switch to 'train' split because 'validation' only has ~3,600 items.
     # We need the massive 87k training set to reach our 15k goal.
-    loader = DataLoader(split="train") 
-    gen = CausalGenerator(model_name="microsoft/Phi-3-mini-4k-instruct")
-    attacker = Perturber()
-    grader = EntailmentGrader()
+    # The split is cached as Parquet under data/cache, so reruns work offline
+    loader = DataLoader(dataset_name=dataset_name, split="train", cache_dir=os.path.join(data_dir, "cache"))
+    if num_shards > 1:
+        loader = loader.shard(num_shards, shard_index)
+    attacker = Perturber(seed=0, spacy_model=spacy_model) # seeded per text: reruns produce the same attacks
+    if service_url:
+        # The service holds the models (and its own caches); many workers share its batches
+        gen, grader = ScoringClient(service_url), None
+        print(f"Scoring through service at {service_url}: {gen.health()}")
+        if token_budget or bucket_width:
+            print("token_budget / bucket_width need the local tokenizer, using plain batches of max_batch_size.")
+            token_budget = bucket_width = None
+    else:
+        gen = CausalGenerator(
+            model_name=model_name,
+            cache=GenerationCache(generation_cache_dir) if generation_cache_dir else None,
+            precision=precision,
+            instrumentation=instr,
+            # Pre-tokenized prompts: the hot loop starts from token ids. Shards share the
+            # directory, so they only read it (pretokenize.py is the writer)
+            token_cache=TokenCache(token_cache_dir, model_name, read_only=num_shards > 1) if token_cache_dir else None
+        )
+        # Evidence strings recur across reruns and ablations, so keep NLI scores on disk
+        grader = EntailmentGrader(
+            model_name=nli_model_name, cache_path=nli_cache_path,
+            precision=precision or "fp32", instrumentation=instr
+        )
 
     # 3. Get Data (Fetch more than needed to account for skipped items)
-    # Fetching 25,000 to ensure we get 15,000 valid attacks
-    dataset = loader.get_batch(start_index=0, limit=25000)
-    
+    # Streaming the first 25,000 to ensure we get 15,000 valid attacks; done ids are skipped by set lookup
+    pending = loader.iter_items(start_index=0, limit=25000, skip_ids=processed_ids)
+
+    def prompt_lengths(items):
+        # One bulk TokenCache read (and one tokenizer call for the misses) per window
+        return gen.prompt_lengths([gen.build_prompt(build_evidence(item), item['question']) for item in items])
+
+    if pipelined:
+        with sink:
+            success_count = run_pipelined(
+                pending, gen, attacker, grader, sink, target_count,
+                success_count=len(processed_ids), max_batch_size=max_batch_size, shard_index=shard_index,
+                instr=instr, sweep_k=sweep_k
+            )
+        instr.close()
+        instr.report()
+        print(f"\n✅ DONE! Collected {success_count} samples in {output_file}")
+        return
+
+    if bucket_width or token_budget:
+        # Batch (length, item) pairs, then drop the lengths again
+        sized = with_lengths(pending, prompt_lengths)
+        length_of = lambda pair: pair[0]
+        if bucket_width:
+            sized_batches = bucket_batches(
+                sized, length_of,
+                bucket_width=bucket_width,
+                max_batch_size=max_batch_size,
+                token_budget=token_budget,
+                reserve_tokens=GENERATION_KWARGS["max_new_tokens"]
+            )
+        else:
+            sized_batches = token_budget_batches(
+                sized, length_of,
+                token_budget=token_budget,
+                max_batch_size=max_batch_size,
+                reserve_tokens=GENERATION_KWARGS["max_new_tokens"]
+            )
+        batches = ([item for _, item in batch] for batch in sized_batches)
+    else:
+        batches = token_budget_batches(pending, None, max_batch_size=max_batch_size)
+
     # 4. The Loop
+    run_batch = with_item_fallback(
+        lambda batch: process_items(batch, gen, attacker, grader, instr, sweep_k), "process_items", instr
+    )
     success_count = len(processed_ids)
-    pbar = tqdm(total=target_count, initial=success_count)
-    
-    # Open in APPEND mode ('a') to save progress incrementally
-    with open(output_file, "a") as f:
-        
-        for item in dataset:
+    pbar = tqdm(total=target_count, initial=success_count, position=shard_index, desc=f"shard {shard_index}")
+    throughput = ThroughputTracker()
+
+    # The sink appends with group commits (every 100 items or 5s, fsynced) to save progress incrementally
+    with sink:
+
+        for batch in batches:
             # Stop if we hit the goal
             if success_count >= target_count:
                 break
-            
-            # Skip if already done
-            if item['id'] in processed_ids:
-                continue
-
-            try:
-                q = item['question']
-                # Simulated Perfect Retrieval
-                evidence_E = f"The answer to the question '{q}' is {item['gold_answer']}."
-                
-                # A. Perturb
-                evidence_E_prime = attacker.perturb(evidence_E, strategy="adversarial")
-                if evidence_E == evidence_E_prime:
-                    continue # Skip failed attacks
-
-                # B. Generate
-                prompt = f"Context: {evidence_E}\nQuestion: {q}"
-                answer_y = gen.generate(prompt)
-
-                # C. Metrics
-                logits_E = gen.get_logits(evidence_E, answer_y)
-                logits_E_prime = gen.get_logits(evidence_E_prime, answer_y)
-                hsb_score = compute_hsb(logits_E, logits_E_prime)
-
-                delta_ent = grader.compute_delta_entailment(evidence_E, evidence_E_prime, answer_y)
-
-                # D. Save
-                result = {
-                    "id": item['id'],
-                    "question": q,
-                    "evidence_original": evidence_E,
-                    "evidence_attacked": evidence_E_prime,
-                    "model_answer": answer_y,
-                    "hsb_score": hsb_score,
-                    "delta_entailment": delta_ent
-                }
-                
-                f.write(json.dumps(result) + "\n")
-                f.flush() # Force write to disk immediately
-                
-                success_count += 1
-                pbar.update(1)
-                
-            except Exception as e:
-                print(f"Skipping Item {item['id']} due to error: {e}")
-                continue
+
+            with throughput.timed(len(batch)) as timer, instr.profile("batch", len(batch)):
+                # Don't lose the whole batch to one bad item: retry item by item
+                results = run_batch(batch)
+                timer.items = len(results)
+
+            # D. Save (one record per item, exactly as before)
+            results = results[:target_count - success_count]
+            with instr.timer("write", items=len(results)):
+                sink.write_many(results)
+            success_count += len(results)
+            pbar.update(len(results))
 
     pbar.close()
+    throughput.report()
+    instr.close()
+    instr.report()
     print(f"\n✅ DONE! Collected {success_count} samples in {output_file}")
 
+def run_pipelined(pending, gen, attacker, grader, sink, target_count,
+                  success_count=0, max_batch_size=8, shard_index=0, report_interval=60, instr=NOOP,
+                  sweep_k=None):
+    """
+    Staged version of the loop. spaCy perturbation and JSON writing run in their
+    own threads, so the two model stages (LM and NLI judge) only wait on each
+    other, never on CPU-light work. Returns the final success count.
+    """
+    pbar = tqdm(total=target_count, initial=success_count, position=shard_index, desc=f"shard {shard_index}")
+    state = {"written": success_count}
+
+    def write_stage(results):
+        # D. Save (one record per item), never past the target
+        results = results[:max(0, target_count - state["written"])]
+        with instr.timer("write", items=len(results)):
+            sink.write_many(results)
+        state["written"] += len(results)
+        return results
+
+    if sweep_k:
+        perturb_fn = lambda batch: sweep_perturb_stage(batch, attacker, sweep_k, instr)
+        generate_fn, grade_fn = sweep_generate_stage, sweep_grade_stage
+    else:
+        perturb_fn = lambda batch: perturb_stage(batch, attacker, instr)
+        generate_fn, grade_fn = generate_stage, grade_stage
+    remote = isinstance(gen, ScoringClient)
+    if remote:
+        # The service returns finished records, so there is no local grade stage
+        generate_fn = service_sweep_stage if sweep_k else service_stage
+
+    def profiled_generate(batch):
+        # The LM stage dominates, so that's where sampled items get profiled
+        with instr.profile("generate", len(batch)):
+            return generate_fn(batch, gen, instr)
+
+    # Generate+score share one model, so they form one stage (and one tokenizer user)
+    stages = [
+        Stage("perturb", with_item_fallback(perturb_fn, "perturb", instr),
+              batch_size=64),
+        Stage("generate", with_item_fallback(profiled_generate, "generate", instr),
+              batch_size=max(1, max_batch_size), max_wait=0.2),
+        Stage("grade", with_item_fallback(lambda batch: grade_fn(batch, grader, instr), "grade", instr),
+              batch_size=max(1, 2 * max_batch_size), max_wait=0.2),
+        Stage("write", write_stage, batch_size=32, max_wait=0.5),
+    ]
+    if remote:
+        del stages[2]
+    pipeline = Pipeline(stages)
+
+    if state["written"] < target_count:
+        for _ in pipeline.run(pending, report_interval=report_interval):
+            pbar.update(1)
+            # Stop if we hit the goal
+            if state["written"] >= target_count:
+                pipeline.stop()
+
+    pbar.close()
+    pipeline.report()
+    return state["written"]
+
 if __name__ == "__main__":
     # We DO NOT delete the file here, so we can resume if needed.
-    run_experiment(target_count=15000)
\ No newline at end of file
+    run_experiment(target_count=15000)
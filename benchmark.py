@@ -0,0 +1,393 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import torch
+from src.instrumentation import current_rss_bytes
+
+# Synthetic world for the NQ-like dataset and the spaCy entity ruler
+ENTITIES = {
+    "PERSON": ["Marie Curie", "Isaac Newton", "Grace Hopper", "Nikola Tesla", "Jane Austen", "Leo Tolstoy"],
+    "GPE": ["Paris", "Berlin", "Madrid", "Rome", "Vienna", "Lisbon", "Oslo", "Cairo"],
+    "ORG": ["Acme Corp", "Globex", "Initech", "Stark Industries", "Wayne Enterprises"],
+    "DATE": ["1867", "1643", "1906", "1856", "1775", "1828", "1954", "1989"],
+}
+QUESTION_TEMPLATES = [
+    ("who founded {ORG}", "PERSON"),
+    ("what is the capital of the country next to {GPE}", "GPE"),
+    ("when was {PERSON} born", "DATE"),
+    ("where is the headquarters of {ORG}", "GPE"),
+    ("who wrote the book set in {GPE}", "PERSON"),
+]
+
+# ---------------------------------------------------------------------------
+# Fixtures: tiny random-weight models + data, built from configs (no downloads)
+# ---------------------------------------------------------------------------
+
+def synthetic_items(n_items, seed=0):
+    rng = random.Random(seed)
+    items = []
+    for _ in range(n_items):
+        template, answer_label = rng.choice(QUESTION_TEMPLATES)
+        slots = {label: rng.choice(values) for label, values in ENTITIES.items()}
+        items.append({"question": template.format(**slots), "answer": [rng.choice(ENTITIES[answer_label])]})
+    return items
+
+def build_dataset(cache_dir, n_items, seed=0, dataset_name="synthetic_nq"):
+    """Writes the synthetic split where DataLoader looks for its Parquet cache."""
+    from datasets import Dataset
+
+    items = synthetic_items(n_items, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    for split in ("train", "validation"):
+        Dataset.from_dict({
+            "question": [item["question"] for item in items],
+            "answer": [item["answer"] for item in items],
+        }).to_parquet(os.path.join(cache_dir, f"{dataset_name}_{split}.parquet"))
+    return dataset_name
+
+def corpus_texts(n_items=2000, seed=0):
+    texts = []
+    for item in synthetic_items(n_items, seed):
+        texts.append(f"Context: The answer to the question '{item['question']}' is {item['answer'][0]}.\n"
+                     f"Question: {item['question']}\nAnswer: {item['answer'][0]}\n")
+    return texts
+
+def build_tokenizer(vocab_size=512, seed=0):
+    """Byte-level BPE trained on the synthetic corpus with the `tokenizers` library."""
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<pad>", "<s>", "</s>", "<unk>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(corpus_texts(seed=seed), trainer)
+    return tokenizer
+
+def _save_tokenizer(tokenizer, path, pair_template=False):
+    """Wraps a raw tokenizer for transformers; pair_template adds BART-style <s> A </s></s> B </s>."""
+    from tokenizers import Tokenizer, processors
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer.from_str(tokenizer.to_str()) # copy: post-processors differ per model
+    if pair_template:
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single="<s> $A </s>",
+            pair="<s> $A </s> </s> $B </s>",
+            special_tokens=[("<s>", tokenizer.token_to_id("<s>")), ("</s>", tokenizer.token_to_id("</s>"))]
+        )
+    wrapped = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>", eos_token="</s>", unk_token="<unk>", pad_token="<pad>",
+        model_max_length=512,
+        model_input_names=["input_ids", "attention_mask"]
+    )
+    wrapped.save_pretrained(path)
+    return wrapped
+
+def build_causal_lm(path, tokenizer):
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    hf_tokenizer = _save_tokenizer(tokenizer, path)
+    config = GPT2Config(
+        vocab_size=len(hf_tokenizer), n_positions=512, n_embd=64, n_layer=2, n_head=2,
+        bos_token_id=hf_tokenizer.bos_token_id, eos_token_id=hf_tokenizer.eos_token_id,
+        pad_token_id=hf_tokenizer.pad_token_id
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+def build_nli_model(path, tokenizer):
+    from transformers import BartConfig, BartForSequenceClassification
+
+    hf_tokenizer = _save_tokenizer(tokenizer, path, pair_template=True)
+    config = BartConfig(
+        vocab_size=len(hf_tokenizer), d_model=64, max_position_embeddings=512,
+        encoder_layers=2, decoder_layers=2, encoder_attention_heads=2, decoder_attention_heads=2,
+        encoder_ffn_dim=128, decoder_ffn_dim=128,
+        pad_token_id=hf_tokenizer.pad_token_id, bos_token_id=hf_tokenizer.bos_token_id,
+        eos_token_id=hf_tokenizer.eos_token_id, decoder_start_token_id=hf_tokenizer.eos_token_id,
+        num_labels=3, id2label={0: "contradiction", 1: "neutral", 2: "entailment"},
+        label2id={"contradiction": 0, "neutral": 1, "entailment": 2}
+    )
+    BartForSequenceClassification(config).save_pretrained(path)
+    return path
+
+def build_sentence_encoder(path, tokenizer):
+    """A tiny BERT; sentence-transformers wraps a plain HF model dir with mean pooling."""
+    from transformers import BertConfig, BertModel
+
+    hf_tokenizer = _save_tokenizer(tokenizer, path, pair_template=True)
+    config = BertConfig(
+        vocab_size=len(hf_tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=128, max_position_embeddings=512, pad_token_id=hf_tokenizer.pad_token_id
+    )
+    BertModel(config).save_pretrained(path)
+    return path
+
+def build_spacy_pipeline(path):
+    """Blank English pipeline whose NER is an entity ruler over the synthetic entities."""
+    import spacy
+
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": label, "pattern": value} for label, values in ENTITIES.items() for value in values])
+    nlp.to_disk(path)
+    return path
+
+def build_fixtures(root, n_items=200, seed=0):
+    """Builds every offline fixture under root. Returns {component: path or name}."""
+    random.seed(seed)
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(seed=seed)
+    data_dir = os.path.join(root, "data")
+    return {
+        "generator": build_causal_lm(os.path.join(root, "tiny-gpt2"), tokenizer),
+        "nli": build_nli_model(os.path.join(root, "tiny-bart-mnli"), tokenizer),
+        "encoder": build_sentence_encoder(os.path.join(root, "tiny-encoder"), tokenizer),
+        "spacy": build_spacy_pipeline(os.path.join(root, "tiny-spacy")),
+        "dataset": build_dataset(os.path.join(data_dir, "cache"), n_items, seed),
+        "data_dir": data_dir,
+    }
+
+# ---------------------------------------------------------------------------
+# Timing
+# ---------------------------------------------------------------------------
+
+class MemorySampler:
+    """Polls the current RSS in a background thread; stop() returns the peak seen."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_bytes() or 0)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes() or 0)
+        return self.peak
+
+def bench(fn, items, repeat=3, warmup=1):
+    """
+    Runs fn() warmup + repeat times; items is how many items one call processes.
+    Memory is the peak RSS while the case runs minus the RSS right before it: the
+    process-wide peak would also count everything earlier cases left behind.
+    """
+    gc.collect()
+    rss_before = current_rss_bytes() or 0
+    sampler = MemorySampler().start()
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    peak = sampler.stop()
+
+    median = statistics.median(times)
+    return {
+        "items": items,
+        "repeat": repeat,
+        "seconds_median": median,
+        "seconds_min": min(times),
+        "items_per_sec": items / median if median > 0 else float("inf"),
+        "peak_rss_bytes": peak,
+        "rss_before_bytes": rss_before,
+        "peak_rss_delta_bytes": max(0, peak - rss_before),
+    }
+
+def run_benchmarks(fixtures, n_items=32, repeat=3, e2e_items=16, e2e_batch_size=4, only=None):
+    from src.generator import CausalGenerator
+    from src.entailment import EntailmentGrader
+    from src.perturb import Perturber
+    from src.retriever import DenseRetriever
+    from src.metrics import compute_hsb
+    from batch_runner import build_evidence, run_experiment
+
+    items = [
+        {"question": item["question"], "gold_answer": item["answer"][0]}
+        for item in synthetic_items(n_items, seed=1)
+    ]
+    evidences = [build_evidence(item) for item in items]
+    torch.manual_seed(0)
+
+    # No result caches anywhere: every call must hit the model
+    gen = CausalGenerator(model_name=fixtures["generator"])
+    grader = EntailmentGrader(model_name=fixtures["nli"], cache_size=0)
+    attacker = Perturber(seed=0, spacy_model=fixtures["spacy"])
+    retriever = DenseRetriever(model_name=fixtures["encoder"])
+    prompts = [gen.build_prompt(evidence, item["question"]) for evidence, item in zip(evidences, items)]
+    counterfactuals = [swap["text"] for swap in attacker.perturb_many(evidences)]
+    answers = [item["gold_answer"] for item in items]
+
+    vocab = 32064 # Phi-3 sized vocab, so the HSB numbers mean something for production
+    hsb_inputs = [(torch.randn(1, 16, vocab), torch.randn(1, 16, vocab)) for _ in range(n_items)]
+
+    runs = {}
+
+    def e2e():
+        # Fresh output and caches per call, so every repeat does the full work
+        run_dir = tempfile.mkdtemp(dir=fixtures["data_dir"], prefix="e2e-")
+        shutil.copytree(os.path.join(fixtures["data_dir"], "cache"), os.path.join(run_dir, "cache"))
+        run_experiment(
+            target_count=e2e_items, output_file=os.path.join(run_dir, "results.jsonl"),
+            max_batch_size=e2e_batch_size, model_name=fixtures["generator"], nli_model_name=fixtures["nli"],
+            spacy_model=fixtures["spacy"], dataset_name=fixtures["dataset"], data_dir=run_dir,
+            nli_cache_path=os.path.join(run_dir, "nli_cache.sqlite"),
+            generation_cache_dir=os.path.join(run_dir, "generation_cache")
+        )
+
+    cases = {
+        "generate": (lambda: [gen.generate(p, max_new_tokens=16) for p in prompts], n_items),
+        "get_logits": (lambda: [gen.get_logits(e, a) for e, a in zip(evidences, answers)], n_items),
+        "get_logits_pair": (lambda: [gen.get_logits_pair(e, c, a) for e, c, a in zip(evidences, counterfactuals, answers)], n_items),
+        "compute_hsb": (lambda: [compute_hsb(p, q) for p, q in hsb_inputs], n_items),
+        "perturb": (lambda: [attacker.perturb(e) for e in evidences], n_items),
+        "perturb_many": (lambda: attacker.perturb_many(evidences), n_items),
+        "check_entailment": (lambda: [grader.check_entailment(e, a) for e, a in zip(evidences, answers)], n_items),
+        "build_index": (lambda: retriever.build_index(evidences), n_items),
+        "retrieve": (lambda: [retriever.retrieve(item["question"], k=3) for item in items], n_items),
+        "end_to_end": (e2e, e2e_items),
+    }
+
+    for name, (fn, count) in cases.items():
+        if only and name not in only:
+            continue
+        if name == "retrieve" and retriever.index is None:
+            retriever.build_index(evidences)
+        print(f"\n--- {name} ---")
+        # The end-to-end slice is long; one warm run is representative enough
+        runs[name] = bench(fn, count, repeat=1 if name == "end_to_end" else repeat,
+                           warmup=0 if name == "end_to_end" else 1)
+        print(f"{name}: {runs[name]['items_per_sec']:.2f} items/sec, "
+              f"peak RSS +{runs[name]['peak_rss_delta_bytes'] / 1024 ** 2:.0f} MiB "
+              f"(process peak {runs[name]['peak_rss_bytes'] / 1024 ** 2:.0f} MiB)")
+    return runs
+
+def environment():
+    import transformers
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.is_available(),
+    }
+
+# ---------------------------------------------------------------------------
+# Baseline comparison
+# ---------------------------------------------------------------------------
+
+def compare(current, baseline, speed_tolerance=0.10, memory_tolerance=0.10):
+    """
+    Flags a benchmark as a regression when items/sec drops by more than
+    speed_tolerance or the case's peak RSS growth (peak_rss_delta_bytes) grows by more
+    than memory_tolerance.
+    Returns the list of comparison rows.
+    """
+    rows = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append({"name": name, "status": "new"})
+            continue
+        speed_ratio = result["items_per_sec"] / base["items_per_sec"] if base["items_per_sec"] else float("nan")
+        # Baselines from before the per-case delta have no comparable memory number
+        base_memory = base.get("peak_rss_delta_bytes")
+        memory_ratio = result["peak_rss_delta_bytes"] / base_memory if base_memory else float("nan")
+        regressions = []
+        if speed_ratio < 1 - speed_tolerance:
+            regressions.append("speed")
+        if memory_ratio > 1 + memory_tolerance:
+            regressions.append("memory")
+        rows.append({
+            "name": name, "speed_ratio": speed_ratio, "memory_ratio": memory_ratio,
+            "status": "REGRESSION (" + ", ".join(regressions) + ")" if regressions else "ok"
+        })
+
+    print(f"\n=== Comparison against baseline ({baseline.get('created', 'unknown date')}) ===")
+    print(f"{'benchmark':<18}{'items/sec':>12}{'RSS delta':>12}  status")
+    for row in rows:
+        if row["status"] == "new":
+            print(f"{row['name']:<18}{'-':>12}{'-':>12}  new (not in baseline)")
+        else:
+            print(f"{row['name']:<18}{row['speed_ratio']:>11.2f}x{row['memory_ratio']:>11.2f}x  {row['status']}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark on tiny random-weight models.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="Stored results JSON to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="Write this run to --baseline")
+    parser.add_argument("--items", type=int, default=32, help="Items per component benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--e2e-items", type=int, default=16)
+    parser.add_argument("--e2e-batch-size", type=int, default=4)
+    parser.add_argument("--only", nargs="+", default=None, help="Run only these benchmarks")
+    parser.add_argument("--fixtures-dir", default=None, help="Keep the fixtures here (default: temp dir)")
+    parser.add_argument("--speed-tolerance", type=float, default=0.10)
+    parser.add_argument("--memory-tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    # Everything is local: make sure nothing reaches for the Hub
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    root = args.fixtures_dir or tempfile.mkdtemp(prefix="causalrag-bench-")
+    print(f"=== Building offline fixtures in {root} ===")
+    fixtures = build_fixtures(root, n_items=max(200, args.e2e_items * 4))
+
+    try:
+        results = {
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "environment": environment(),
+            "config": {k: v for k, v in vars(args).items() if k in ("items", "repeat", "e2e_items", "e2e_batch_size")},
+            "results": run_benchmarks(fixtures, args.items, args.repeat, args.e2e_items, args.e2e_batch_size, args.only),
+        }
+    finally:
+        if args.fixtures_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to '{args.output}'")
+
+    if args.baseline and args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Updated baseline '{args.baseline}'")
+    elif args.baseline:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at '{args.baseline}' yet (create one with --update-baseline).")
+        else:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            rows = compare(results, baseline, args.speed_tolerance, args.memory_tolerance)
+            if any(row["status"].startswith("REGRESSION") for row in rows):
+                sys.exit(1)
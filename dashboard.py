@@ -1,97 +1,366 @@
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import streamlit as st
 import torch
 import plotly.graph_objects as go
 from src.generator import CausalGenerator
-from src.metrics import compute_hsb
+from src.metrics import compute_hsb_batch
 from src.perturb import Perturber
+from src.generation_cache import GenerationCache
+from src.sinks import iter_record_batches
+from src.service import ScoringClient
+from src.analysis import SENSITIVITY_THRESHOLD
+from batch_runner import generate_stage, service_stage, make_record, GENERATION_KWARGS
 
 # Page Config
 st.set_page_config(page_title="CausalRAG Inspector", layout="wide")
 
+# Switch to "meta-llama/Llama-2-7b-chat-hf" later
+MODELS = ["gpt2", "distilgpt2", "microsoft/Phi-3-mini-4k-instruct"]
+
+# Bounded memo caches: answers and scores are small, answer logits are [T, vocab] each
+ANSWER_CACHE_ENTRIES = 512
+LOGITS_CACHE_ENTRIES = 64
+SCORE_CACHE_ENTRIES = 512
+
 # Cached Loaders (so we don't reload the model on every click)
 @st.cache_resource
-def load_models():
-    gen = CausalGenerator(model_name="gpt2") # Switch to "meta-llama/Llama-2-7b-chat-hf" later
-    attacker = Perturber()
-    return gen, attacker
+def load_generator(model_name, service_url):
+    # With a scoring service (python -m src.service) the models live there, not in this process
+    if service_url:
+        return ScoringClient(service_url)
+    return CausalGenerator(model_name=model_name, cache=GenerationCache("data/generation_cache"))
+
+@st.cache_resource
+def load_attacker():
+    return Perturber()
+
+@st.cache_resource
+def scoring_worker():
+    # ONE thread does all model work: reruns never block on a forward pass, and the
+    # generator is never used from two threads at once
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="dashboard-scoring")
+
+# --- Memoized model calls (arguments starting with "_" are not hashed) ---
+
+# The Inspector uses the experiment's QA template and settings (the same as the Batch tab),
+# so a scenario gets the same answer and HSB in both tabs
+
+@st.cache_data(max_entries=ANSWER_CACHE_ENTRIES, show_spinner=False)
+def cached_answer(model_key, evidence, query, _gen):
+    """Greedy answer under E -> {answer, answer_ids, question}."""
+    if isinstance(_gen, ScoringClient):
+        response = _gen.generate(evidence, query, **GENERATION_KWARGS)
+    else:
+        response = _gen.generate_and_score(evidence, query, **GENERATION_KWARGS)
+    return {"answer": response["answer"], "answer_ids": list(response["answer_ids"]), "question": query}
+
+@st.cache_data(max_entries=LOGITS_CACHE_ENTRIES, show_spinner=False)
+def cached_logits(model_key, context, question, answer_ids, _gen):
+    """Answer-token log-probs under one context; editing only E' reuses the E pass."""
+    return torch.log_softmax(_gen.get_answer_logits(context, question, list(answer_ids)).float(), dim=-1).cpu()
+
+@st.cache_data(max_entries=SCORE_CACHE_ENTRIES, show_spinner=False)
+def cached_score(model_key, evidence, evidence_prime, question, answer_ids, _gen):
+    """HSB and per-token KL of the answer tokens under E vs E'."""
+    if isinstance(_gen, ScoringClient):
+        response = _gen.score(evidence, evidence_prime, question=question, answer_ids=list(answer_ids))
+        return {"hsb": response["hsb"], "per_token_kl": response["per_token_kl"]}
+    logits_E = cached_logits(model_key, evidence, question, answer_ids, _gen)
+    logits_E_prime = cached_logits(model_key, evidence_prime, question, answer_ids, _gen)
+    per_token = compute_hsb_batch(logits_E, logits_E_prime)["per_token"][0]
+    return {"hsb": per_token.sum().item(), "per_token_kl": per_token.tolist()}
+
+def sampled_answer(evidence, query, gen, temperature):
+    # Sampled answers differ on every call, so they are never memoized
+    answer = gen.generate(gen.build_prompt(evidence, query), temperature=temperature, **GENERATION_KWARGS)
+    answer_ids = gen.tokenizer(answer, add_special_tokens=False).input_ids
+    return {"answer": answer, "answer_ids": answer_ids, "question": query}
 
-gen, attacker = load_models()
+def poll_job(name):
+    """Moves a finished background job's result into session_state. Returns True while it still runs."""
+    job = st.session_state.get(name + "_job")
+    if job is None:
+        return False
+    if not job.done():
+        return True
+    del st.session_state[name + "_job"]
+    try:
+        st.session_state[name] = job.result()
+    except Exception as e:
+        st.session_state[name + "_error"] = str(e)
+    return False
+
+# --- Batch scoring helpers ---
+
+def load_scenarios(uploaded):
+    """Rows of an uploaded CSV / JSONL file as dicts (question, evidence, optional id / evidence_prime)."""
+    if uploaded.name.endswith(".csv"):
+        rows = pd.read_csv(io.BytesIO(uploaded.getvalue())).to_dict("records")
+    else:
+        rows = [json.loads(line) for line in uploaded.getvalue().decode("utf-8").splitlines() if line.strip()]
+    missing = {"question", "evidence"} - set(rows[0]) if rows else set()
+    if missing:
+        raise ValueError(f"Missing columns: {sorted(missing)}")
+    return rows
+
+def prepare_scenarios(rows, start, attacker):
+    """Builds batch_runner work dicts; rows without an evidence_prime are auto-perturbed."""
+    todo = [i for i, row in enumerate(rows) if not isinstance(row.get("evidence_prime"), str)]
+    swaps = dict(zip(todo, attacker.perturb_many([rows[i]["evidence"] for i in todo], strategy="adversarial")))
+
+    prepared = []
+    for i, row in enumerate(rows):
+        evidence_prime = swaps[i]["text"] if i in swaps else row["evidence_prime"]
+        if i in swaps and swaps[i]["label"] is None:
+            continue # No entity to swap
+        item_id = row.get("id", start + i)
+        prepared.append({
+            "item": {"id": item_id, "question": row["question"]},
+            "evidence_E": row["evidence"],
+            "evidence_E_prime": evidence_prime
+        })
+    return prepared
+
+def score_scenarios(prepared, gen):
+    # Same stages as the experiment; there is no NLI judge in the dashboard process
+    if isinstance(gen, ScoringClient):
+        return service_stage(prepared, gen)
+    return [make_record(work, None) for work in generate_stage(prepared, gen)]
+
+def score_batch(rows, batch_size, attacker, gen, progress):
+    """Background job: scores the rows chunk by chunk, reporting into the `progress` dict."""
+    records = []
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        prepared = prepare_scenarios(chunk, start, attacker)
+        progress["skipped"] += len(chunk) - len(prepared)
+        records.extend(score_scenarios(prepared, gen))
+        progress["done"] = start + len(chunk)
+    return {"records": pd.DataFrame(records), "skipped": progress["skipped"]}
+
+# --- Streaming results browser ---
+
+def results_version(path):
+    """Changes whenever the results file (or a Parquet part) is appended to."""
+    if os.path.isdir(path):
+        return max((entry.stat().st_mtime for entry in os.scandir(path)), default=0.0)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def results_summary(path, version):
+    """One streaming pass over the score columns: count, mean, min, max, share above the threshold."""
+    stats = {column: {"count": 0, "sum": 0.0, "min": float("inf"), "max": float("-inf")}
+             for column in ("hsb_score", "delta_entailment")}
+    sensitive = 0
+    for batch in iter_record_batches(path, columns=list(stats)):
+        for record in batch:
+            for column, entry in stats.items():
+                value = record.get(column)
+                if value is None:
+                    continue
+                entry["count"] += 1
+                entry["sum"] += value
+                entry["min"] = min(entry["min"], value)
+                entry["max"] = max(entry["max"], value)
+            if (record.get("hsb_score") or 0.0) > SENSITIVITY_THRESHOLD:
+                sensitive += 1
+
+    summary = {
+        column: {"count": entry["count"], "mean": entry["sum"] / entry["count"] if entry["count"] else None,
+                 "min": entry["min"] if entry["count"] else None, "max": entry["max"] if entry["count"] else None}
+        for column, entry in stats.items()
+    }
+    summary["records"] = stats["hsb_score"]["count"]
+    summary["sensitive"] = sensitive
+    return summary
+
+def results_page(path, page, page_size):
+    """Only the requested page is materialized; earlier pages are streamed past."""
+    return next(itertools.islice(iter_record_batches(path, batch_size=page_size), page, page + 1), [])
 
 # --- SIDEBAR ---
 st.sidebar.title("Configuration")
-model_name = st.sidebar.selectbox("Model", ["gpt2", "Llama-3-8B (Mock)", "Mistral-7B (Mock)"])
-temp = st.sidebar.slider("Temperature", 0.0, 1.0, 0.7)
+service_url = st.sidebar.text_input(
+    "Scoring service (optional)", os.environ.get("CAUSALRAG_SERVICE", ""),
+    help="e.g. http://127.0.0.1:8765 or unix:///tmp/causalrag.sock"
+).strip()
+remote = bool(service_url)
+
+if remote:
+    # The service decides the model; answers via the service are always greedy
+    try:
+        service_model = ScoringClient(service_url).health()["model"]
+    except Exception as e:
+        st.sidebar.error(f"Scoring service unreachable: {e}")
+        st.stop()
+    model_name = st.sidebar.selectbox("Model", [service_model], disabled=True)
+    temp = st.sidebar.slider("Temperature", 0.0, 1.0, 0.0, disabled=True, help="The service decodes greedily")
+else:
+    model_name = st.sidebar.selectbox("Model", MODELS)
+    temp = st.sidebar.slider("Temperature", 0.0, 1.0, 0.0, help="0 = greedy (cached); above 0 samples")
+
+gen = load_generator(model_name, service_url)
+attacker = load_attacker()
+worker = scoring_worker()
+model_key = (service_url, model_name)
+
+# A different model invalidates everything shown for the previous one
+if st.session_state.get("model_key") != model_key:
+    for name in ("answer", "hsb", "answer_job", "hsb_job"):
+        st.session_state.pop(name, None)
+    st.session_state["model_key"] = model_key
 
 # --- MAIN PAGE ---
 st.title("🕵️ CausalRAG: Hallucination Inspector")
 st.markdown("Intervention-based evaluation of RAG stability.")
 
-col1, col2 = st.columns(2)
-
-with col1:
-    st.subheader("1. The Scenario")
-    query = st.text_input("Question (q)", "Where is the Eiffel Tower?")
-    evidence = st.text_area("Original Evidence (E)", "The Eiffel Tower is located in Paris, France.")
-    
-    if st.button("Generate Baseline Answer (y)"):
-        with st.spinner("Generating..."):
-            prompt = f"Context: {evidence}\nQuestion: {query}"
-            answer = gen.generate(prompt)
-            st.session_state['answer'] = answer
-            st.success("Baseline Generated!")
-
-    if 'answer' in st.session_state:
-        st.info(f"**Model Answer (y):**\n\n{st.session_state['answer']}")
-
-with col2:
-    st.subheader("2. The Intervention")
-    
-    # Auto-Perturb Button
-    if st.button("🎲 Auto-Perturb Evidence"):
-        new_ev = attacker.perturb(evidence, strategy="adversarial")
-        st.session_state['evidence_prime'] = new_ev
-    
-    evidence_prime = st.text_area(
-        "Counterfactual Evidence (E')", 
-        value=st.session_state.get('evidence_prime', "The Eiffel Tower is located in Tokyo, Japan.")
-    )
-
-    if 'answer' in st.session_state:
-        if st.button("🔥 Measure Sensitivity (HSB)"):
-            with st.spinner("Calculating KL Divergence..."):
-                # 1. Get Logits for Original
-                logits_E = gen.get_logits(evidence, st.session_state['answer'])
-                
-                # 2. Get Logits for Counterfactual
-                logits_E_prime = gen.get_logits(evidence_prime, st.session_state['answer'])
-                
-                # 3. Compute Metric
-                hsb = compute_hsb(logits_E, logits_E_prime)
-                
-                # Visualization
-                st.metric(label="Hallucination Sensitivity Bound (HSB)", value=f"{hsb:.4f}")
-                
-                if hsb > 1.0:
-                    st.success("High Sensitivity: Model respected the evidence change.")
-                elif hsb > 0.1:
-                    st.warning("Moderate Sensitivity: Model is uncertain.")
-                else:
-                    st.error("Low Sensitivity: Hallucination Risk! Model ignored evidence.")
-
-                # Simple Gauge Chart
-                fig = go.Figure(go.Indicator(
-                    mode = "gauge+number",
-                    value = hsb,
-                    domain = {'x': [0, 1], 'y': [0, 1]},
-                    title = {'text': "Causal Influence"},
-                    gauge = {'axis': {'range': [None, 10]},
-                             'bar': {'color': "darkblue"},
-                             'steps': [
-                                 {'range': [0, 0.5], 'color': "red"},
-                                 {'range': [0.5, 2], 'color': "yellow"},
-                                 {'range': [2, 10], 'color': "green"}],
-                             }))
-                st.plotly_chart(fig, use_container_width=True)
+inspect_tab, batch_tab, results_tab = st.tabs(["🔍 Inspector", "📦 Batch scoring", "📂 Experiment Results"])
+
+with inspect_tab:
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.subheader("1. The Scenario")
+        query = st.text_input("Question (q)", "Where is the Eiffel Tower?")
+        evidence = st.text_area("Original Evidence (E)", "The Eiffel Tower is located in Paris, France.")
+
+        if st.button("Generate Baseline Answer (y)", disabled="answer_job" in st.session_state):
+            st.session_state.pop("hsb", None)
+            if temp > 0:
+                st.session_state["answer_job"] = worker.submit(sampled_answer, evidence, query, gen, temp)
+            else:
+                st.session_state["answer_job"] = worker.submit(cached_answer, model_key, evidence, query, gen)
+
+        if poll_job("answer"):
+            st.info("Generating in the background...")
+        if "answer_error" in st.session_state:
+            st.error(f"Generation failed: {st.session_state.pop('answer_error')}")
+        if 'answer' in st.session_state:
+            st.info(f"**Model Answer (y):**\n\n{st.session_state['answer']['answer']}")
+
+    with col2:
+        st.subheader("2. The Intervention")
+
+        # Auto-Perturb Button
+        if st.button("🎲 Auto-Perturb Evidence"):
+            new_ev = attacker.perturb(evidence, strategy="adversarial")
+            st.session_state['evidence_prime'] = new_ev
+
+        evidence_prime = st.text_area(
+            "Counterfactual Evidence (E')",
+            value=st.session_state.get('evidence_prime', "The Eiffel Tower is located in Tokyo, Japan.")
+        )
+
+        if 'answer' in st.session_state:
+            if st.button("🔥 Measure Sensitivity (HSB)", disabled="hsb_job" in st.session_state):
+                # Repeat clicks on the same (model, E, E', y) are served from the memo caches
+                # Scored under the question the answer was generated for
+                answer = st.session_state['answer']
+                st.session_state["hsb_job"] = worker.submit(
+                    cached_score, model_key, evidence, evidence_prime, answer["question"], tuple(answer["answer_ids"]), gen
+                )
+
+        if poll_job("hsb"):
+            st.info("Calculating KL Divergence in the background...")
+        if "hsb_error" in st.session_state:
+            st.error(f"Scoring failed: {st.session_state.pop('hsb_error')}")
+
+        if "hsb" in st.session_state:
+            hsb = st.session_state["hsb"]["hsb"]
+
+            # Visualization
+            st.metric(label="Hallucination Sensitivity Bound (HSB)", value=f"{hsb:.4f}")
+
+            if hsb > 1.0:
+                st.success("High Sensitivity: Model respected the evidence change.")
+            elif hsb > 0.1:
+                st.warning("Moderate Sensitivity: Model is uncertain.")
+            else:
+                st.error("Low Sensitivity: Hallucination Risk! Model ignored evidence.")
+
+            # Simple Gauge Chart
+            fig = go.Figure(go.Indicator(
+                mode = "gauge+number",
+                value = hsb,
+                domain = {'x': [0, 1], 'y': [0, 1]},
+                title = {'text': "Causal Influence"},
+                gauge = {'axis': {'range': [None, 10]},
+                         'bar': {'color': "darkblue"},
+                         'steps': [
+                             {'range': [0, 0.5], 'color': "red"},
+                             {'range': [0.5, 2], 'color': "yellow"},
+                             {'range': [2, 10], 'color': "green"}],
+                         }))
+            st.plotly_chart(fig, use_container_width=True)
+
+            # Where in the answer the evidence change matters
+            st.caption("KL divergence per answer token")
+            st.bar_chart(st.session_state["hsb"]["per_token_kl"])
+
+with batch_tab:
+    st.subheader("Score many scenarios")
+    st.markdown("Upload a CSV or JSONL file with `question` and `evidence` columns "
+                "(optional: `id`, `evidence_prime`; missing counterfactuals are auto-perturbed). "
+                "Answers are greedy, as in the experiment.")
+    uploaded = st.file_uploader("Scenarios", type=["csv", "jsonl"])
+    batch_size = st.number_input("Batch size", min_value=1, max_value=64, value=8)
+
+    running = poll_job("batch_results")
+    if uploaded is not None and st.button("Score scenarios", disabled=running):
+        try:
+            rows = load_scenarios(uploaded)
+        except ValueError as e:
+            st.error(str(e))
+            rows = []
+        if rows:
+            # Same single worker as the inspector: the model is never used from two threads
+            progress = {"done": 0, "total": len(rows), "skipped": 0}
+            st.session_state["batch_progress"] = progress
+            st.session_state.pop("batch_results", None)
+            st.session_state["batch_results_job"] = worker.submit(score_batch, rows, batch_size, attacker, gen, progress)
+            running = True
+
+    if running:
+        progress = st.session_state["batch_progress"]
+        st.progress(progress["done"] / progress["total"], text=f"{progress['done']} / {progress['total']} scenarios")
+    if "batch_results_error" in st.session_state:
+        st.error(f"Batch scoring failed: {st.session_state.pop('batch_results_error')}")
+
+    if "batch_results" in st.session_state:
+        if st.session_state["batch_results"]["skipped"]:
+            st.warning(f"{st.session_state['batch_results']['skipped']} scenarios had no entity to perturb and were skipped.")
+        batch_df = st.session_state["batch_results"]["records"]
+        st.write(f"{len(batch_df)} scored scenarios")
+        st.dataframe(batch_df)
+        st.download_button("Download CSV", batch_df.to_csv(index=False), "scored_scenarios.csv", "text/csv")
+
+with results_tab:
+    results_path = st.text_input("Results file (JSONL or Parquet directory)", "final_thesis_results.jsonl")
+    version = results_version(results_path)
+    if version is None:
+        st.warning("No results found.")
+    else:
+        # Summary and pages are streamed from disk; the file is never loaded whole
+        summary = results_summary(results_path, version)
+        st.write(f"{summary['records']} records, "
+                 f"{summary['sensitive']} above the sensitivity threshold ({SENSITIVITY_THRESHOLD})")
+        st.dataframe(pd.DataFrame({column: summary[column] for column in ("hsb_score", "delta_entailment")}))
+
+        page_size = st.selectbox("Rows per page", [25, 100, 500], index=1)
+        num_pages = max(1, -(-summary["records"] // page_size))
+        page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1) - 1
+        st.dataframe(pd.DataFrame(results_page(results_path, page, page_size)))
 
 st.markdown("---")
-st.caption("CausalRAG v0.1 | Master's Thesis Project")
\ No newline at end of file
+st.caption("CausalRAG v0.1 | Master's Thesis Project")
+
+# Keep polling while the background worker is busy (the page stays interactive in between)
+if any(job in st.session_state for job in ("answer_job", "hsb_job", "batch_results_job")):
+    time.sleep(0.3)
+    st.rerun()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+from src.sinks import IdIndex, ParquetSink, is_parquet, iter_records
+
+def shard_output_file(output_file, shard_index, num_shards):
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.shard{shard_index:02d}-of-{num_shards:02d}{ext or '.jsonl'}"
+
+def core_sets(num_workers, cores=None):
+    """Splits the available cores into num_workers disjoint, contiguous sets."""
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    per_worker = max(1, len(cores) // num_workers)
+    return [cores[i * per_worker:(i + 1) * per_worker] or cores[-1:] for i in range(num_workers)]
+
+def worker(shard_index, num_shards, cores, target_count, output_file, runner_kwargs):
+    """Entry point of one worker process: pin cores, size torch's thread pool, run its shard."""
+    threads = str(len(cores))
+    # Must be set before torch is imported, so batch_runner is imported only after this
+    os.environ["OMP_NUM_THREADS"] = threads
+    os.environ["MKL_NUM_THREADS"] = threads
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(len(cores))
+
+    from batch_runner import run_experiment
+    run_experiment(
+        target_count=target_count,
+        output_file=output_file,
+        num_shards=num_shards,
+        shard_index=shard_index,
+        **runner_kwargs
+    )
+
+def merge_shards(output_file, shard_files):
+    """
+    Merges the shard files (and any existing final output) into output_file,
+    keeping the first record seen for every id, sorted by id. The output keeps the
+    shards' format: a `*.parquet` output is a ParquetSink directory, anything else JSONL.
+    The merge is written to a temp name first, so a crash mid-merge never leaves the
+    final output half written.
+    """
+    records = {}
+    for path in [output_file] + shard_files:
+        # iter_records reads JSONL or Parquet shards and skips partial last lines
+        for data in iter_records(path):
+            records.setdefault(data['id'], data)
+
+    if is_parquet(output_file):
+        return _merge_parquet(output_file, records)
+
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        for item_id in sorted(records):
+            f.write(json.dumps(records[item_id]) + "\n")
+    os.replace(tmp_file, output_file)
+    # The merged file was rewritten, so its resume index must be rebuilt on next open
+    IdIndex(output_file).reset()
+    print(f"Merged {len(records)} unique records into {output_file}")
+    return len(records)
+
+def _merge_parquet(output_file, records):
+    # A directory can't be os.replace'd over a non-empty one: swap via "<output>.old"
+    tmp_dir, old_dir = output_file + ".tmp", output_file + ".old"
+    for path in (tmp_dir, old_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    # The sink writes the parts and their id index (inside the directory)
+    with ParquetSink(tmp_dir, flush_every=100000) as sink:
+        sink.write_many([records[item_id] for item_id in sorted(records)])
+
+    if os.path.exists(output_file):
+        os.rename(output_file, old_dir)
+    os.rename(tmp_dir, output_file)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    print(f"Merged {len(records)} unique records into {output_file}")
+    return len(records)
+
+def launch(num_workers, target_count=15000, output_file="final_thesis_results.jsonl",
+           max_restarts=2, runner_kwargs=None):
+    """
+    Starts num_workers processes on disjoint id shards and core sets, restarts a
+    worker that dies (it resumes from its own shard file), then merges everything.
+    """
+    runner_kwargs = runner_kwargs or {}
+    per_shard_target = math.ceil(target_count / num_workers)
+
+    # Download and cache the split once, before N workers race to write the same file
+    from src.data_loader import DataLoader
+    data_dir = runner_kwargs.get("data_dir", "data")
+    DataLoader(runner_kwargs.get("dataset_name", "nq_open"), split="train", cache_dir=os.path.join(data_dir, "cache"))
+
+    cores = core_sets(num_workers)
+    shard_files = [shard_output_file(output_file, i, num_workers) for i in range(num_workers)]
+
+    # spawn: every worker gets a fresh interpreter and its own model instances
+    ctx = mp.get_context("spawn")
+
+    def start(i):
+        proc = ctx.Process(
+            target=worker,
+            args=(i, num_workers, cores[i], per_shard_target, shard_files[i], runner_kwargs),
+            name=f"shard-{i}"
+        )
+        proc.start()
+        print(f"Started shard {i} (pid {proc.pid}) on cores {cores[i]}")
+        return proc
+
+    procs = {i: start(i) for i in range(num_workers)}
+    restarts = {i: 0 for i in range(num_workers)}
+
+    while procs:
+        for i, proc in list(procs.items()):
+            proc.join(timeout=1.0)
+            if proc.is_alive():
+                continue
+            del procs[i]
+            if proc.exitcode != 0 and restarts[i] < max_restarts:
+                restarts[i] += 1
+                print(f"Shard {i} exited with code {proc.exitcode}, restarting ({restarts[i]}/{max_restarts})...")
+                procs[i] = start(i)
+            elif proc.exitcode != 0:
+                print(f"Shard {i} failed {max_restarts + 1} times, giving up on it.")
+
+    return merge_shards(output_file, shard_files)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the experiment as N sharded worker processes.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--target", type=int, default=15000)
+    parser.add_argument("--output", default="final_thesis_results.jsonl")
+    parser.add_argument("--max-batch-size", type=int, default=1)
+    parser.add_argument("--token-budget", type=int, default=None)
+    parser.add_argument("--precision", default=None, choices=["fp32", "fp16", "bf16", "int8"])
+    parser.add_argument("--profile-items", type=int, default=0, help="Profile the first N items of every shard")
+    parser.add_argument("--sweep-k", type=int, default=None, help="Counterfactuals scored per item (sweep mode)")
+    parser.add_argument("--service-url", default=None,
+                        help="Score through a running scoring service (python -m src.service) instead of per-worker models")
+    parser.add_argument("--token-cache", default=None, help="TokenCache directory filled by pretokenize.py")
+    parser.add_argument("--bucket-width", type=int, default=None, help="Batch by prompt-length buckets of this width")
+    parser.add_argument("--generation-cache", default=None,
+                        help="GenerationCache directory shared by all shards (off by default)")
+    parser.add_argument("--merge-only", action="store_true", help="Only merge existing shard files")
+    args = parser.parse_args()
+
+    if args.merge_only:
+        merge_shards(args.output, [shard_output_file(args.output, i, args.workers) for i in range(args.workers)])
+    else:
+        launch(
+            args.workers,
+            target_count=args.target,
+            output_file=args.output,
+            runner_kwargs={
+                "max_batch_size": args.max_batch_size,
+                "token_budget": args.token_budget,
+                "precision": args.precision,
+                "profile_items": args.profile_items,
+                "sweep_k": args.sweep_k,
+                "service_url": args.service_url,
+                "token_cache_dir": args.token_cache,
+                "bucket_width": args.bucket_width,
+                "generation_cache_dir": args.generation_cache
+            }
+        )
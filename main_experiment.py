@@ -3,14 +3,15 @@ from src.generator import CausalGenerator
 from src.retriever import DenseRetriever
 from src.metrics import compute_hsb
 from src.perturb import Perturber
+from src.generation_cache import GenerationCache
 
 def main():
     print("=== Initializing CausalRAG Pipeline ===")
     
     # 1. Setup Models
     # We let the CausalGenerator auto-detect the best device (MPS/CUDA/CPU)
-    gen = CausalGenerator(model_name="gpt2") 
-    ret = DenseRetriever()
+    gen = CausalGenerator(model_name="gpt2", cache=GenerationCache("data/generation_cache"))
+    ret = DenseRetriever(embedding_cache="data/embedding_cache")
     attacker = Perturber()
 
     # 2. Mock Knowledge Base (In reality, load this from data/raw)
@@ -34,7 +35,7 @@ def main():
     # Generate the Baseline Answer (y)
     # We use the Generator to answer based on the original truthful evidence
     prompt_original = f"Context: {evidence_E}\nQuestion: {query}"
-    answer_y = gen.generate(prompt_original)
+    answer_y = gen.generate(prompt_original, stop_at_newline=True)
     
     print(f"\n[1] Query: {query}")
     print(f"[2] Original Evidence (E):  {evidence_E}")
@@ -51,8 +52,8 @@ def main():
     # when we force it to see the LIE (E') vs the TRUTH (E) for the SAME answer.
     
     print("\n... Calculating Logits & HSB ...")
-    logits_E = gen.get_logits(evidence_E, answer_y)
-    logits_E_prime = gen.get_logits(evidence_E_prime, answer_y)
+    # Both evidence versions are scored in one padded forward pass
+    logits_E, logits_E_prime = gen.get_logits_pair(evidence_E, evidence_E_prime, answer_y)
 
     hsb_score = compute_hsb(logits_E, logits_E_prime)
     
@@ -0,0 +1,152 @@
+import argparse
+import json
+import time
+from src.generator import CausalGenerator
+from src.entailment import EntailmentGrader
+from src.perturb import Perturber
+from src.data_loader import DataLoader
+from src.metrics import compute_hsb_batch, pad_answer_logits
+from src.precision import model_size_bytes
+from src.registry import release
+from src.analysis import SENSITIVITY_THRESHOLD
+from batch_runner import build_evidence, GENERATION_KWARGS
+
+def prepare_items(num_items, seed=0):
+    """Fixed item set: the first num_items validation questions with a successful (seeded) attack."""
+    loader = DataLoader(split="validation", cache_dir="data/cache")
+    attacker = Perturber(seed=seed)
+    items = list(loader.iter_items(start_index=0, limit=num_items * 2))
+    evidences = [build_evidence(item) for item in items]
+    swaps = attacker.perturb_many(evidences, strategy="adversarial")
+
+    prepared = []
+    for item, evidence_E, swap in zip(items, evidences, swaps):
+        if swap["label"] is not None:
+            prepared.append({"item": item, "evidence_E": evidence_E, "evidence_E_prime": swap["text"]})
+    return prepared[:num_items]
+
+def run_precision(prepared, precision, model_name, nli_model_name, batch_size=8, reference=None):
+    """
+    Runs generate -> HSB -> delta entailment over the item set under one precision.
+    With a reference run, HSB and delta entailment are computed for the reference's
+    answers, so the drift measures the numerics and not a different answer.
+    """
+    # No result caches here: every number must come from this precision's forward passes
+    gen = CausalGenerator(model_name=model_name, device="cpu", precision=precision)
+    grader = EntailmentGrader(model_name=nli_model_name, device="cpu", cache_size=0, precision=precision)
+    model_bytes = model_size_bytes(gen.model) + model_size_bytes(grader.model) # also loads both models
+
+    result = {"precision": gen.precision, "answers": [], "answer_ids": [], "hsb": [], "delta_entailment": [],
+              "seconds": {"generate": 0.0, "score": 0.0, "grade": 0.0}, "model_bytes": model_bytes}
+
+    for start in range(0, len(prepared), batch_size):
+        chunk = prepared[start:start + batch_size]
+        contexts_E = [work["evidence_E"] for work in chunk]
+        contexts_E_prime = [work["evidence_E_prime"] for work in chunk]
+        questions = [work["item"]['question'] for work in chunk]
+
+        # 1. Generate under E
+        t0 = time.perf_counter()
+        generations = gen.generate_and_score_batch(contexts_E, questions, **GENERATION_KWARGS)
+        result["seconds"]["generate"] += time.perf_counter() - t0
+        result["answers"].extend(generation["answer"] for generation in generations)
+        result["answer_ids"].extend(generation["answer_ids"] for generation in generations)
+
+        source = reference or result
+        answers = source["answers"][start:start + len(chunk)]
+        answer_ids = source["answer_ids"][start:start + len(chunk)]
+
+        # 2. HSB: the same answer tokens teacher-forced under E and E'
+        t0 = time.perf_counter()
+        logits_E, mask = pad_answer_logits(gen.get_answer_logits_batch(contexts_E, questions, answer_ids))
+        logits_E_prime, _ = pad_answer_logits(gen.get_answer_logits_batch(contexts_E_prime, questions, answer_ids))
+        result["hsb"].extend(compute_hsb_batch(logits_E, logits_E_prime, mask)["per_item"].tolist())
+        result["seconds"]["score"] += time.perf_counter() - t0
+
+        # 3. Delta entailment
+        t0 = time.perf_counter()
+        result["delta_entailment"].extend(grader.compute_delta_entailment_batch(
+            list(zip(contexts_E, contexts_E_prime, answers))
+        ))
+        result["seconds"]["grade"] += time.perf_counter() - t0
+
+    # Free this precision's weights before the next one is loaded
+    release()
+    return result
+
+def drift_report(reference, result):
+    """Drift of one precision against the fp32 reference, next to its speedup and memory saving."""
+    def abs_diffs(metric):
+        return [abs(a - b) for a, b in zip(reference[metric], result[metric])]
+
+    hsb_diff = abs_diffs("hsb")
+    ent_diff = abs_diffs("delta_entailment")
+    n = len(hsb_diff)
+    flips = sum(
+        (a > SENSITIVITY_THRESHOLD) != (b > SENSITIVITY_THRESHOLD)
+        for a, b in zip(reference["hsb"], result["hsb"])
+    )
+    ref_seconds = sum(reference["seconds"].values())
+    seconds = sum(result["seconds"].values())
+
+    return {
+        "precision": result["precision"],
+        "items": n,
+        "hsb_mean_abs_drift": sum(hsb_diff) / n,
+        "hsb_max_abs_drift": max(hsb_diff),
+        "delta_entailment_mean_abs_drift": sum(ent_diff) / n,
+        "delta_entailment_max_abs_drift": max(ent_diff),
+        "sensitivity_flips": flips / n,
+        "answer_agreement": sum(a == b for a, b in zip(reference["answers"], result["answers"])) / n,
+        "speedup": ref_seconds / seconds if seconds else float("nan"),
+        "stage_speedup": {
+            stage: reference["seconds"][stage] / result["seconds"][stage] if result["seconds"][stage] else float("nan")
+            for stage in result["seconds"]
+        },
+        "memory_saving": 1 - result["model_bytes"] / reference["model_bytes"],
+    }
+
+def check_precisions(precisions=("bf16", "int8"), num_items=100,
+                     model_name="microsoft/Phi-3-mini-4k-instruct",
+                     nli_model_name="facebook/bart-large-mnli", batch_size=8, output_file=None):
+    print(f"=== Precision drift check: {num_items} items, {model_name} + {nli_model_name} (CPU) ===")
+    prepared = prepare_items(num_items)
+
+    # 1. fp32 reference
+    reference = run_precision(prepared, "fp32", model_name, nli_model_name, batch_size)
+
+    # 2. Every candidate precision, scored on the reference answers
+    reports = []
+    for precision in precisions:
+        result = run_precision(prepared, precision, model_name, nli_model_name, batch_size, reference=reference)
+        if result["precision"] == "fp32":
+            print(f"Skipping {precision}: not supported here (fell back to fp32).")
+            continue
+        reports.append(drift_report(reference, result))
+
+    print(f"\n{'precision':<10}{'HSB drift':>20}{'ΔEnt drift':>20}{'flips':>8}{'same ans':>10}{'speedup':>9}{'mem saved':>11}")
+    for r in reports:
+        print(f"{r['precision']:<10}"
+              f"{r['hsb_mean_abs_drift']:>9.4f} / {r['hsb_max_abs_drift']:<8.3f}"
+              f"{r['delta_entailment_mean_abs_drift']:>9.4f} / {r['delta_entailment_max_abs_drift']:<8.3f}"
+              f"{r['sensitivity_flips']:>8.1%}{r['answer_agreement']:>10.1%}"
+              f"{r['speedup']:>8.2f}x{r['memory_saving']:>11.1%}")
+    print("(drift = mean / max absolute difference to fp32; flips = items crossing the HSB sensitivity threshold)")
+
+    if output_file:
+        with open(output_file, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"\nSaved report to '{output_file}'")
+    return reports
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare bf16 / int8 CPU inference against fp32.")
+    parser.add_argument("--precisions", nargs="+", default=["bf16", "int8"])
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct")
+    parser.add_argument("--nli-model", default="facebook/bart-large-mnli")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--output", default="precision_report.json")
+    args = parser.parse_args()
+
+    check_precisions(args.precisions, args.items, args.model, args.nli_model, args.batch_size, args.output)
@@ -0,0 +1,110 @@
+import argparse
+import os
+from src.data_loader import DataLoader
+from src.perturb import Perturber
+from src.cache import hash_key
+from src.generator import QA_PROMPT_TEMPLATE, load_tokenizer
+from src.token_cache import TokenCache, pretokenize
+from src.batching import token_budget_batches, bucket_batches
+from batch_runner import build_evidence, perturb_stage, sweep_perturb_stage, GENERATION_KWARGS
+
+def collect_prompts(items, attacker, sweep_k=None):
+    """
+    Every QA prompt a run tokenizes for these items: E for generation (and batching),
+    and each E' the seeded attacker produces for teacher-forced scoring.
+    """
+    prompts = [QA_PROMPT_TEMPLATE.format(context=build_evidence(item), question=item['question']) for item in items]
+
+    if sweep_k:
+        prepared = sweep_perturb_stage(items, attacker, sweep_k)
+        counterfactuals = [[swap["text"] for swap in work["counterfactuals"]] for work in prepared]
+    else:
+        prepared = perturb_stage(items, attacker)
+        counterfactuals = [[work["evidence_E_prime"]] for work in prepared]
+
+    for work, texts in zip(prepared, counterfactuals):
+        question = work["item"]['question']
+        prompts.extend(QA_PROMPT_TEMPLATE.format(context=text, question=question) for text in texts)
+    return prompts
+
+def padding_efficiency(batches):
+    """Real tokens / padded tokens over batches of prompt lengths."""
+    real = sum(sum(batch) for batch in batches)
+    padded = sum(len(batch) * max(batch) for batch in batches)
+    return real / padded if padded else 1.0
+
+def padding_report(lengths, max_batch_size=8, bucket_width=16, token_budget=None):
+    """How much padding each batching strategy leaves on the generation prompts (dataset order)."""
+    reserve = GENERATION_KWARGS["max_new_tokens"]
+    strategies = {
+        "in order": token_budget_batches(lengths, lambda n: n, None, max_batch_size),
+        "sorted windows": token_budget_batches(
+            lengths, lambda n: n, token_budget or 10 ** 9, max_batch_size, reserve_tokens=reserve
+        ),
+        f"buckets of {bucket_width}": bucket_batches(
+            lengths, lambda n: n, bucket_width, max_batch_size, token_budget, reserve_tokens=reserve
+        ),
+    }
+    return {name: padding_efficiency(list(batches)) for name, batches in strategies.items()}
+
+def pretokenize_dataset(model_name="microsoft/Phi-3-mini-4k-instruct", dataset_name="nq_open", split="train",
+                        data_dir="data", cache_dir="data/token_cache", limit=25000, num_shards=1,
+                        sweep_k=None, spacy_model="en_core_web_sm", chunk_size=1024,
+                        max_batch_size=8, bucket_width=16, token_budget=None):
+    """
+    Fills the TokenCache for the slice run_experiment would process (the same limit and
+    shards, and the same seeded attacks), then reports the length buckets and padding.
+    """
+    print(f"=== Pre-tokenizing {dataset_name}/{split} for {model_name} ===")
+
+    # 1. Components: the run's tokenizer (same loader as CausalGenerator) and the run's (seeded) attacker
+    tokenizer = load_tokenizer(model_name)
+    cache = TokenCache(cache_dir, model_name)
+    attacker = Perturber(seed=0, spacy_model=spacy_model)
+    loader = DataLoader(dataset_name=dataset_name, split=split, cache_dir=os.path.join(data_dir, "cache"))
+
+    # 2. Tokenize chunk by chunk: one nlp.pipe pass and a few big tokenizer calls each
+    generation_keys, added = [], 0
+    for shard_index in range(num_shards):
+        shard = loader.shard(num_shards, shard_index) if num_shards > 1 else loader
+        items = shard.iter_items(start_index=0, limit=limit)
+        for chunk in token_budget_batches(items, None, max_batch_size=chunk_size):
+            prompts = collect_prompts(chunk, attacker, sweep_k)
+            added += pretokenize(cache, tokenizer, prompts, batch_size=chunk_size)
+            generation_keys.extend(hash_key(prompt) for prompt in prompts[:len(chunk)])
+            print(f"  {len(generation_keys)} items, {added} new prompts tokenized")
+
+    # 3. Report
+    stats = cache.stats()
+    print(f"\nToken cache: {stats['entries']} prompts, {stats['tokens']} tokens in {cache.dir}")
+    print(f"Generation prompt lengths (bucket width {bucket_width}):")
+    for start, count in cache.length_buckets(generation_keys, bucket_width).items():
+        print(f"  {start:>5}-{start + bucket_width - 1:<5} {count:>7}")
+
+    found = cache.lengths_many(generation_keys)
+    lengths = [found[key] for key in generation_keys]
+    print(f"\nPadding efficiency at batch size {max_batch_size} (real / padded tokens):")
+    for name, efficiency in padding_report(lengths, max_batch_size, bucket_width, token_budget).items():
+        print(f"  {name:<16} {efficiency:.1%}")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch-tokenize a dataset slice into a TokenCache.")
+    parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct")
+    parser.add_argument("--dataset", default="nq_open")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--cache-dir", default="data/token_cache")
+    parser.add_argument("--limit", type=int, default=25000, help="Items per shard, as in run_experiment")
+    parser.add_argument("--num-shards", type=int, default=1, help="Match launch_workers.py --workers")
+    parser.add_argument("--sweep-k", type=int, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--bucket-width", type=int, default=16)
+    parser.add_argument("--token-budget", type=int, default=None)
+    args = parser.parse_args()
+
+    pretokenize_dataset(
+        args.model, args.dataset, args.split, args.data_dir, args.cache_dir, args.limit, args.num_shards,
+        args.sweep_k, max_batch_size=args.max_batch_size, bucket_width=args.bucket_width,
+        token_budget=args.token_budget
+    )
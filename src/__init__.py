@@ -0,0 +1,23 @@
+# Lazy package exports: `import src` is cheap, and torch / transformers / spaCy
+# are only imported when one of these names is actually used.
+import importlib
+
+_EXPORTS = {
+    "CausalGenerator": "src.generator",
+    "EntailmentGrader": "src.entailment",
+    "Perturber": "src.perturb",
+    "DenseRetriever": "src.retriever",
+    "DataLoader": "src.data_loader",
+    "compute_hsb": "src.metrics",
+    "compute_hsb_batch": "src.metrics",
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name]), name)
+    raise AttributeError(f"module 'src' has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_EXPORTS.keys()))
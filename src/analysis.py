@@ -1,50 +1,307 @@
+import glob
+import hashlib
 import json
+import math
+import os
+import random
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
+from src.sinks import is_parquet
 
-def analyze_results(file_path="results.jsonl"):
-    data = []
-    # robust read that handles potential empty lines
-    with open(file_path, "r") as f:
-        for line in f:
-            if line.strip():
-                data.append(json.loads(line))
-    
-    if not data:
-        print("No data found in results.jsonl!")
+METRICS = ["hsb_score", "delta_entailment"]
+
+# We define 'sensitive' as HSB > 0.5 (Model was surprised)
+SENSITIVITY_THRESHOLD = 0.5
+
+# Fixed histogram ranges (lo, hi, bins, log-spaced). HSB is a summed per-sequence KL:
+# >= 0 with a tail over many orders of magnitude, so its bins are log-spaced
+# (50 per decade); delta entailment is in [-1, 1]
+HISTOGRAM_RANGES = {
+    "hsb_score": (1e-4, 1e4, 400, True),
+    "delta_entailment": (-1.0, 1.0, 200, False),
+}
+
+# Bump when the aggregate layout changes, so older `.agg.json` caches are rebuilt
+# (3: metrics are counted independently, older caches dropped records without NLI scores)
+AGGREGATE_VERSION = 3
+
+class RunningStats:
+    """Streaming count / mean / variance / min / max (Welford), JSON-serializable."""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.n = state.get("n", 0)
+        self.mean = state.get("mean", 0.0)
+        self.m2 = state.get("m2", 0.0)
+        self.min = state.get("min", math.inf)
+        self.max = state.get("max", -math.inf)
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def std(self):
+        # Sample std, like pandas describe()
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else float("nan")
+
+    def state(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max}
+
+class Histogram:
+    """
+    Fixed-bin histogram with under/overflow counters; doubles as a quantile sketch.
+    With log=True the bins are evenly spaced in log(x) (lo must be > 0).
+    """
+
+    def __init__(self, lo, hi, bins, log=False, state=None):
+        self.lo, self.hi, self.bins, self.log = lo, hi, bins, log
+        state = state or {}
+        self.counts = state.get("counts", [0] * bins)
+        self.under = state.get("under", 0)
+        self.over = state.get("over", 0)
+
+    def _scale(self, x):
+        return math.log(x) if self.log else x
+
+    def add(self, x):
+        if x < self.lo:
+            self.under += 1
+        elif x >= self.hi:
+            self.over += 1
+        else:
+            lo, hi = self._scale(self.lo), self._scale(self.hi)
+            index = int((self._scale(x) - lo) / (hi - lo) * self.bins)
+            self.counts[min(index, self.bins - 1)] += 1
+
+    def quantile(self, q, stats):
+        """Approximate quantile, linearly interpolated inside the bin (exact min/max at the ends)."""
+        total = self.under + sum(self.counts) + self.over
+        if total == 0:
+            return float("nan")
+        rank = q * (total - 1)
+        if rank < self.under:
+            return stats.min
+        seen = self.under
+        lo, hi = self._scale(self.lo), self._scale(self.hi)
+        width = (hi - lo) / self.bins
+        for i, count in enumerate(self.counts):
+            if count and rank < seen + count:
+                value = lo + width * (i + (rank - seen + 0.5) / count)
+                return math.exp(value) if self.log else value
+            seen += count
+        return stats.max
+
+    def state(self):
+        return {"counts": self.counts, "under": self.under, "over": self.over}
+
+class ResultsAggregate:
+    """
+    All running aggregates for one results file, plus a reservoir sample of points
+    for plotting. The whole thing round-trips through JSON, so re-analysis of a
+    growing file only has to process the records added since the last run.
+    """
+
+    def __init__(self, state=None, max_points=5000, seed=0):
+        state = state or {}
+        self.stats = {m: RunningStats(state.get("stats", {}).get(m)) for m in METRICS}
+        self.histograms = {
+            m: Histogram(*HISTOGRAM_RANGES[m], state=state.get("histograms", {}).get(m)) for m in METRICS
+        }
+        self.sensitive = state.get("sensitive", 0)
+        self.max_points = state.get("max_points", max_points)
+        self.sample = state.get("sample", [])
+        self.rng = random.Random(seed)
+        if "rng" in state:
+            self.rng.setstate(_to_tuple(state["rng"]))
+
+    @property
+    def count(self):
+        return self.stats["hsb_score"].n
+
+    def add(self, record):
+        # Missing or non-finite (NaN / inf) scores can't be binned or averaged: each metric
+        # skips only its own missing values (runs without NLI have no delta_entailment)
+        values = [record.get(m) for m in METRICS]
+        values = [v if v is not None and math.isfinite(v) else None for v in values]
+        for m, v in zip(METRICS, values):
+            if v is not None:
+                self.stats[m].add(v)
+                self.histograms[m].add(v)
+        if values[0] is None:
+            return # no x coordinate: nothing to count as sensitive or to plot
+        if values[0] > SENSITIVITY_THRESHOLD:
+            self.sensitive += 1
+
+        # Reservoir sampling (Algorithm R): a uniform sample of at most max_points points
+        if len(self.sample) < self.max_points:
+            self.sample.append(values)
+        else:
+            j = self.rng.randrange(self.count)
+            if j < self.max_points:
+                self.sample[j] = values
+
+    def describe(self):
+        """Same rows as pandas describe(), from the running aggregates."""
+        rows = {}
+        for m in METRICS:
+            s, h = self.stats[m], self.histograms[m]
+            rows[m] = {
+                "count": s.n, "mean": s.mean, "std": s.std, "min": s.min,
+                "25%": h.quantile(0.25, s), "50%": h.quantile(0.5, s),
+                "75%": h.quantile(0.75, s), "max": s.max
+            }
+        return pd.DataFrame(rows)
+
+    def state(self):
+        return {
+            "stats": {m: s.state() for m, s in self.stats.items()},
+            "histograms": {m: h.state() for m, h in self.histograms.items()},
+            "sensitive": self.sensitive,
+            "max_points": self.max_points,
+            "sample": self.sample,
+            "rng": self.rng.getstate()
+        }
+
+def _to_tuple(value):
+    return tuple(_to_tuple(v) for v in value) if isinstance(value, list) else value
+
+def update_aggregate(file_path, chunk_lines=10000):
+    """
+    Brings the cached aggregate of `file_path` up to date and returns it.
+    Partial aggregates are stored next to the results (`<file>.agg.json`) together
+    with how far they got: a byte offset for JSONL, the set of part files for Parquet.
+    """
+    cache_path = file_path.rstrip("/") + ".agg.json"
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache.get("version") != AGGREGATE_VERSION:
+            cache = {} # older layout: rebuild from scratch
+
+    if is_parquet(file_path):
+        agg, progress = _update_parquet(file_path, cache)
+    else:
+        agg, progress = _update_jsonl(file_path, cache, chunk_lines)
+
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": AGGREGATE_VERSION, "progress": progress, "aggregate": agg.state()}, f)
+    os.replace(tmp_path, cache_path)
+    return agg
+
+def _jsonl_fingerprint(file_path, offset, window=4096):
+    """
+    Identifies the already-aggregated prefix: inode plus a hash of the first bytes and
+    of the bytes just before `offset`. A rewrite (e.g. merge_shards re-sorting the
+    file) changes these even when the file only grew.
+    """
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "rb") as f:
+        head = f.read(min(window, offset))
+        f.seek(max(0, offset - window))
+        tail = f.read(min(window, offset))
+    return {
+        "inode": os.stat(file_path).st_ino,
+        "head": hashlib.sha256(head).hexdigest(),
+        "tail": hashlib.sha256(tail).hexdigest()
+    }
+
+def _update_jsonl(file_path, cache, chunk_lines):
+    progress = cache.get("progress", {})
+    offset = progress.get("offset", 0)
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if offset > size or (offset and progress.get("fingerprint") != _jsonl_fingerprint(file_path, offset)):
+        cache, offset = {}, 0 # the file was rewritten: start over
+    agg = ResultsAggregate(cache.get("aggregate"))
+
+    if offset < size:
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                lines = f.readlines(chunk_lines * 512) # ~chunk_lines records per read
+                if not lines:
+                    break
+                for line in lines:
+                    if not line.endswith(b"\n"):
+                        # Partial last line (writer mid-commit): leave it for next time
+                        break
+                    offset += len(line)
+                    if line.strip():
+                        try:
+                            agg.add(json.loads(line))
+                        except ValueError:
+                            continue
+                else:
+                    continue
+                break
+    return agg, {"offset": offset, "fingerprint": _jsonl_fingerprint(file_path, offset)}
+
+def _update_parquet(file_path, cache):
+    import pyarrow.parquet as pq
+
+    done = set(cache.get("progress", {}).get("parts", []))
+    parts = sorted(glob.glob(os.path.join(file_path, "part-*.parquet"))) if os.path.isdir(file_path) else [file_path]
+    if not done.issubset(parts):
+        cache, done = {}, set() # parts were removed or rewritten: start over
+    agg = ResultsAggregate(cache.get("aggregate"))
+
+    for part in parts:
+        if part in done:
+            continue
+        for batch in pq.ParquetFile(part).iter_batches(columns=METRICS):
+            for record in batch.to_pylist():
+                agg.add(record)
+        done.add(part)
+    return agg, {"parts": sorted(done)}
+
+def analyze_results(file_path="results.jsonl", max_points=5000):
+    # Streams the results (JSONL or Parquet directory) chunk-wise; only new records since
+    # the last analysis are read, everything else comes from the cached aggregate
+    agg = update_aggregate(file_path)
+
+    if agg.count == 0:
+        print(f"No data found in {file_path}!")
         return
 
-    df = pd.DataFrame(data)
-    print(f"Loaded {len(df)} records.")
-    
-    # --- FIX: Calculate the missing column manually ---
-    # We define 'sensitive' as HSB > 0.5 (Model was surprised)
-    df['sensitive_hsb'] = df['hsb_score'] > 0.5
-    
-    # 1. Basic Stats
+    print(f"Loaded {agg.count} records.")
+
+    # 1. Basic Stats (quartiles are histogram-based approximations)
     print("\n=== Statistics ===")
-    print(df[['hsb_score', 'delta_entailment']].describe())
+    print(agg.describe())
 
-    # 2. Correlation Plot (HSB vs Entailment)
+    # 2. Correlation Plot (HSB vs Entailment), on a uniform sample of the points
     plt.figure(figsize=(10, 6))
-    
+
     # Check if we have enough variation to plot
-    if len(df) > 1:
+    if agg.count > 1:
+        df = pd.DataFrame(agg.sample[:max_points], columns=METRICS)
+        if df['delta_entailment'].isna().all():
+            df['delta_entailment'] = 0.0 # no NLI scores in this run: HSB only, on a flat line
+        df['sensitive_hsb'] = df['hsb_score'] > SENSITIVITY_THRESHOLD
         sns.scatterplot(
-            data=df, 
-            x='hsb_score', 
-            y='delta_entailment', 
-            hue='sensitive_hsb', 
-            palette='viridis'
+            data=df,
+            x='hsb_score',
+            y='delta_entailment',
+            hue='sensitive_hsb',
+            palette='viridis',
+            s=10 if len(df) > 1000 else None
         )
-        plt.title("Hallucination Sensitivity: Probability Shift vs Logical Shift")
+        sampled = f" ({len(df)} of {agg.count} points)" if len(df) < agg.count else ""
+        plt.title(f"Hallucination Sensitivity: Probability Shift vs Logical Shift{sampled}")
         plt.xlabel("HSB Score (Model Surprise)")
         plt.ylabel("Delta Entailment (Logical Consistency Drop)")
-        
+
         # Add a threshold line
-        plt.axvline(0.5, color='r', linestyle='--', label="Sensitivity Threshold")
-        
+        plt.axvline(SENSITIVITY_THRESHOLD, color='r', linestyle='--', label="Sensitivity Threshold")
+
         plt.legend(title="Detected?")
         plt.grid(True, alpha=0.3)
         plt.savefig("sensitivity_plot.png")
@@ -52,10 +309,9 @@ def analyze_results(file_path="results.jsonl"):
     else:
         print("\nNot enough data points to plot yet.")
 
-    # 3. Success Rate
-    if 'sensitive_hsb' in df.columns:
-        rate = df['sensitive_hsb'].mean()
-        print(f"\nSensitivity Rate: {rate:.2%} of attacks were detected by the model.")
+    # 3. Success Rate (exact, counted while streaming)
+    rate = agg.sensitive / agg.count
+    print(f"\nSensitivity Rate: {rate:.2%} of attacks were detected by the model.")
 
 if __name__ == "__main__":
-    analyze_results()
\ No newline at end of file
+    analyze_results()
@@ -0,0 +1,159 @@
+# File: src/batching.py
+import time
+from collections import defaultdict
+
+
+def token_budget_batches(items, length_fn, token_budget=None, max_batch_size=32,
+                         reserve_tokens=0, window=512):
+    """
+    Groups a stream of items into batches.
+
+    Without a token_budget this is a plain in-order chunking by max_batch_size.
+    With a token_budget, items are read in windows of `window`, sorted by length
+    inside each window (so padding stays small), and a batch grows until
+        rows * (longest_prompt + reserve_tokens) > token_budget.
+    Sorting only inside a window keeps the overall processing order close to the
+    dataset order, so stopping at a target count doesn't favour short items.
+
+    Args:
+        items: iterable of items
+        length_fn: item -> prompt length in tokens
+        token_budget: max padded tokens per batch (None = fixed-size batches)
+        max_batch_size: hard cap on rows per batch
+        reserve_tokens: extra tokens per row (e.g. max_new_tokens for generation)
+        window: how many items to sort together
+    """
+    if token_budget is None:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= max_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if len(buffer) >= window:
+            yield from _pack_window(buffer, length_fn, token_budget, max_batch_size, reserve_tokens)
+            buffer = []
+    if buffer:
+        yield from _pack_window(buffer, length_fn, token_budget, max_batch_size, reserve_tokens)
+
+
+def _pack_window(items, length_fn, token_budget, max_batch_size, reserve_tokens):
+    sized = sorted(((length_fn(item), item) for item in items), key=lambda pair: pair[0])
+
+    batch, longest = [], 0
+    for length, item in sized:
+        new_longest = max(longest, length)
+        cost = (len(batch) + 1) * (new_longest + reserve_tokens)
+        # A single over-budget item still gets its own batch
+        if batch and (cost > token_budget or len(batch) >= max_batch_size):
+            yield batch
+            batch, new_longest = [], length
+        batch.append(item)
+        longest = new_longest
+    if batch:
+        yield batch
+
+
+def with_lengths(items, lengths_fn, window=512):
+    """
+    Yields (length, item) pairs, computing lengths for `window` items at a time
+    (lengths_fn: list of items -> list of lengths), so one bulk cache lookup or one
+    batched tokenizer call covers a whole window instead of one call per item.
+    """
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if len(buffer) >= window:
+            yield from zip(lengths_fn(buffer), buffer)
+            buffer = []
+    if buffer:
+        yield from zip(lengths_fn(buffer), buffer)
+
+
+def bucket_batches(items, length_fn, bucket_width=16, max_batch_size=32, token_budget=None,
+                   reserve_tokens=0, max_buffered=1024):
+    """
+    Groups a stream of items into batches of near-equal length (length buckets).
+
+    Every item goes into the bucket of `bucket_width` tokens its length falls in, so
+    rows of one batch differ by less than bucket_width tokens of padding. A bucket is
+    emitted once it holds max_batch_size items or one more row would break
+        rows * (longest + reserve_tokens) > token_budget.
+    With more than max_buffered items waiting, the fullest bucket goes out early: that
+    bounds memory and how far the output order drifts from the dataset order.
+    Cheap when length_fn reads precomputed lengths (e.g. from a TokenCache).
+    """
+    buckets = defaultdict(list) # bucket -> [(length, item)]
+    buffered = 0
+
+    def emit(bucket):
+        nonlocal buffered
+        batch = buckets.pop(bucket)
+        buffered -= len(batch)
+        return [item for _, item in batch]
+
+    for item in items:
+        length = length_fn(item)
+        bucket = length // bucket_width
+        waiting = buckets[bucket]
+        if waiting and token_budget is not None:
+            longest = max(length, max(l for l, _ in waiting))
+            if (len(waiting) + 1) * (longest + reserve_tokens) > token_budget:
+                yield emit(bucket)
+        buckets[bucket].append((length, item))
+        buffered += 1
+
+        if len(buckets[bucket]) >= max_batch_size:
+            yield emit(bucket)
+        elif buffered > max_buffered:
+            yield emit(max(buckets, key=lambda b: len(buckets[b])))
+
+    for bucket in sorted(buckets):
+        yield emit(bucket)
+
+
+class ThroughputTracker:
+    """Accumulates items/sec per batch size so batch settings can be tuned per machine."""
+
+    def __init__(self):
+        self.stats = defaultdict(lambda: {"batches": 0, "items": 0, "seconds": 0.0})
+
+    def record(self, batch_size, n_items, seconds):
+        entry = self.stats[batch_size]
+        entry["batches"] += 1
+        entry["items"] += n_items
+        entry["seconds"] += seconds
+
+    def timed(self, batch_size):
+        """Context manager: `with tracker.timed(len(batch)) as t: ...; t.items = n_done`."""
+        return _Timed(self, batch_size)
+
+    def report(self):
+        print("\n=== Throughput by batch size ===")
+        for batch_size in sorted(self.stats):
+            entry = self.stats[batch_size]
+            rate = entry["items"] / entry["seconds"] if entry["seconds"] > 0 else 0.0
+            print(f"batch={batch_size:>3}  batches={entry['batches']:>5}  "
+                  f"items={entry['items']:>6}  {rate:.3f} items/sec")
+
+
+class _Timed:
+    def __init__(self, tracker, batch_size):
+        self.tracker = tracker
+        self.batch_size = batch_size
+        self.items = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracker.record(self.batch_size, self.items, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,265 @@
+# File: src/cache.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def hash_key(*parts):
+    """Stable content hash for a tuple of strings (e.g. model name, premise, hypothesis)."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x00") # separator, so ("ab", "c") != ("a", "bc")
+    return h.hexdigest()
+
+
+class LRUCache:
+    """Small in-memory LRU cache. Thread-safe, bounded by number of entries."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache:
+    """
+    Persistent key -> JSON value store backed by a single sqlite file.
+    Survives reruns, so repeated evidence strings are only scored once across runs.
+    WAL mode plus a busy timeout let several worker processes share the file.
+    """
+
+    def __init__(self, path, busy_timeout=60.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys that are present."""
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            # sqlite caps the number of bound parameters, so query in slices
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def set_many(self, items):
+        """Stores a {key: value} dict in one transaction."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in items.items()]
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class KeyedArrayStore:
+    """
+    Append-only on-disk rows of numbers keyed by 64-char content hashes. Backs
+    EmbeddingCache (fixed-width rows) and TokenCache (variable-length rows).
+
+    Layout under `directory`:
+        <data_name>   every row's values, concatenated; read back memory-mapped
+        lengths.i32   one length per row (variable-length stores only)
+        keys.txt      one key per line, line i <-> row i
+
+    Writes go data -> lengths -> keys (each fsynced), so after a crash a row only
+    counts once its key made it to disk; on open, anything past the last complete
+    key is cut off. read_only stores never create, truncate or append.
+    """
+
+    def __init__(self, directory, data_name, dtype, row_width=None, read_only=False):
+        import numpy as np # deferred: src.cache must stay cheap to import
+
+        self.dir = directory
+        self.data_path = os.path.join(directory, data_name)
+        self.keys_path = os.path.join(directory, "keys.txt")
+        self.lengths_path = os.path.join(directory, "lengths.i32") if row_width is None else None
+        self.dtype = np.dtype(dtype)
+        self.row_width = row_width
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._rows = {}       # key -> row
+        self._mmap = None     # memory-mapped view of the data file
+        self.hits = 0
+        self.misses = 0
+
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, "r") as f:
+                for row, line in enumerate(f):
+                    key = line.strip()
+                    if len(key) != 64:
+                        break # partial last line
+                    self._rows.setdefault(key, row)
+
+        # Every complete key line is 64 hex chars + newline
+        self._n = os.path.getsize(self.keys_path) // 65 if os.path.exists(self.keys_path) else 0
+        if self.lengths_path is not None:
+            lengths = np.fromfile(self.lengths_path, dtype=np.int32) if os.path.exists(self.lengths_path) else np.zeros(0, np.int32)
+            self._n = min(self._n, len(lengths)) # keys are written last, so this only trims damage
+            self._lengths = lengths[:self._n]
+            self._offsets = np.concatenate([[0], np.cumsum(self._lengths, dtype=np.int64)])
+
+        self._rows = {key: row for key, row in self._rows.items() if row < self._n}
+
+        # Drop anything past the last complete key (crash between the writes)
+        if read_only:
+            return
+        sizes = [(self.keys_path, self._n * 65), (self.data_path, self._end(self._n) * self.dtype.itemsize)]
+        if self.lengths_path is not None:
+            sizes.append((self.lengths_path, self._n * 4))
+        for path, size in sizes:
+            if os.path.exists(path):
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def _end(self, row):
+        """Number of values stored before `row`."""
+        return int(self._offsets[row]) if self.lengths_path is not None else row * self.row_width
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _view(self):
+        import numpy as np
+
+        n_values = self._end(self._n)
+        if self._mmap is None or len(self._mmap) != n_values:
+            self._mmap = np.memmap(self.data_path, dtype=self.dtype, mode="r", shape=(n_values,)) if n_values else None
+        return self._mmap
+
+    def get_many(self, keys):
+        """Returns {key: row as a 1-D array (a copy, not a view)} for the keys that are stored."""
+        with self._lock:
+            found = {key: self._rows[key] for key in keys if key in self._rows}
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if not found:
+                return {}
+            view = self._view()
+            return {key: view[self._end(row):self._end(row + 1)].copy() for key, row in found.items()}
+
+    def lengths_many(self, keys):
+        """Returns {key: row length} for stored keys, without touching the data."""
+        with self._lock:
+            return {key: self.row_length(self._rows[key]) for key in keys if key in self._rows}
+
+    def row_length(self, row):
+        return int(self._lengths[row]) if self.lengths_path is not None else self.row_width
+
+    def put_many(self, keys, rows):
+        """Appends new (key, row) pairs; keys that are already stored are skipped."""
+        import numpy as np
+
+        if self.read_only:
+            return
+        with self._lock:
+            new_keys, new_rows, seen = [], [], set()
+            for key, row in zip(keys, rows):
+                if key in self._rows or key in seen:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(np.asarray(row, dtype=self.dtype).ravel())
+            if not new_keys:
+                return
+            lengths = np.array([len(row) for row in new_rows], dtype=np.int32)
+            if self.lengths_path is None and (lengths != self.row_width).any():
+                raise ValueError(f"Rows must have {self.row_width} values")
+
+            # Truncating first overwrites whatever a failed earlier append left behind
+            writes = [(self.data_path, self._end(self._n) * self.dtype.itemsize, np.concatenate(new_rows).tobytes())]
+            if self.lengths_path is not None:
+                writes.append((self.lengths_path, self._n * 4, lengths.tobytes()))
+            writes.append((self.keys_path, self._n * 65, "".join(key + "\n" for key in new_keys).encode("ascii")))
+            for path, size, data in writes:
+                with open(path, "ab") as f:
+                    f.truncate(size)
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            for i, key in enumerate(new_keys):
+                self._rows[key] = self._n + i
+            self._n += len(new_keys)
+            if self.lengths_path is not None:
+                self._lengths = np.concatenate([self._lengths, lengths])
+                self._offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum(lengths, dtype=np.int64)])
+
+    def lengths(self, keys=None):
+        """Lengths of all rows, or of the stored `keys`."""
+        with self._lock:
+            if keys is None:
+                return [self.row_length(row) for row in range(self._n)]
+            return [self.row_length(self._rows[key]) for key in keys if key in self._rows]
+
+    def total_values(self):
+        return self._end(self._n)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+if __name__ == "__main__":
+    import tempfile
+
+    # --- Test block: a torn append is cut off on reopen ---
+    with tempfile.TemporaryDirectory() as tmp:
+        store = KeyedArrayStore(tmp, "data.i32", "int32")
+        keys = [hash_key(t) for t in ["a", "b", "c"]]
+        store.put_many(keys[:2], [[1, 2, 3], [4]])
+        with open(store.data_path, "ab") as f:
+            f.write(b"\x00" * 8) # data of a row whose key never made it to disk
+
+        reopened = KeyedArrayStore(tmp, "data.i32", "int32")
+        reopened.put_many(keys[2:], [[7, 8]])
+        found = reopened.get_many(keys)
+        assert [found[key].tolist() for key in keys] == [[1, 2, 3], [4], [7, 8]]
+        assert reopened.lengths_many(keys) == {keys[0]: 3, keys[1]: 1, keys[2]: 2}
+        print(f"Keyed array store OK: {reopened.stats()}")
@@ -1,41 +1,99 @@
 # src/data_loader.py
-from datasets import load_dataset
+import copy
+import os
+from datasets import Dataset, load_dataset
 
 class DataLoader:
-    def __init__(self, dataset_name="nq_open", split="validation"):
+    def __init__(self, dataset_name="nq_open", split="validation", cache_dir=None):
         """
         Loads the Natural Questions (NQ-Open) dataset.
         We use 'validation' split for testing because 'train' is huge.
+
+        If cache_dir is given, the split is stored there as Parquet on the first
+        run and read back from disk (no network) on every later run.
+        """
+        self.num_shards = 1
+        self.shard_index = 0
+
+        parquet_path = None
+        if cache_dir is not None:
+            parquet_path = os.path.join(cache_dir, f"{dataset_name.replace('/', '__')}_{split}.parquet")
+
+        if parquet_path is not None and os.path.exists(parquet_path):
+            print(f"Loading dataset from local cache: {parquet_path}...")
+            # Arrow-backed and memory-mapped: rows are only read when iterated
+            self.data = Dataset.from_parquet(parquet_path)
+        else:
+            print(f"Loading dataset: {dataset_name} ({split})...")
+            # trust_remote_code needed for some HF datasets
+            self.data = load_dataset(dataset_name, split=split, trust_remote_code=True)
+            if parquet_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Written under a per-process name and renamed into place, so another
+                # worker never reads a half-written file
+                tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+                self.data.to_parquet(tmp_path)
+                os.replace(tmp_path, parquet_path)
+                print(f"Cached dataset to {parquet_path}")
+
+    def shard(self, num_shards, index):
+        """
+        Returns a view of this loader that only yields ids with id % num_shards == index.
+        Ids stay global, so results from different shards never collide.
+        """
+        if not 0 <= index < num_shards:
+            raise ValueError(f"Shard index {index} out of range for {num_shards} shards")
+        view = copy.copy(self)
+        view.num_shards = num_shards
+        view.shard_index = index
+        return view
+
+    def iter_items(self, start_index=0, limit=None, batch_size=1000, skip_ids=None):
         """
-        print(f"Loading dataset: {dataset_name} ({split})...")
-        # trust_remote_code needed for some HF datasets
-        self.data = load_dataset(dataset_name, split=split, trust_remote_code=True)
-    
+        Streams items of [start_index, start_index + limit) in Arrow record batches.
+        Only this loader's shard is read, and ids in skip_ids (a set) are skipped
+        without building the item dicts. Memory stays flat however large the range is.
+        """
+        end = len(self.data) if limit is None else min(len(self.data), start_index + limit)
+
+        # First id in range that belongs to this shard, then every num_shards-th id
+        first = start_index + (self.shard_index - start_index) % self.num_shards
+        ids = range(first, end, self.num_shards)
+        if len(ids) == 0:
+            return
+
+        if self.num_shards == 1:
+            subset = self.data.select(range(first, end))
+        else:
+            subset = self.data.select(ids)
+
+        position = 0
+        for columns in subset.iter(batch_size=batch_size):
+            for q, answers in zip(columns['question'], columns['answer']):
+                item_id = ids[position]
+                position += 1
+
+                # Skip if already done
+                if skip_ids is not None and item_id in skip_ids:
+                    continue
+
+                # nq_open structure: {'question': str, 'answer': [str, str...]}
+                # We take the first valid answer as the 'Gold Truth'
+                yield {
+                    "id": item_id,
+                    "question": q,
+                    "gold_answer": answers[0]
+                }
+
     def get_batch(self, start_index=0, limit=100):
         """
         Returns a clean list of items to process.
         """
-        batch = []
-        # We slice the dataset to get the requested range
-        subset = self.data.select(range(start_index, start_index + limit))
-        
-        for i, item in enumerate(subset):
-            # nq_open structure: {'question': str, 'answer': [str, str...]}
-            q = item['question']
-            
-            # We take the first valid answer as the 'Gold Truth'
-            gold_answer = item['answer'][0] 
-            
-            batch.append({
-                "id": start_index + i,
-                "question": q,
-                "gold_answer": gold_answer
-            })
-            
-        return batch
+        return list(self.iter_items(start_index=start_index, limit=limit))
 
 # Test block
 if __name__ == "__main__":
     loader = DataLoader()
     sample = loader.get_batch(limit=3)
-    print("Loaded sample:", sample)
\ No newline at end of file
+    print("Loaded sample:", sample)
+    print("Shard 1/2 sample:", list(loader.shard(2, 1).iter_items(limit=6)))
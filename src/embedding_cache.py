@@ -0,0 +1,81 @@
+# File: src/embedding_cache.py
+import json
+import os
+import numpy as np
+from src.cache import KeyedArrayStore, hash_key
+
+
+def text_hash(text):
+    return hash_key(text)
+
+
+class EmbeddingCache:
+    """
+    Append-only on-disk store of document embeddings, keyed by (encoder model, text hash).
+
+    Layout under cache_dir/<model hash>/:
+        meta.json     model name and embedding dimension
+        vectors.f32   raw float32 rows, appended; read back memory-mapped
+        keys.txt      one text hash per line, line i <-> row i
+
+    Storage and crash recovery are KeyedArrayStore's (src/cache.py); the store is
+    opened once the dimension is known (from meta.json or the first put).
+    """
+
+    def __init__(self, cache_dir="data/embedding_cache", model_name="all-MiniLM-L6-v2"):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, hash_key(model_name)[:16])
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.dim = None
+        self._store = None
+
+        os.makedirs(self.dir, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                self._open(json.load(f)["dim"])
+
+    def _open(self, dim):
+        self.dim = dim
+        self._store = KeyedArrayStore(self.dir, "vectors.f32", np.float32, row_width=dim)
+
+    def __len__(self):
+        return len(self._store) if self._store else 0
+
+    def __contains__(self, key):
+        return self._store is not None and key in self._store
+
+    def get_many(self, keys):
+        """Returns {key: vector} for the keys that are cached."""
+        if self._store is None:
+            return {}
+        return self._store.get_many(keys)
+
+    def put_many(self, keys, vectors):
+        """Appends new (key, vector) rows; keys that are already cached are skipped."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self._store is None:
+            with open(self.meta_path, "w") as f:
+                json.dump({"model_name": self.model_name, "dim": vectors.shape[1]}, f)
+            self._open(vectors.shape[1])
+        self._store.put_many(keys, vectors)
+
+    def stats(self):
+        if self._store is None:
+            return {"entries": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+        return self._store.stats()
+
+if __name__ == "__main__":
+    import tempfile
+
+    # --- Test block ---
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = EmbeddingCache(tmp, "dummy-encoder")
+        keys = [text_hash(t) for t in ["a", "b", "c"]]
+        cache.put_many(keys, np.eye(3, dtype=np.float32))
+        cache.put_many(keys[:1], np.ones((1, 3), dtype=np.float32)) # already cached: ignored
+
+        reopened = EmbeddingCache(tmp, "dummy-encoder")
+        found = reopened.get_many(keys + [text_hash("d")])
+        assert len(reopened) == 3 and set(found) == set(keys)
+        assert np.allclose(found[keys[1]], [0, 1, 0])
+        print(f"Embedding cache OK: {reopened.stats()}")
@@ -1,45 +1,165 @@
 # src/entailment.py
 import torch
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from src.cache import LRUCache, DiskCache, hash_key
+from src.registry import get_model
+from src.precision import PRECISIONS, resolve_precision, prepare_for_inference, inference_context
+from src.instrumentation import Instrumentation
+
+def _load_nli_model(model_name, device, precision="fp32", compile=False):
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification # deferred: slow import
+
+    print(f"Loading NLI Judge: {model_name} on {device} ({precision})...")
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        model_name, torch_dtype=PRECISIONS[precision]
+    ).to(device)
+    model = prepare_for_inference(model, precision, compile)
+    return tokenizer, model
 
 class EntailmentGrader:
-    def __init__(self, model_name="facebook/bart-large-mnli", device=None):
+    def __init__(self, model_name="facebook/bart-large-mnli", device=None,
+                 batch_size=16, max_length=512, cache_size=10000, cache_path=None,
+                 precision="fp32", compile=False, instrumentation=None):
+        """
+        Args:
+            batch_size: (premise, hypothesis) pairs per padded NLI forward pass
+            max_length: pairs longer than this are truncated (longest side first)
+            cache_size: entries kept in the in-memory LRU cache (0 disables it)
+            cache_path: optional sqlite file that persists scores across runs
+            precision: "fp32" (default), "fp16", "bf16" or "int8" (CPU only), see src/precision.py
+            compile: torch.compile the model's forward where available
+            instrumentation: Instrumentation that receives "nli" timings and token counts
+        """
         if device is None:
             self.device = "cuda" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu"
         else:
             self.device = device
-            
-        print(f"Loading NLI Judge: {model_name} on {self.device}...")
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).to(self.device)
-        self.model.eval()
+
+        self.model_name = model_name
+        self.precision = resolve_precision(precision, self.device)
+        self.compile = compile
+        self.instrumentation = instrumentation or Instrumentation()
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache = LRUCache(cache_size)
+        self.disk_cache = DiskCache(cache_path) if cache_path else None
+
+        # Weights load lazily on first use, through the process-wide registry
+        self._bundle = None
+
+    def _load(self):
+        if self._bundle is None:
+            key = ("nli", self.model_name, self.device, self.precision, self.compile)
+            self._bundle = get_model(key, lambda: _load_nli_model(
+                self.model_name, self.device, self.precision, self.compile
+            ))
+        return self._bundle
+
+    @property
+    def tokenizer(self):
+        return self._load()[0]
+
+    @property
+    def model(self):
+        return self._load()[1]
 
     def check_entailment(self, premise, hypothesis):
         """
         Returns probabilities for [Contradiction, Neutral, Entailment]
         """
-        input_text = f"{premise} </s></s> {hypothesis}" # BART uses </s></s> separator
-        inputs = self.tokenizer(input_text, return_tensors="pt").to(self.device)
+        return self.check_entailment_batch([(premise, hypothesis)])[0]
+
+    def check_entailment_batch(self, pairs):
+        """
+        Scores many (premise, hypothesis) pairs. Cached pairs are served from the
+        LRU / disk cache, the rest run in padded, truncated batches.
+        Returns one probability dict per pair, in input order.
+        """
+        # Non-fp32 scores are cached separately, so they never mix with the reference ones
+        tag = self.model_name if self.precision == "fp32" else f"{self.model_name}@{self.precision}"
+        keys = [hash_key(tag, premise, hypothesis) for premise, hypothesis in pairs]
 
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            # BART-Large-MNLI output logits are [Contradiction, Neutral, Entailment]
-            probs = torch.softmax(outputs.logits, dim=1)[0]
+        # 1. Memory cache, then disk cache
+        scores = {}
+        for key in keys:
+            cached = self.cache.get(key)
+            if cached is not None:
+                scores[key] = cached
 
-        # Explicit mapping for facebook/bart-large-mnli
-        return {
-            "contradiction": probs[0].item(),
-            "neutral": probs[1].item(),
-            "entailment": probs[2].item()
-        }
+        missing = [key for key in dict.fromkeys(keys) if key not in scores]
+        if missing and self.disk_cache is not None:
+            from_disk = self.disk_cache.get_many(missing)
+            for key, value in from_disk.items():
+                self.cache.set(key, value)
+            scores.update(from_disk)
+
+        # 2. Run the model on unique pairs that are still missing
+        todo = {}
+        for key, pair in zip(keys, pairs):
+            if key not in scores:
+                todo[key] = pair
+
+        if todo:
+            new_scores = self._score_pairs(list(todo.keys()), list(todo.values()))
+            for key, value in new_scores.items():
+                self.cache.set(key, value)
+            if self.disk_cache is not None:
+                self.disk_cache.set_many(new_scores)
+            scores.update(new_scores)
+
+        return [scores[key] for key in keys]
+
+    def _score_pairs(self, keys, pairs):
+        # Sort by length so each padded batch wastes as little as possible
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i][0]) + len(pairs[i][1]))
+
+        results = {}
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start:start + self.batch_size]
+            # Tokenizer pair encoding inserts BART's </s></s> separator itself
+            inputs = self.tokenizer(
+                [pairs[i][0] for i in chunk],
+                [pairs[i][1] for i in chunk],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt"
+            ).to(self.device)
+
+            with self.instrumentation.timer("nli", items=len(chunk)) as timer, inference_context(self.precision, self.device):
+                outputs = self.model(**inputs)
+                # BART-Large-MNLI output logits are [Contradiction, Neutral, Entailment]
+                probs = torch.softmax(outputs.logits.float(), dim=1).tolist()
+                timer.tokens = int(inputs["attention_mask"].sum())
+
+            # Explicit mapping for facebook/bart-large-mnli
+            for i, row in zip(chunk, probs):
+                results[keys[i]] = {
+                    "contradiction": row[0],
+                    "neutral": row[1],
+                    "entailment": row[2]
+                }
+        return results
 
     def compute_delta_entailment(self, evidence_real, evidence_fake, answer):
         """
         Calculates: Entailment(Real) - Entailment(Fake)
         Positive Score = The answer matches Real evidence better than Fake evidence.
         """
-        scores_real = self.check_entailment(evidence_real, answer)
-        scores_fake = self.check_entailment(evidence_fake, answer)
-        
-        delta = scores_real["entailment"] - scores_fake["entailment"]
-        return delta
\ No newline at end of file
+        return self.compute_delta_entailment_batch([(evidence_real, evidence_fake, answer)])[0]
+
+    def compute_delta_entailment_batch(self, triples):
+        """
+        Batched compute_delta_entailment over (evidence_real, evidence_fake, answer)
+        triples. Both NLI pairs of every triple go through one check_entailment_batch call.
+        """
+        pairs = []
+        for evidence_real, evidence_fake, answer in triples:
+            pairs.append((evidence_real, answer))
+            pairs.append((evidence_fake, answer))
+
+        scores = self.check_entailment_batch(pairs)
+        return [
+            scores[i]["entailment"] - scores[i + 1]["entailment"]
+            for i in range(0, len(scores), 2)
+        ]
@@ -0,0 +1,200 @@
+# File: src/generation_cache.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from src.cache import hash_key
+
+
+class GenerationCache:
+    """
+    Persistent, content-addressed cache for generated answers and answer-span log-probs.
+
+    Keys are hashes of everything that determines the result (model name, dtype,
+    prompt or token ids, generation params), so a rerun that only changes the
+    metric or the analysis never touches the model again.
+
+    Layout under cache_dir:
+        index.sqlite      key -> JSON payload, array file, size, last access
+        arrays/ab/<key>.npy   float16 arrays, opened memory-mapped on read
+
+    The store is bounded by max_bytes: once exceeded, the least recently used
+    entries are evicted until it is back under 90% of the limit.
+
+    Lookups never write: access times are buffered in memory and flushed every
+    `access_flush_every` hits / `access_flush_interval` seconds, before eviction and
+    on close(). The index runs in WAL mode with a busy timeout, so several worker
+    processes can share one cache directory.
+    """
+
+    def __init__(self, cache_dir="data/generation_cache", max_bytes=10 * 1024 ** 3,
+                 access_flush_every=1000, access_flush_interval=30.0, busy_timeout=60.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.access_flush_every = access_flush_every
+        self.access_flush_interval = access_flush_interval
+        self._pending_access = {} # key -> last access time, not yet in the index
+        self._last_access_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(cache_dir, "arrays"), exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), timeout=busy_timeout, check_same_thread=False
+        )
+        # WAL: readers never block the writer (and vice versa) across processes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, payload TEXT, array_file TEXT,"
+            " nbytes INTEGER, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS by_access ON entries (last_access)")
+        self._conn.commit()
+        # Running total, so a put doesn't have to SUM over the whole index
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts):
+        return hash_key(*parts)
+
+    def get(self, key):
+        """
+        Returns (payload, array) or None. payload is the stored JSON value (or None),
+        array is a read-only memory-mapped float16 np.ndarray (or None).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, array_file FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._pending_access[key] = time.time()
+            if (len(self._pending_access) >= self.access_flush_every
+                    or time.monotonic() - self._last_access_flush >= self.access_flush_interval):
+                self._flush_access()
+
+        payload, array_file = row
+        array = None
+        if array_file is not None:
+            path = os.path.join(self.cache_dir, array_file)
+            if not os.path.exists(path):
+                # Array was removed behind our back: treat as a miss
+                self.delete(key)
+                with self._lock:
+                    self.misses += 1
+                return None
+            array = np.load(path, mmap_mode="r")
+
+        with self._lock:
+            self.hits += 1
+        return (json.loads(payload) if payload is not None else None), array
+
+    def put(self, key, payload=None, array=None):
+        """Stores a JSON-serializable payload and/or an array (saved as float16)."""
+        array_file, nbytes = None, 0
+        if array is not None:
+            array = np.asarray(array, dtype=np.float16)
+            array_file = os.path.join("arrays", key[:2], f"{key}.npy")
+            path = os.path.join(self.cache_dir, array_file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so a crash never leaves a truncated array behind
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+            nbytes = array.nbytes
+
+        encoded = json.dumps(payload) if payload is not None else None
+        nbytes += len(encoded) if encoded else 0
+
+        with self._lock:
+            old = self._conn.execute("SELECT nbytes FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, payload, array_file, nbytes, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, array_file, nbytes, time.time())
+            )
+            self._conn.commit()
+            self._total_bytes += nbytes - (old[0] if old else 0)
+        self._evict_if_needed()
+
+    def _flush_access(self):
+        """Writes the buffered access times in one transaction (caller holds the lock)."""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE entries SET last_access = ? WHERE key = ?",
+                [(t, key) for key, t in self._pending_access.items()]
+            )
+            self._conn.commit()
+            self._pending_access = {}
+        self._last_access_flush = time.monotonic()
+
+    def delete(self, key):
+        with self._lock:
+            self._pending_access.pop(key, None)
+            row = self._conn.execute("SELECT array_file, nbytes FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._conn.commit()
+            if row:
+                self._total_bytes -= row[1]
+        if row and row[0]:
+            try:
+                os.remove(os.path.join(self.cache_dir, row[0]))
+            except FileNotFoundError:
+                pass
+
+    def total_bytes(self):
+        """Bytes this process knows about (other processes' puts show up after the next eviction pass)."""
+        return self._total_bytes
+
+    def _evict_if_needed(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * 0.9)
+        with self._lock:
+            # LRU order must include the hits since the last flush
+            self._flush_access()
+            rows = self._conn.execute(
+                "SELECT key, array_file, nbytes FROM entries ORDER BY last_access ASC"
+            ).fetchall()
+            # Resync: worker processes sharing the directory add entries too
+            total = sum(nbytes for _, _, nbytes in rows)
+
+            evicted = []
+            for key, array_file, nbytes in rows:
+                if total <= target:
+                    break
+                evicted.append((key, array_file))
+                total -= nbytes
+
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+            self._conn.commit()
+            self._total_bytes = total
+        for _, array_file in evicted:
+            if array_file:
+                try:
+                    os.remove(os.path.join(self.cache_dir, array_file))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self.total_bytes()
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_access()
+            self._conn.close()
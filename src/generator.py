@@ -1,7 +1,59 @@
 # File: src/generator.py
+import copy
 import torch
 import torch.nn.functional as F
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from src.registry import get_model
+from src.cache import hash_key
+from src.precision import PRECISIONS, resolve_precision, prepare_for_inference, inference_context
+from src.instrumentation import Instrumentation
+
+# One explicit template shared by generation and generation-time scoring,
+# so the answer logits come from exactly the prompt the model answered.
+QA_PROMPT_TEMPLATE = "Context: {context}\nQuestion: {question}\nAnswer: "
+
+def find_stop(text, stop_strings):
+    """
+    Returns the character index where the answer should be cut, or -1.
+    Leading whitespace is ignored so a prompt-closing newline doesn't end the answer early.
+    """
+    offset = len(text) - len(text.lstrip())
+    hits = [text.find(stop, offset) for stop in stop_strings]
+    hits = [h for h in hits if h != -1]
+    return min(hits) if hits else -1
+
+_stop_on_strings_class = None
+
+def make_stop_on_strings(tokenizer, prompt_len, stop_strings, trigger_ids=None):
+    """A StopOnStrings criteria; the class is built on first use so importing this module skips transformers."""
+    global _stop_on_strings_class
+    if _stop_on_strings_class is None:
+        from transformers import StoppingCriteria
+
+        class StopOnStrings(StoppingCriteria):
+            """
+            Stops each row once its continuation contains a stop string.
+            Returns one flag per row, so finished rows in a batch are marked done individually.
+            """
+            def __init__(self, tokenizer, prompt_len, stop_strings, trigger_ids=None):
+                self.tokenizer = tokenizer
+                self.prompt_len = prompt_len
+                self.stop_strings = list(stop_strings)
+                # Optional fast path: only decode when the last token can possibly complete a stop
+                self.trigger_ids = trigger_ids
+
+            def __call__(self, input_ids, scores, **kwargs):
+                done = []
+                for row in input_ids:
+                    new_ids = row[self.prompt_len:]
+                    if self.trigger_ids is not None and new_ids[-1].item() not in self.trigger_ids:
+                        done.append(False)
+                        continue
+                    text = self.tokenizer.decode(new_ids, skip_special_tokens=True)
+                    done.append(find_stop(text, self.stop_strings) != -1)
+                return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+        _stop_on_strings_class = StopOnStrings
+    return _stop_on_strings_class(tokenizer, prompt_len, stop_strings, trigger_ids)
 
 def get_best_device():
     """
@@ -15,73 +67,599 @@ def get_best_device():
     else:
         return "cpu"
 
+def _load_tokenizer(model_name):
+    from transformers import AutoTokenizer # deferred: transformers takes seconds to import
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    # Padded batches need a pad token; GPT-2 style tokenizers ship without one
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def load_tokenizer(model_name):
+    """The generator's tokenizer on its own (no weights), shared through the registry."""
+    return get_model(("tokenizer", model_name), lambda: _load_tokenizer(model_name))
+
+def _load_causal_lm(model_name, device, dtype, precision=None, compile=False):
+    from transformers import AutoModelForCausalLM
+
+    print(f"Loading Generator: {model_name} on {device} ({precision or dtype})...")
+    tokenizer = load_tokenizer(model_name)
+
+    # Load model with trust_remote_code=True for Phi-3
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=dtype,
+        trust_remote_code=True
+    )
+    model.to(device)
+    model = prepare_for_inference(model, precision, compile)
+    return tokenizer, model
+
 class CausalGenerator:
     # Change default to a better model that runs on Mac
-    def __init__(self, model_name="microsoft/Phi-3-mini-4k-instruct", device=None):
-        
+    def __init__(self, model_name="microsoft/Phi-3-mini-4k-instruct", device=None, prefix_cache=False, cache=None,
+                 precision=None, compile=False, instrumentation=None, token_cache=None):
+        """
+        Args:
+            precision: None (fp16 on GPU/MPS, fp32 on CPU), "fp32", "fp16", "bf16" or "int8"
+                       (see src/precision.py; check drift with precision_check.py before trusting it)
+            compile: torch.compile the model's forward where available
+            instrumentation: Instrumentation that receives "generate" / "get_logits"
+                             timings and token counts (cache hits are not counted)
+            token_cache: optional TokenCache for this model's tokenizer (see src/token_cache.py);
+                         QA prompts are looked up there before running the tokenizer
+        """
         if device is None:
             self.device = get_best_device()
         else:
             self.device = device
-            
-        print(f"Loading Generator: {model_name} on {self.device}...")
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        
-        # Load model with trust_remote_code=True for Phi-3
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name, 
-            torch_dtype=torch.float16 if self.device != "cpu" else torch.float32,
-            trust_remote_code=True 
-        )
-        self.model.to(self.device)
-        self.model.eval()
-
-    def generate(self, prompt, max_new_tokens=100):
+
+        self.model_name = model_name
+        self.precision = resolve_precision(precision, self.device)
+        self.dtype = PRECISIONS[self.precision]
+        self.compile = compile
+        self.instrumentation = instrumentation or Instrumentation()
+
+        # When True, get_logits_pair runs the shared E/E' prefix once and reuses its KV cache
+        self.prefix_cache = prefix_cache
+        self._num_params = None
+
+        # Optional GenerationCache: answers and answer log-probs are looked up before running the model
+        self.cache = cache
+
+        if token_cache is not None and token_cache.tokenizer_name != model_name:
+            raise ValueError(f"Token cache is for '{token_cache.tokenizer_name}', not '{model_name}'")
+        self.token_cache = token_cache
+
+        # Weights load lazily on first use, through the process-wide registry
+        self._bundle = None
+        self._eos_token_ids = None
+        self._newline_ids = None
+
+    def _load(self):
+        if self._bundle is None:
+            key = ("causal_lm", self.model_name, self.device, self.precision, self.compile)
+            self._bundle = get_model(key, lambda: _load_causal_lm(
+                self.model_name, self.device, self.dtype, self.precision, self.compile
+            ))
+        return self._bundle
+
+    def _inference(self):
+        return inference_context(self.precision, self.device)
+
+    @property
+    def tokenizer(self):
+        return self._load()[0]
+
+    @property
+    def model(self):
+        return self._load()[1]
+
+    @property
+    def eos_token_ids(self):
+        # Stop-token ids are resolved once per generator, not per call
+        if self._eos_token_ids is None:
+            self._eos_token_ids = self._collect_eos_ids()
+        return self._eos_token_ids
+
+    def _collect_eos_ids(self):
+        """EOS ids from the tokenizer plus the model's generation config (e.g. Phi-3's <|end|>)."""
+        eos_ids = {self.tokenizer.eos_token_id}
+        config_eos = getattr(self.model.generation_config, "eos_token_id", None)
+        if isinstance(config_eos, int):
+            eos_ids.add(config_eos)
+        elif config_eos:
+            eos_ids.update(config_eos)
+        eos_ids.discard(None)
+        return sorted(eos_ids)
+
+    def newline_token_ids(self):
+        """Ids of every vocab token whose text contains a newline (scanned once, then cached)."""
+        if self._newline_ids is None:
+            self._newline_ids = {
+                token_id for token_id in range(len(self.tokenizer))
+                if "\n" in self.tokenizer.decode([token_id])
+            }
+        return self._newline_ids
+
+    def _generation_kwargs(self, prompt_len, max_new_tokens, stop_at_newline, stop_strings):
+        """
+        Stopping setup shared by all generate paths:
+        EOS always stops, max_new_tokens is the token budget, and newline /
+        custom stop strings are checked on the decoded continuation.
+        """
+        kwargs = {
+            "max_new_tokens": max_new_tokens,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.eos_token_ids
+        }
+        stops = self._stop_list(stop_at_newline, stop_strings)
+        if stops:
+            # With newline as the only stop we can skip decoding unless a newline token just appeared
+            trigger_ids = self.newline_token_ids() if stops == ["\n"] else None
+            from transformers import StoppingCriteriaList # already loaded with the model
+            kwargs["stopping_criteria"] = StoppingCriteriaList([
+                make_stop_on_strings(self.tokenizer, prompt_len, stops, trigger_ids)
+            ])
+        return kwargs
+
+    def _stop_list(self, stop_at_newline, stop_strings):
+        stops = list(stop_strings or [])
+        if stop_at_newline and "\n" not in stops:
+            stops.append("\n")
+        return stops
+
+    def _trim_answer_ids(self, new_ids, stop_at_newline=False, stop_strings=None):
+        """
+        Cuts generated ids at EOS/padding and at the first stop string.
+        The token that completes a stop string is dropped, so the decoded ids
+        and the returned answer text always agree.
+        """
+        answer_ids = []
+        for token_id in new_ids:
+            if token_id in self.eos_token_ids or token_id == self.tokenizer.pad_token_id:
+                break
+            answer_ids.append(token_id)
+
+        stops = self._stop_list(stop_at_newline, stop_strings)
+        if stops and find_stop(self.tokenizer.decode(answer_ids, skip_special_tokens=True), stops) != -1:
+            for k in range(1, len(answer_ids) + 1):
+                if find_stop(self.tokenizer.decode(answer_ids[:k], skip_special_tokens=True), stops) != -1:
+                    answer_ids = answer_ids[:k - 1]
+                    break
+        return answer_ids
+
+    def _cache_key(self, kind, *parts):
+        """Content address of a result: everything that can change it goes into the hash."""
+        # int8 shares fp32's dtype, so it gets its own tag
+        dtype_tag = "qint8" if self.precision == "int8" else str(self.dtype)
+        return hash_key(kind, self.model_name, dtype_tag, *parts)
+
+    def _logits_to_cache(self, logits):
+        # Stored as float16 log-probs: softmax is shift-invariant, so they work as logits downstream
+        return torch.log_softmax(logits[0].float(), dim=-1).cpu().numpy()
+
+    def _logits_from_cache(self, array):
+        return torch.tensor(array.astype("float32")).unsqueeze(0).to(self.device, self.dtype)
+
+    def generate(self, prompt, max_new_tokens=100, stop_at_newline=False, stop_strings=None, temperature=0.0):
+        """
+        Returns ONLY the newly generated text (the prompt is not echoed back).
+
+        Args:
+            max_new_tokens: token budget for the answer
+            stop_at_newline: stop at the first newline after the answer starts
+            stop_strings: extra strings that end the answer (EOS always does)
+            temperature: 0 = greedy; above 0 samples (and bypasses the cache)
+        """
+        key = None
+        sampling = {"do_sample": True, "temperature": temperature} if temperature > 0 else {"do_sample": False}
+        if self.cache is not None and temperature <= 0:
+            key = self._cache_key("generate", prompt, max_new_tokens, stop_at_newline, stop_strings)
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit[0]["answer"]
+
         # Ensure inputs are on the same device as the model
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        prompt_len = inputs.input_ids.shape[1]
         
-        with torch.no_grad():
+        with self.instrumentation.timer("generate", items=1) as timer, self._inference():
             outputs = self.model.generate(
                 **inputs, 
-                max_new_tokens=max_new_tokens,
-                pad_token_id=self.tokenizer.eos_token_id
+                **self._generation_kwargs(prompt_len, max_new_tokens, stop_at_newline, stop_strings),
+                **sampling
             )
-        return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            timer.tokens = outputs.shape[1]
 
+        answer_ids = self._trim_answer_ids(outputs[0, prompt_len:].tolist(), stop_at_newline, stop_strings)
+        answer = self.tokenizer.decode(answer_ids, skip_special_tokens=True).strip()
 
-    def get_logits(self, context, answer):
+        if key is not None:
+            self.cache.put(key, {"answer": answer})
+        return answer
+
+    def build_prompt(self, context, question):
+        """Formats the shared generation/scoring template."""
+        return QA_PROMPT_TEMPLATE.format(context=context, question=question)
+
+    def tokenize_prompts(self, prompts):
         """
-        Computes logits specifically for the ANSWER tokens, masking out the context.
-        This ensures that even if Context A is longer than Context B,
-        we only compare the distributions for the Answer tokens.
+        Token ids of many prompts: served from the token cache where possible, the
+        rest in ONE batched tokenizer call (and added to the cache).
+        """
+        if not prompts:
+            return []
+        if self.token_cache is None:
+            return self.tokenizer(list(prompts)).input_ids
+
+        keys = [hash_key(prompt) for prompt in prompts]
+        found = self.token_cache.get_many(keys)
+        todo = {key: prompt for key, prompt in zip(keys, prompts) if key not in found}
+        if todo:
+            fresh = self.tokenizer(list(todo.values())).input_ids
+            self.token_cache.put_many(list(todo), fresh)
+            found.update(zip(todo, fresh))
+        return [found[key] for key in keys]
+
+    def prompt_lengths(self, prompts):
+        """
+        Token counts of many prompts: cached lengths are read without loading the ids,
+        the rest are tokenized in ONE batched call (and added to the cache).
+        """
+        if not prompts:
+            return []
+        if self.token_cache is None:
+            return [len(ids) for ids in self.tokenizer(list(prompts)).input_ids]
+
+        keys = [hash_key(prompt) for prompt in prompts]
+        found = self.token_cache.lengths_many(keys)
+        todo = {key: prompt for key, prompt in zip(keys, prompts) if key not in found}
+        if todo:
+            fresh = self.tokenizer(list(todo.values())).input_ids
+            self.token_cache.put_many(list(todo), fresh)
+            found.update((key, len(ids)) for key, ids in zip(todo, fresh))
+        return [found[key] for key in keys]
+
+    def generate_and_score(self, context, question, max_new_tokens=100, stop_at_newline=False, stop_strings=None):
+        """
+        Generates an answer from the QA template AND returns the answer-token
+        logits conditioned on the context, taken straight from model.generate.
+        This makes logits_E free: only the counterfactual branch needs a new pass.
+
+        Returns a dict:
+            answer:     decoded answer text (continuation only)
+            answer_ids: generated answer token ids (cut at EOS / stop strings)
+            logits:     [1, len(answer_ids), vocab] answer logits under `context`
+        """
+        return self.generate_and_score_batch(
+            [context], [question], max_new_tokens, stop_at_newline, stop_strings
+        )[0]
+
+    def generate_and_score_batch(self, contexts, questions, max_new_tokens=100, stop_at_newline=False, stop_strings=None):
+        """
+        Batched generate_and_score: all prompts run as one LEFT-padded generate call.
+        Rows that hit a stop are marked finished individually (they only receive
+        padding afterwards) and the call ends as soon as every row is done.
+        Returns one generate_and_score() dict per prompt.
+        """
+        prompts = [self.build_prompt(c, q) for c, q in zip(contexts, questions)]
+        if self.cache is None:
+            return self._generate_and_score_prompts(prompts, max_new_tokens, stop_at_newline, stop_strings)
+
+        # Serve cached rows, generate only the misses (as one batch)
+        keys = [
+            self._cache_key("generate_and_score", prompt, max_new_tokens, stop_at_newline, stop_strings)
+            for prompt in prompts
+        ]
+        results = [None] * len(prompts)
+        for row, key in enumerate(keys):
+            hit = self.cache.get(key)
+            if hit is not None:
+                payload, array = hit
+                results[row] = dict(payload, logits=self._logits_from_cache(array))
+
+        missing = [row for row, result in enumerate(results) if result is None]
+        if missing:
+            fresh = self._generate_and_score_prompts(
+                [prompts[row] for row in missing], max_new_tokens, stop_at_newline, stop_strings
+            )
+            for row, result in zip(missing, fresh):
+                self.cache.put(
+                    keys[row],
+                    {"answer": result["answer"], "answer_ids": result["answer_ids"]},
+                    self._logits_to_cache(result["logits"])
+                )
+                results[row] = result
+        return results
+
+    def _generate_and_score_prompts(self, prompts, max_new_tokens, stop_at_newline, stop_strings):
+
+        # Decoder-only models must be left-padded so every row continues from its last real token
+        sequences = self.tokenize_prompts(prompts)
+        prompt_len = max(len(ids) for ids in sequences)
+        input_ids = torch.full((len(sequences), prompt_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), prompt_len), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            input_ids[row, prompt_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, prompt_len - len(ids):] = 1
+        inputs = {"input_ids": input_ids.to(self.device), "attention_mask": attention_mask.to(self.device)}
+
+        # Greedy decoding, so the raw step logits equal a teacher-forced pass
+        with self.instrumentation.timer("generate", items=len(prompts)) as timer, self._inference():
+            outputs = self.model.generate(
+                **inputs,
+                **self._generation_kwargs(prompt_len, max_new_tokens, stop_at_newline, stop_strings),
+                do_sample=False,
+                return_dict_in_generate=True,
+                output_logits=True
+            )
+            # Real prompt tokens plus every decode step of every row
+            timer.tokens = int(attention_mask.sum()) + (outputs.sequences.shape[1] - prompt_len) * len(prompts)
+
+        # outputs.logits is a tuple with one [batch, vocab] tensor per generated step
+        step_logits = torch.stack(outputs.logits, dim=1)
+
+        results = []
+        for row in range(len(prompts)):
+            # Continuation only, cut at EOS / stop strings
+            answer_ids = self._trim_answer_ids(
+                outputs.sequences[row, prompt_len:].tolist(), stop_at_newline, stop_strings
+            )
+            results.append({
+                "answer": self.tokenizer.decode(answer_ids, skip_special_tokens=True).strip(),
+                "answer_ids": answer_ids,
+                "logits": step_logits[row:row + 1, :len(answer_ids), :]
+            })
+        return results
+
+    def get_answer_logits(self, context, question, answer_ids):
+        """
+        Teacher-forced scoring of already-generated answer tokens under the
+        QA template. Use it for E' after generate_and_score() on E.
+        """
+        return self.get_answer_logits_batch([context], [question], [answer_ids])[0]
+
+    def get_answer_logits_batch(self, contexts, questions, answer_ids_list):
+        """Batched get_answer_logits: one right-padded forward pass for all rows."""
+        prompt_ids_list = self.tokenize_prompts([self.build_prompt(c, q) for c, q in zip(contexts, questions)])
+        sequences, starts = [], []
+        for prompt_ids, answer_ids in zip(prompt_ids_list, answer_ids_list):
+            sequences.append(prompt_ids + list(answer_ids))
+            starts.append(len(prompt_ids) - 1)
+        return self._forward_answer_logits(sequences, starts)
+
+    def _answer_span_inputs(self, context, answer):
+        """
+        Tokenizes one (context, answer) pair for scoring.
+        Returns the full token ids and the index of the first logit that predicts the answer.
         """
-        # 1. Tokenize the Prompt (Context + Question part)
         # We need to know where the prompt ends and the answer begins.
         prompt_text = f"{context}\nAnswer: "
-        prompt_inputs = self.tokenizer(prompt_text, return_tensors="pt").to(self.device)
-        prompt_len = prompt_inputs.input_ids.shape[1]
+        prompt_len = len(self.tokenizer(prompt_text).input_ids)
 
-        # 2. Tokenize the Full Sequence (Prompt + Answer)
         full_text = f"{context}\nAnswer: {answer}"
-        full_inputs = self.tokenizer(full_text, return_tensors="pt").to(self.device)
-        
-        # 3. Run the model
-        with torch.no_grad():
-            outputs = self.model(**full_inputs)
-        
-        # 4. Smart Slicing
+        full_ids = self.tokenizer(full_text).input_ids
+
         # The model predicts token[i+1] based on logits[i].
-        # We want the predictions for the Answer tokens.
         # The first token of the answer is predicted by the last token of the prompt.
-        # So we slice from (prompt_len - 1) to the end.
-        
-        # Calculate how many tokens are in the answer part
-        seq_len = full_inputs.input_ids.shape[1]
-        
-        # Slice: Start at last prompt token -> End at last answer token
-        start_idx = prompt_len - 1
-        end_idx = seq_len - 1
-        
-        answer_logits = outputs.logits[:, start_idx:end_idx, :]
-        
-        return answer_logits
\ No newline at end of file
+        return full_ids, prompt_len - 1
+
+    def _answer_logits_key(self, ids, start):
+        # Keyed by the exact token ids, so every scoring path shares the same entries
+        return self._cache_key("answer_logits", ",".join(map(str, ids)), start)
+
+    def _forward_answer_logits(self, sequences, starts):
+        """
+        Answer logits for each (token ids, answer start) row. Rows found in the
+        cache are loaded, the rest run as ONE padded forward pass.
+        """
+        if self.cache is None:
+            return self._run_answer_logits(sequences, starts)
+
+        keys = [self._answer_logits_key(ids, start) for ids, start in zip(sequences, starts)]
+        results = [None] * len(sequences)
+        for row, key in enumerate(keys):
+            hit = self.cache.get(key)
+            if hit is not None:
+                results[row] = self._logits_from_cache(hit[1])
+
+        missing = [row for row, result in enumerate(results) if result is None]
+        if missing:
+            fresh = self._run_answer_logits([sequences[row] for row in missing], [starts[row] for row in missing])
+            for row, logits in zip(missing, fresh):
+                self.cache.put(keys[row], array=self._logits_to_cache(logits))
+                results[row] = logits
+        return results
+
+    def _run_answer_logits(self, sequences, starts):
+        """
+        Runs all sequences as ONE right-padded batch and slices out each row's answer logits.
+        Right padding keeps every real token at its original position, so the
+        per-row logits match an unpadded batch-of-one pass.
+        """
+        pad_id = self.tokenizer.pad_token_id
+        max_len = max(len(ids) for ids in sequences)
+
+        input_ids = torch.full((len(sequences), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for row, ids in enumerate(sequences):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+
+        with self.instrumentation.timer("get_logits", items=len(sequences)) as timer, self._inference():
+            outputs = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device)
+            )
+            timer.tokens = int(attention_mask.sum())
+
+        # Slice: Start at last prompt token -> End at last answer token (padding excluded)
+        return [
+            outputs.logits[row:row + 1, start:len(ids) - 1, :]
+            for row, (ids, start) in enumerate(zip(sequences, starts))
+        ]
+
+    def get_logits(self, context, answer):
+        """
+        Computes logits specifically for the ANSWER tokens, masking out the context.
+        This ensures that even if Context A is longer than Context B,
+        we only compare the distributions for the Answer tokens.
+        """
+        full_ids, start_idx = self._answer_span_inputs(context, answer)
+        return self._forward_answer_logits([full_ids], [start_idx])[0]
+
+    def get_logits_rows(self, pairs):
+        """get_logits for a list of (context, answer) pairs, as one padded forward pass."""
+        inputs = [self._answer_span_inputs(context, answer) for context, answer in pairs]
+        return self._forward_answer_logits([ids for ids, _ in inputs], [start for _, start in inputs])
+
+    def get_logits_pair(self, context, counterfactual_context, answer, use_prefix_cache=None, return_stats=False):
+        """
+        Scores the same answer under E and E' in a single forward pass.
+        Returns (logits_E, logits_E_prime), each shaped like get_logits() output.
+
+        With use_prefix_cache=True (defaults to self.prefix_cache) the shared token
+        prefix of E and E' is run once and its KV cache is forked for both suffixes.
+        With return_stats=True a dict with the prefix savings is returned as well.
+        """
+        if use_prefix_cache is None:
+            use_prefix_cache = self.prefix_cache
+
+        if use_prefix_cache:
+            logits_pair, stats = self._get_logits_pair_prefix_cached(context, counterfactual_context, answer)
+        else:
+            logits_pair = self.get_logits_batch([(context, counterfactual_context, answer)])[0]
+            stats = self._prefix_stats(0, logits_pair)
+
+        if return_stats:
+            return logits_pair, stats
+        return logits_pair
+
+    def _get_logits_pair_prefix_cached(self, context, counterfactual_context, answer):
+        """
+        Runs the longest common token prefix of E and E' once, then scores
+        both suffixes on top of a copy of its past_key_values.
+        """
+        ids_E, start_E = self._answer_span_inputs(context, answer)
+        ids_E_prime, start_E_prime = self._answer_span_inputs(counterfactual_context, answer)
+
+        # 1. Longest common token prefix of the two full sequences
+        prefix_len = 0
+        for a, b in zip(ids_E, ids_E_prime):
+            if a != b:
+                break
+            prefix_len += 1
+
+        # Every answer logit must come out of a suffix pass, so the prefix has to
+        # stop at (or before) the last prompt token of the shorter prompt
+        prefix_len = min(prefix_len, start_E, start_E_prime)
+
+        keys = None
+        if self.cache is not None:
+            keys = [self._answer_logits_key(ids_E, start_E), self._answer_logits_key(ids_E_prime, start_E_prime)]
+            hits = [self.cache.get(key) for key in keys]
+            if all(hit is not None for hit in hits):
+                logits_pair = tuple(self._logits_from_cache(hit[1]) for hit in hits)
+                return logits_pair, self._prefix_stats(0, logits_pair)
+
+        if prefix_len == 0:
+            logits_pair = tuple(self._forward_answer_logits([ids_E, ids_E_prime], [start_E, start_E_prime]))
+            return logits_pair, self._prefix_stats(0, logits_pair)
+
+        with self.instrumentation.timer("get_logits", items=2) as timer:
+            # 2. Run the shared prefix once
+            with self._inference():
+                prefix_out = self.model(
+                    input_ids=torch.tensor([ids_E[:prefix_len]], dtype=torch.long, device=self.device),
+                    use_cache=True
+                )
+            past = prefix_out.past_key_values
+
+            # 3. Fork the cache: the model appends to it in place, so only the
+            #    last suffix may consume the original
+            answer_logits = []
+            suffixes = [(ids_E, start_E), (ids_E_prime, start_E_prime)]
+            for i, (ids, start) in enumerate(suffixes):
+                with self._inference():
+                    past_for_suffix = past if i == len(suffixes) - 1 else copy.deepcopy(past)
+                    outputs = self.model(
+                        input_ids=torch.tensor([ids[prefix_len:]], dtype=torch.long, device=self.device),
+                        attention_mask=torch.ones((1, len(ids)), dtype=torch.long, device=self.device),
+                        past_key_values=past_for_suffix,
+                        use_cache=True
+                    )
+                # Suffix logits are offset by prefix_len relative to the full sequence
+                answer_logits.append(outputs.logits[:, start - prefix_len:len(ids) - 1 - prefix_len, :])
+            # Only the tokens actually run: the shared prefix once, then both suffixes
+            timer.tokens = prefix_len + sum(len(ids) - prefix_len for ids, _ in suffixes)
+
+        if keys is not None:
+            for key, logits in zip(keys, answer_logits):
+                self.cache.put(key, array=self._logits_to_cache(logits))
+
+        logits_pair = tuple(answer_logits)
+        return logits_pair, self._prefix_stats(prefix_len, logits_pair)
+
+    def _prefix_stats(self, prefix_len, logits_pair):
+        """
+        Rough forward-pass cost saved by prefix caching.
+        Uses the standard ~2 * n_params FLOPs per token estimate (attention ignored).
+        """
+        if self._num_params is None:
+            self._num_params = sum(p.numel() for p in self.model.parameters())
+
+        return {
+            "prefix_tokens": prefix_len,
+            "tokens_saved": prefix_len,
+            "flops_saved": 2 * self._num_params * prefix_len,
+        }
+
+    def get_logits_batch(self, triples, max_batch_size=16):
+        """
+        Paired scoring for many items at once.
+
+        Args:
+            triples: list of (context, counterfactual_context, answer)
+            max_batch_size: max number of ROWS per forward pass (each triple uses 2 rows)
+
+        Returns a list of (logits_E, logits_E_prime) tuples, one per triple.
+        """
+        sequences, starts = [], []
+        for context, counterfactual_context, answer in triples:
+            for ctx in (context, counterfactual_context):
+                full_ids, start_idx = self._answer_span_inputs(ctx, answer)
+                sequences.append(full_ids)
+                starts.append(start_idx)
+
+        # Keep the two rows of a pair in the same chunk
+        rows_per_chunk = max(2, max_batch_size - max_batch_size % 2)
+        answer_logits = []
+        for i in range(0, len(sequences), rows_per_chunk):
+            answer_logits.extend(
+                self._forward_answer_logits(sequences[i:i + rows_per_chunk], starts[i:i + rows_per_chunk])
+            )
+
+        return [(answer_logits[i], answer_logits[i + 1]) for i in range(0, len(answer_logits), 2)]
+
+
+# Test block: prefix-cached scoring must match the plain padded path
+if __name__ == "__main__":
+    gen = CausalGenerator(model_name="gpt2", device="cpu")
+    question = "where is the eiffel tower"
+    evidence_E = f"The answer to the question '{question}' is Paris."
+    evidence_E_prime = f"The answer to the question '{question}' is London."
+    answer = "The Eiffel Tower is in Paris."
+
+    ref_E, ref_E_prime = gen.get_logits_pair(evidence_E, evidence_E_prime, answer, use_prefix_cache=False)
+    (cached_E, cached_E_prime), stats = gen.get_logits_pair(
+        evidence_E, evidence_E_prime, answer, use_prefix_cache=True, return_stats=True
+    )
+
+    max_diff = max(
+        (ref_E - cached_E).abs().max().item(),
+        (ref_E_prime - cached_E_prime).abs().max().item()
+    )
+    print(f"Max |logit diff| cached vs uncached: {max_diff:.2e}")
+    print(f"Shared prefix: {stats['prefix_tokens']} tokens, ~{stats['flops_saved'] / 1e9:.2f} GFLOPs saved per item")
+    assert max_diff < 1e-3, "Prefix-cached logits drifted from the uncached path!"
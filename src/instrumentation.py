@@ -0,0 +1,283 @@
+# File: src/instrumentation.py
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (None where `resource` is unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss_bytes():
+    """Current resident set size (Linux /proc; falls back to the peak elsewhere)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_bytes()
+
+
+class Instrumentation:
+    """
+    Per-stage timers and counters for the experiment, emitted as structured metrics.
+
+    Stages are timed with `with instr.timer("generate") as t: ...; t.items = n; t.tokens = m`.
+    Wall time is perf_counter, CPU time is the calling thread's (torch's intra-op
+    threads are only in the process-wide `cpu_seconds`).
+
+    Args:
+        output_file: where snapshots go. `*.prom` is rewritten as a Prometheus text file
+                     (node_exporter textfile collector), anything else gets one JSON line
+                     per snapshot. None keeps everything in memory.
+        interval: seconds between snapshots once start() is called
+        labels: extra labels on every metric, e.g. {"shard": "0"}
+        profile_items: profile the first N items that go through profile() (0 = off)
+        profile_every: only every k-th profile() call is sampled
+        profiler: "cprofile" (.pstats files) or "torch" (chrome traces)
+        profile_dir: where the profiles are written
+    """
+
+    def __init__(self, output_file=None, interval=60.0, labels=None, profile_items=0,
+                 profile_every=1, profiler="cprofile", profile_dir="profiles"):
+        self.output_file = output_file
+        self.interval = interval
+        self.labels = labels or {}
+        self.stages = defaultdict(lambda: {"calls": 0, "items": 0, "tokens": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+        self.counters = defaultdict(int)
+        self.errors = defaultdict(int) # (stage, exception type) -> count
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._start_cpu = time.process_time()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.profile_items = profile_items
+        self.profile_every = max(1, profile_every)
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self._profile_calls = 0
+        self._profiling = False
+
+    # --- recording ---
+
+    def timer(self, stage, items=0):
+        return _StageTimer(self, stage, items)
+
+    def record(self, stage, wall_seconds, cpu_seconds=0.0, items=0, tokens=0):
+        with self._lock:
+            entry = self.stages[stage]
+            entry["calls"] += 1
+            entry["items"] += items
+            entry["tokens"] += tokens
+            entry["wall_seconds"] += wall_seconds
+            entry["cpu_seconds"] += cpu_seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def error(self, stage, exc):
+        with self._lock:
+            self.errors[(stage, type(exc).__name__)] += 1
+
+    # --- profiling hook ---
+
+    @contextlib.contextmanager
+    def profile(self, label, n_items=1):
+        """Profiles the wrapped block while the profile_items budget lasts (one block at a time)."""
+        with self._lock:
+            self._profile_calls += 1
+            sampled = (
+                self.profile_items > 0 and not self._profiling
+                and (self._profile_calls - 1) % self.profile_every == 0
+            )
+            if sampled:
+                self.profile_items -= n_items
+                self._profiling = True
+        if not sampled:
+            yield
+            return
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{label}-{os.getpid()}-{self._profile_calls:05d}"
+        try:
+            if self.profiler == "torch":
+                import torch
+                with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True) as prof:
+                    yield
+                prof.export_chrome_trace(os.path.join(self.profile_dir, name + ".json"))
+            else:
+                import cProfile
+                prof = cProfile.Profile()
+                prof.enable()
+                try:
+                    yield
+                finally:
+                    prof.disable()
+                    prof.dump_stats(os.path.join(self.profile_dir, name + ".pstats"))
+        finally:
+            with self._lock:
+                self._profiling = False
+
+    # --- output ---
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for stage, entry in self.stages.items():
+                stages[stage] = dict(entry)
+                if entry["wall_seconds"] > 0:
+                    stages[stage]["items_per_sec"] = entry["items"] / entry["wall_seconds"]
+                    stages[stage]["tokens_per_sec"] = entry["tokens"] / entry["wall_seconds"]
+            return {
+                "time": time.time(),
+                "uptime_seconds": time.time() - self._start_time,
+                "cpu_seconds": time.process_time() - self._start_cpu,
+                "peak_rss_bytes": peak_rss_bytes(),
+                "labels": self.labels,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "errors": [
+                    {"stage": stage, "type": exc_type, "count": count}
+                    for (stage, exc_type), count in self.errors.items()
+                ],
+            }
+
+    def emit(self):
+        """Writes one snapshot to output_file (no-op without one). Returns the snapshot."""
+        snapshot = self.snapshot()
+        if not self.output_file:
+            return snapshot
+        if self.output_file.endswith(".prom"):
+            # Replaced atomically, so a scraper never reads half a file
+            tmp_path = self.output_file + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(to_prometheus(snapshot))
+            os.replace(tmp_path, self.output_file)
+        else:
+            with open(self.output_file, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+        return snapshot
+
+    def start(self):
+        """Emits a snapshot every `interval` seconds from a background thread."""
+        if self._thread is None and self.output_file:
+            self._thread = threading.Thread(target=self._loop, name="instrumentation", daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.emit()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+        return self.emit()
+
+    def report(self):
+        snapshot = self.snapshot()
+        print(f"\n=== Stage metrics ({snapshot['uptime_seconds']:.1f}s wall, {snapshot['cpu_seconds']:.1f}s CPU) ===")
+        for stage, entry in sorted(snapshot["stages"].items()):
+            tokens = f"  {entry.get('tokens_per_sec', 0.0):9.1f} tok/s" if entry["tokens"] else ""
+            print(f"{stage:<12} calls={entry['calls']:>6} items={entry['items']:>7} "
+                  f"wall={entry['wall_seconds']:8.1f}s cpu={entry['cpu_seconds']:8.1f}s{tokens}")
+        for name, value in sorted(snapshot["counters"].items()):
+            print(f"{name:<24} {value}")
+        for error in snapshot["errors"]:
+            print(f"error {error['stage']}/{error['type']}: {error['count']}")
+        if snapshot["peak_rss_bytes"] is not None:
+            print(f"Peak RSS: {snapshot['peak_rss_bytes'] / 1024 ** 2:.0f} MiB")
+
+
+class _StageTimer:
+    def __init__(self, instr, stage, items):
+        self.instr = instr
+        self.stage = stage
+        self.items = items
+        self.tokens = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instr.record(
+            self.stage, time.perf_counter() - self.start, time.thread_time() - self.start_cpu,
+            items=self.items, tokens=self.tokens
+        )
+        return False
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels.keys(), escaped)) + "}"
+
+
+def to_prometheus(snapshot, prefix="causalrag"):
+    """Renders a snapshot in the Prometheus text exposition format."""
+    base = snapshot["labels"]
+    lines = []
+
+    def metric(name, kind, samples, help_text):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{prefix}_{name}{_prom_labels(dict(base, **labels))} {value}")
+
+    stages = snapshot["stages"]
+    for field, kind, help_text in [
+        ("calls", "counter", "Timed calls per stage"),
+        ("items", "counter", "Items processed per stage"),
+        ("tokens", "counter", "Tokens run through the model per stage"),
+        ("wall_seconds", "counter", "Wall-clock seconds spent per stage"),
+        ("cpu_seconds", "counter", "Calling-thread CPU seconds per stage"),
+        ("tokens_per_sec", "gauge", "Average tokens per second per stage"),
+    ]:
+        name = f"stage_{field}" + ("_total" if kind == "counter" else "")
+        metric(name, kind, [({"stage": s}, e[field]) for s, e in stages.items() if field in e], help_text)
+
+    metric("events_total", "counter", [({"name": n}, v) for n, v in snapshot["counters"].items()], "Event counters")
+    metric("errors_total", "counter",
+           [({"stage": e["stage"], "type": e["type"]}, e["count"]) for e in snapshot["errors"]], "Errors by stage and type")
+    metric("uptime_seconds", "gauge", [({}, snapshot["uptime_seconds"])], "Seconds since start")
+    metric("cpu_seconds_total", "counter", [({}, snapshot["cpu_seconds"])], "Process CPU seconds since start")
+    if snapshot["peak_rss_bytes"] is not None:
+        metric("peak_rss_bytes", "gauge", [({}, snapshot["peak_rss_bytes"])], "Peak resident set size")
+    return "\n".join(lines) + "\n"
+
+# Default for callers that don't pass one: it still counts, but never writes anything
+NOOP = Instrumentation()
+
+if __name__ == "__main__":
+    # --- Test block ---
+    instr = Instrumentation(labels={"shard": "0"})
+    with instr.timer("generate", items=4) as t:
+        time.sleep(0.01)
+        t.tokens = 128
+    instr.count("perturb_failed", 2)
+    instr.error("grade", ValueError("boom"))
+    snap = instr.snapshot()
+    assert snap["stages"]["generate"]["tokens"] == 128
+    assert snap["errors"][0]["type"] == "ValueError"
+    print(to_prometheus(snap))
+    instr.report()
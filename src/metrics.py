@@ -1,29 +1,146 @@
+import math
 import torch
-import torch.nn.functional as F
 
 def compute_hsb(logits_original, logits_counterfactual):
     """
     Computes Hallucination Sensitivity Bound (HSB) using KL Divergence.
     Formula: KL( P(y|E) || P(y|E') )
-    
+
+    The KL is summed over the vocabulary AND over the answer tokens (this is what
+    the original reduction='batchmean' did for a batch of one), so scores stay
+    comparable with earlier runs. Equals compute_hsb_batch(...)["per_item"].
+
     Args:
         logits_original: Logits from model run with Evidence E
         logits_counterfactual: Logits from model run with Evidence E'
     """
-    # Convert logits to probabilities (Softmax)
-    probs_p = F.softmax(logits_original, dim=-1)
-    probs_q = F.softmax(logits_counterfactual, dim=-1)
-
-    # Compute KL Divergence
-    # kl_div expects log_probabilities for the input (target distribution)
-    # Note: PyTorch kl_div argument order is (input, target) where input is log-probs
-    log_probs_p = F.log_softmax(logits_original, dim=-1)
-    
-    # We sum over the vocabulary dimension (last dim) and mean over the sequence
-    kl_divergence = F.kl_div(
-        F.log_softmax(logits_counterfactual, dim=-1), # Q (approx)
-        probs_p,                                      # P (true)
-        reduction='batchmean'
-    )
-    
-    return kl_divergence.item()
\ No newline at end of file
+    result = compute_hsb_batch(logits_original, logits_counterfactual)
+    # 'batchmean' divided by the batch size, keep that for batch > 1 inputs
+    return result["per_item"].mean().item()
+
+def pad_answer_logits(logits_list):
+    """
+    Stacks per-item answer logits ([1, T_i, V] each, as returned by the generator)
+    into one right-padded [B, T_max, V] tensor plus a [B, T_max] bool mask.
+    """
+    max_len = max(logits.shape[1] for logits in logits_list)
+    vocab = logits_list[0].shape[-1]
+    ref = logits_list[0]
+
+    padded = torch.zeros((len(logits_list), max_len, vocab), dtype=ref.dtype, device=ref.device)
+    mask = torch.zeros((len(logits_list), max_len), dtype=torch.bool, device=ref.device)
+    for row, logits in enumerate(logits_list):
+        length = logits.shape[1]
+        padded[row, :length] = logits[0]
+        mask[row, :length] = True
+    return padded, mask
+
+def compute_hsb_batch(logits_original, logits_counterfactual, mask=None, mode="kl",
+                      chunk_size=None, top_k=None):
+    """
+    Batched HSB over padded answer logits.
+
+    Args:
+        logits_original:       [B, T, V] logits under E  (P)
+        logits_counterfactual: [B, T, V] logits under E' (Q)
+        mask:      [B, T] bool, True on real answer tokens (None = all tokens)
+        mode:      "kl"        -> KL(P || Q)
+                   "symmetric" -> KL(P || Q) + KL(Q || P)
+                   "js"        -> Jensen-Shannon divergence
+        chunk_size: process the vocab in chunks of this size to bound peak memory
+        top_k:     approximate mode: keep P's top-k tokens and lump the rest of the
+                   vocab into one "other" bucket. By the log-sum inequality this
+                   never overestimates the exact divergence.
+
+    Returns a dict:
+        per_token:     [B, T] divergence per answer token (0 on padding)
+        per_item:      [B] sum over answer tokens (same scale as compute_hsb)
+        per_item_mean: [B] mean over answer tokens
+    """
+    if mode not in ("kl", "symmetric", "js"):
+        raise ValueError(f"Unknown HSB mode: {mode}")
+
+    if mask is None:
+        mask = torch.ones(logits_original.shape[:2], dtype=torch.bool, device=logits_original.device)
+    mask = mask.bool()
+
+    # Only real answer positions are ever materialized: [N, V] with N = mask.sum()
+    p_logits = logits_original[mask]
+    q_logits = logits_counterfactual[mask]
+
+    if top_k is not None and top_k < p_logits.shape[-1]:
+        token_div = _topk_divergence(p_logits, q_logits, mode, top_k, chunk_size)
+    else:
+        token_div = _chunked_divergence(p_logits, q_logits, mode, chunk_size)
+
+    per_token = torch.zeros(mask.shape, dtype=torch.float32, device=mask.device)
+    per_token[mask] = token_div
+
+    lengths = mask.sum(dim=1)
+    per_item = per_token.sum(dim=1)
+    return {
+        "per_token": per_token,
+        "per_item": per_item,
+        "per_item_mean": per_item / lengths.clamp(min=1)
+    }
+
+def _logsumexp(logits, chunk_size):
+    """Log-normalizer of each row, computed chunk by chunk over the vocab."""
+    vocab = logits.shape[-1]
+    chunk_size = chunk_size or vocab
+    parts = [
+        torch.logsumexp(logits[..., i:i + chunk_size].float(), dim=-1)
+        for i in range(0, vocab, chunk_size)
+    ]
+    return torch.logsumexp(torch.stack(parts, dim=-1), dim=-1)
+
+def _weighted_log_ratio(p, log_p, log_x):
+    """p * (log p - log x), with 0 * log(0 / x) := 0 like F.kl_div does for zero targets."""
+    terms = p * (log_p - log_x)
+    return torch.where(p > 0, terms, torch.zeros_like(terms))
+
+def _divergence_terms(log_p, log_q, mode):
+    """Per-row divergence contribution of one slice of the (log-)distributions."""
+    p = log_p.exp()
+    if mode == "kl":
+        terms = _weighted_log_ratio(p, log_p, log_q)
+    elif mode == "symmetric":
+        q = log_q.exp()
+        terms = _weighted_log_ratio(p, log_p, log_q) + _weighted_log_ratio(q, log_q, log_p)
+    else:
+        q = log_q.exp()
+        log_m = torch.logaddexp(log_p, log_q) - math.log(2)
+        terms = 0.5 * (_weighted_log_ratio(p, log_p, log_m) + _weighted_log_ratio(q, log_q, log_m))
+    return terms.sum(dim=-1)
+
+def _chunked_divergence(p_logits, q_logits, mode, chunk_size):
+    """Exact divergence; log-softmax is computed once per side, one vocab chunk at a time."""
+    vocab = p_logits.shape[-1]
+    chunk_size = chunk_size or vocab
+    lse_p = _logsumexp(p_logits, chunk_size).unsqueeze(-1)
+    lse_q = _logsumexp(q_logits, chunk_size).unsqueeze(-1)
+
+    total = torch.zeros(p_logits.shape[0], dtype=torch.float32, device=p_logits.device)
+    for i in range(0, vocab, chunk_size):
+        log_p = p_logits[..., i:i + chunk_size].float() - lse_p
+        log_q = q_logits[..., i:i + chunk_size].float() - lse_q
+        total += _divergence_terms(log_p, log_q, mode)
+    return total
+
+def _topk_divergence(p_logits, q_logits, mode, top_k, chunk_size):
+    """Divergence over P's top-k tokens plus one bucket holding the remaining mass."""
+    lse_p = _logsumexp(p_logits, chunk_size).unsqueeze(-1)
+    lse_q = _logsumexp(q_logits, chunk_size).unsqueeze(-1)
+
+    top_idx = p_logits.topk(top_k, dim=-1).indices
+    log_p_top = p_logits.gather(-1, top_idx).float() - lse_p
+    log_q_top = q_logits.gather(-1, top_idx).float() - lse_q
+
+    # log(1 - sum(top-k probs)), clamped so rounding can't produce log(<=0)
+    eps = torch.finfo(torch.float32).tiny
+    log_p_rest = torch.log((1 - log_p_top.exp().sum(-1, keepdim=True)).clamp(min=eps))
+    log_q_rest = torch.log((1 - log_q_top.exp().sum(-1, keepdim=True)).clamp(min=eps))
+
+    log_p = torch.cat([log_p_top, log_p_rest], dim=-1)
+    log_q = torch.cat([log_q_top, log_q_rest], dim=-1)
+    return _divergence_terms(log_p, log_q, mode)
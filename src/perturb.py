@@ -1,11 +1,39 @@
-import spacy
 import random
+from src.registry import get_model
 
-# Load the NLP model once
-nlp = spacy.load("en_core_web_sm")
+# Only NER is used, so everything else in the pipeline is dead weight
+UNUSED_PIPES = ["parser", "tagger", "attribute_ruler", "lemmatizer"]
+
+def load_ner_pipeline(model_name="en_core_web_sm"):
+    """Loads a spaCy model with every component except NER (and what NER depends on) disabled."""
+    import spacy # deferred: importing spaCy alone costs about a second
+
+    nlp = spacy.load(model_name)
+    for name in UNUSED_PIPES:
+        if name in nlp.pipe_names:
+            nlp.disable_pipe(name)
+
+    # tok2vec is only needed if NER listens to it (it doesn't in en_core_web_sm)
+    if "tok2vec" in nlp.pipe_names and "ner" not in nlp.get_pipe("tok2vec").listening_components:
+        nlp.disable_pipe("tok2vec")
+    return nlp
+
+def get_nlp(model_name="en_core_web_sm"):
+    """The NER pipeline, loaded once per process on first use."""
+    return get_model(("spacy", model_name), lambda: load_ner_pipeline(model_name))
 
 class Perturber:
-    def __init__(self):
+    def __init__(self, seed=None, spacy_model="en_core_web_sm"):
+        """
+        Args:
+            spacy_model: spaCy pipeline used for NER (loaded lazily, shared per process)
+            seed: if set, every text gets its own RNG seeded from (seed, text), so a
+                  counterfactual is reproducible no matter how items are batched or sharded
+        """
+        self.spacy_model = spacy_model
+        self.seed = seed
+        self.rng = random.Random(seed)
+
         # Expanded dictionary of replacements
         self.replacements = {
             "GPE": ["London", "Berlin", "Tokyo", "Moscow", "Sydney", "New York"],
@@ -15,49 +43,114 @@ class Perturber:
             "FAC": ["The Empire State Building", "The Pyramids", "The White House"] # Added support for Facilities
         }
 
+    @property
+    def nlp(self):
+        return get_nlp(self.spacy_model)
+
     def perturb(self, text, strategy="adversarial"):
         """
         Automatically creates a counterfactual version of the text.
         """
-        doc = nlp(text)
-        new_text = text
-        
-        # 1. Filter entities: Only keep ones we actually have replacements for
-        valid_entities = [
-            (ent.text, ent.label_) 
-            for ent in doc.ents 
+        swap = self._swap(self.nlp(text), strategy)
+        if swap["label"] is None:
+            print("WARNING: No swappable entities found in text!")
+        return swap["text"]
+
+    def perturb_many(self, texts, strategy="adversarial", n_process=1, batch_size=256):
+        """
+        Bulk version of perturb(): streams the texts through nlp.pipe.
+        Returns one dict per input text:
+            text:        the counterfactual (== input text if nothing could be swapped)
+            original:    the entity span that was replaced (None on failure)
+            label:       its spaCy entity label (None on failure)
+            replacement: the fake value that was inserted (None on failure)
+            start, end:  character offsets of the replaced span in the input text
+        """
+        docs = self.nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
+        return [self._swap(doc, strategy) for doc in docs]
+
+    def counterfactuals_many(self, texts, k=8, n_process=1, batch_size=256):
+        """
+        Sweep version of perturb_many(): for every text, up to k distinct counterfactuals
+        (every swappable entity x every replacement option for its label).
+        Returns one list of swap dicts (same keys as perturb_many) per text; empty if
+        nothing is swappable. When there are more than k candidates, a seeded sample is kept.
+        """
+        docs = self.nlp.pipe(texts, n_process=n_process, batch_size=batch_size)
+        return [self._enumerate(doc, k) for doc in docs]
+
+    def _valid_entities(self, doc):
+        # Only keep entities we actually have a *different* replacement for
+        return [
+            ent for ent in doc.ents
             if ent.label_ in self.replacements
+            and any(opt != ent.text for opt in self.replacements[ent.label_])
         ]
-        
+
+    def _enumerate(self, doc, k):
+        text = doc.text
+        swaps, seen = [], set()
+        for ent in self._valid_entities(doc):
+            for fake_value in self.replacements[ent.label_]:
+                if fake_value == ent.text:
+                    continue
+                new_text = text[:ent.start_char] + fake_value + text[ent.end_char:]
+                if new_text in seen:
+                    continue # the same entity text can occur twice with the same swap result
+                seen.add(new_text)
+                swaps.append({
+                    "text": new_text,
+                    "original": ent.text,
+                    "label": ent.label_,
+                    "replacement": fake_value,
+                    "start": ent.start_char,
+                    "end": ent.end_char
+                })
+        if len(swaps) > k:
+            rng = self._rng_for(text)
+            keep = sorted(rng.sample(range(len(swaps)), k))
+            swaps = [swaps[i] for i in keep]
+        return swaps
+
+    def _rng_for(self, text):
+        if self.seed is None:
+            return self.rng
+        return random.Random(f"{self.seed}:{text}")
+
+    def _swap(self, doc, strategy):
+        text = doc.text
+        swap = {"text": text, "original": None, "label": None, "replacement": None, "start": None, "end": None}
+
+        # 1. Filter entities: Only keep ones we actually have a *different* replacement for
+        valid_entities = self._valid_entities(doc)
+
         # Debug print to see what spaCy found
         # print(f"DEBUG: Found valid entities: {valid_entities}")
-        
-        if not valid_entities:
-            print("WARNING: No swappable entities found in text!")
-            return text 
-
-        # 2. Adversarial: Swap a named entity with a fake one
-        if strategy == "adversarial":
-            # Retry loop to ensure we don't accidentally pick the exact same word
-            for _ in range(5): 
-                target_text, label = random.choice(valid_entities)
-                
-                # Get options for this label
-                options = [opt for opt in self.replacements[label] if opt != target_text]
-                
-                if options:
-                    fake_value = random.choice(options)
-                    new_text = new_text.replace(target_text, fake_value)
-                    
-                    # If the text actually changed, we are done
-                    if new_text != text:
-                        return new_text
-                    
-        return new_text
+
+        if not valid_entities or strategy != "adversarial":
+            return swap
+
+        # 2. Adversarial: Swap ONE named entity occurrence with a fake one, by character offsets
+        rng = self._rng_for(text)
+        ent = rng.choice(valid_entities)
+        options = [opt for opt in self.replacements[ent.label_] if opt != ent.text]
+        fake_value = rng.choice(options)
+
+        swap.update({
+            "text": text[:ent.start_char] + fake_value + text[ent.end_char:],
+            "original": ent.text,
+            "label": ent.label_,
+            "replacement": fake_value,
+            "start": ent.start_char,
+            "end": ent.end_char
+        })
+        return swap
 
 # Quick test block
 if __name__ == "__main__":
-    p = Perturber()
+    p = Perturber(seed=0)
     original = "The Eiffel Tower is located in Paris, France."
     print(f"Original: {original}")
-    print(f"Attack:   {p.perturb(original)}")
\ No newline at end of file
+    print(f"Attack:   {p.perturb(original)}")
+    print(f"Bulk:     {p.perturb_many([original, 'Nothing to swap here.'])}")
+    print(f"Sweep:    {[swap['text'] for swap in p.counterfactuals_many([original], k=4)[0]]}")
@@ -0,0 +1,208 @@
+# File: src/pipeline.py
+import queue
+import threading
+import time
+
+# End-of-stream marker passed down the queues
+_STOP = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    Args:
+        name: label used in the stats report
+        fn: list of items -> list of outputs (may return fewer items, e.g. to filter)
+        batch_size: max items per fn call (micro-batch)
+        max_wait: seconds to wait for a micro-batch to fill before running it anyway
+        workers: number of threads running this stage
+        queue_size: capacity of this stage's input queue (backpressure bound)
+    """
+
+    def __init__(self, name, fn, batch_size=1, max_wait=0.05, workers=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class StageStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items_in = 0
+        self.items_out = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.depth_sum = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+
+    def sample_depth(self, depth):
+        with self.lock:
+            self.depth_sum += depth
+            self.depth_samples += 1
+            self.depth_max = max(self.depth_max, depth)
+
+
+class Pipeline:
+    """
+    Runs Stages connected by bounded queues, each stage in its own worker thread(s).
+
+    A full queue blocks the stage in front of it, so a slow stage throttles the
+    producers instead of letting memory grow. Model stages should release the
+    GIL in their heavy ops (torch does), so threads are enough to overlap them
+    with the light Python stages.
+    """
+
+    def __init__(self, stages, queue_size=64):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=stage.queue_size or queue_size) for stage in stages]
+        self.queues.append(queue.Queue(maxsize=queue_size)) # outputs of the last stage
+        self.stats = {stage.name: StageStats() for stage in stages}
+        self._alive = [stage.workers for stage in stages]
+        self._alive_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._start_time = None
+
+    def stop(self):
+        """Stops feeding and makes every worker exit (in-flight items are dropped)."""
+        self._stop.set()
+
+    def run(self, items, report_interval=None):
+        """Feeds `items` into the first stage and yields the last stage's outputs as they arrive."""
+        self._start_time = time.perf_counter()
+        threads = [threading.Thread(target=self._feed, args=(items,), name="feeder", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for w in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(index,), name=f"{stage.name}-{w}", daemon=True
+                ))
+        if report_interval:
+            threads.append(threading.Thread(
+                target=self._monitor, args=(report_interval,), name="monitor", daemon=True
+            ))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                output = self._get(self.queues[-1])
+                if output is _STOP or output is None:
+                    break
+                yield output
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join(timeout=5.0)
+
+    # --- internals ---
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q, timeout=None):
+        """Blocking get that gives up when the pipeline is stopped (returns None)."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not self._stop.is_set():
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.perf_counter())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return None
+
+    def _feed(self, items):
+        for item in items:
+            if not self._put(self.queues[0], item):
+                return
+        self._put(self.queues[0], _STOP)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        stats = self.stats[stage.name]
+        in_q, out_q = self.queues[index], self.queues[index + 1]
+
+        while not self._stop.is_set():
+            stats.sample_depth(in_q.qsize())
+            first = self._get(in_q)
+            if first is None:
+                return
+            if first is _STOP:
+                self._finish(index)
+                return
+
+            # Fill the micro-batch until it is full or max_wait has passed
+            batch, saw_stop = [first], False
+            deadline = time.perf_counter() + stage.max_wait
+            while len(batch) < stage.batch_size:
+                try:
+                    item = self._get(in_q, timeout=deadline - time.perf_counter())
+                except queue.Empty:
+                    break
+                if item is None:
+                    return
+                if item is _STOP:
+                    saw_stop = True
+                    break
+                batch.append(item)
+
+            started = time.perf_counter()
+            try:
+                outputs = stage.fn(batch)
+            except Exception as e:
+                print(f"[pipeline] Stage '{stage.name}' dropped a batch of {len(batch)}: {e}")
+                outputs = []
+                with stats.lock:
+                    stats.errors += 1
+            with stats.lock:
+                stats.busy_seconds += time.perf_counter() - started
+                stats.batches += 1
+                stats.items_in += len(batch)
+                stats.items_out += len(outputs)
+
+            for output in outputs:
+                if not self._put(out_q, output):
+                    return
+
+            if saw_stop:
+                self._finish(index)
+                return
+
+    def _finish(self, index):
+        """Hands the end-of-stream marker to a sibling worker, or downstream from the last one."""
+        with self._alive_lock:
+            self._alive[index] -= 1
+            last = self._alive[index] == 0
+        self._put(self.queues[index + 1] if last else self.queues[index], _STOP)
+
+    def _monitor(self, interval):
+        while not self._stop.wait(interval):
+            self.report()
+
+    def report(self):
+        """Prints per-stage throughput, utilization and input queue depth."""
+        wall = time.perf_counter() - self._start_time if self._start_time else 0.0
+        print(f"\n=== Pipeline stages ({wall:.1f}s wall) ===")
+        for index, stage in enumerate(self.stages):
+            stats = self.stats[stage.name]
+            with stats.lock:
+                capacity = wall * stage.workers
+                utilization = stats.busy_seconds / capacity if capacity > 0 else 0.0
+                avg_depth = stats.depth_sum / stats.depth_samples if stats.depth_samples else 0.0
+                print(f"{stage.name:<10} in={stats.items_in:>6} out={stats.items_out:>6} "
+                      f"batches={stats.batches:>5} errors={stats.errors:>3} "
+                      f"util={utilization:6.1%} queue now={self.queues[index].qsize():>4} "
+                      f"avg={avg_depth:6.1f} max={stats.depth_max:>4}")
@@ -0,0 +1,68 @@
+# File: src/precision.py
+import contextlib
+import torch
+
+# Precision modes for CPU / GPU inference -> dtype the weights are loaded in
+#   fp32: reference path
+#   fp16: default on CUDA / MPS
+#   bf16: bf16 weights + bf16 autocast (CPU needs AVX512-BF16 / AMX to be fast)
+#   int8: fp32 weights with every nn.Linear dynamically quantized to int8 (CPU only)
+PRECISIONS = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": torch.float32,
+}
+
+def cpu_supports_bf16():
+    """True when oneDNN reports native bf16 kernels on this CPU."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+def resolve_precision(precision, device):
+    """Default (None) is fp16 on accelerators and fp32 on CPU; unsupported choices fall back to fp32."""
+    if precision is None:
+        return "fp16" if device != "cpu" else "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {sorted(PRECISIONS)}")
+    if precision == "int8" and device != "cpu":
+        raise ValueError("int8 dynamic quantization only runs on CPU")
+    if precision == "bf16" and device == "cpu" and not cpu_supports_bf16():
+        print("Warning: this CPU has no native bf16 support, falling back to fp32.")
+        return "fp32"
+    return precision
+
+def prepare_for_inference(model, precision, compile=False):
+    """Applies the precision mode to a loaded model (in place) and optionally torch.compile's its forward."""
+    model.eval()
+    if precision == "int8":
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if compile and hasattr(torch, "compile"):
+        # Compile forward only, so HF generate() and attributes keep working
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+def inference_context(precision, device):
+    """inference_mode, plus bf16 autocast for the bf16 mode. Use instead of torch.no_grad()."""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if precision == "bf16":
+        stack.enter_context(torch.autocast(device_type=device.split(":")[0], dtype=torch.bfloat16))
+    return stack
+
+def model_size_bytes(model):
+    """
+    Bytes of every tensor in the state_dict. Unlike summing parameters this also counts
+    int8 packed weights (quantize_dynamic stores them as (weight, bias) tuples), and
+    unlike torch.save it never copies the weights.
+    """
+    def tensor_bytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0 # e.g. the packed params' dtype entry
+
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
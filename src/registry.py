@@ -0,0 +1,108 @@
+# File: src/registry.py
+"""
+Process-wide model registry.
+
+Models are loaded on first use and shared: two components asking for the same
+key (e.g. two CausalGenerators on "gpt2"/"cpu") get the same instance. Nothing
+heavy is imported here, so `import src` stays cheap.
+"""
+import subprocess
+import sys
+import threading
+
+_models = {}
+_key_locks = {}
+_registry_lock = threading.Lock()
+
+
+def get_model(key, loader):
+    """
+    Returns the object registered under `key`, calling `loader()` the first time.
+    Concurrent first calls for the same key wait for one load instead of loading twice.
+    """
+    if key in _models:
+        return _models[key]
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    # Only this key is blocked while it loads, other models can load in parallel
+    with key_lock:
+        if key not in _models:
+            _models[key] = loader()
+    return _models[key]
+
+
+def loaded_models():
+    """Keys of every model loaded so far in this process."""
+    return list(_models.keys())
+
+
+def release(key=None):
+    """Drops one model (or all of them) so it can be garbage collected."""
+    with _registry_lock:
+        if key is None:
+            _models.clear()
+        else:
+            _models.pop(key, None)
+
+
+def measure_import_time(module):
+    """
+    Cumulative import time of `module` in seconds, measured in a fresh interpreter
+    with `python -X importtime` (so already-imported modules don't hide the cost).
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    for line in proc.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"No importtime entry found for {module}")
+
+
+# Libraries that only the model loaders may import
+HEAVY_MODULES = ["transformers", "sentence_transformers", "faiss", "spacy"]
+
+
+def heavy_imports(module):
+    """Which HEAVY_MODULES `import module` pulls in, checked in a fresh interpreter."""
+    proc = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"],
+        capture_output=True, text=True, check=True
+    )
+    return proc.stdout.split()
+
+
+# Import-time budgets (seconds) for modules that must not pull in torch/spaCy/HF.
+# The model modules may import torch (their tensor code needs it), but never transformers,
+# sentence_transformers or faiss: those load with the models.
+IMPORT_BUDGETS = {
+    "src": 0.05,
+    "src.registry": 0.05,
+    "src.perturb": 0.1,
+    "src.cache": 0.1,
+    "src.batching": 0.1,
+    "src.retriever": 0.3,
+    "src.generator": 2.0,
+    "src.entailment": 2.0,
+}
+
+# Test block: run `python -m src.registry` to check the import-time budgets
+if __name__ == "__main__":
+    over_budget = []
+    for module, budget in IMPORT_BUDGETS.items():
+        seconds = measure_import_time(module)
+        status = "OK " if seconds <= budget else "SLOW"
+        print(f"{status} import {module:<14} {seconds * 1000:8.1f} ms  (budget {budget * 1000:.0f} ms)")
+        if seconds > budget:
+            over_budget.append(module)
+        # A fast machine can hide an eager import inside the budget, so check for it directly
+        heavy = heavy_imports(module)
+        if heavy:
+            print(f"HEAVY import {module} loads {heavy}")
+            over_budget.append(module)
+    assert not over_budget, f"Import-time budget exceeded: {over_budget}"
@@ -1,29 +1,337 @@
-from sentence_transformers import SentenceTransformer
-import faiss
+import itertools
+import json
+import os
+import time
 import numpy as np
+from src.registry import get_model
+from src.embedding_cache import EmbeddingCache, text_hash
+# faiss and sentence_transformers are imported where they are used, so importing this module stays cheap
+
+# Short names for the FAISS index types we support (any raw index_factory string works too)
+INDEX_FACTORIES = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "hnsw": "HNSW{hnsw_m}",
+    "ivfpq": "IVF{nlist},PQ{pq_m}",
+    "hnswpq": "HNSW{hnsw_m}_PQ{pq_m}",
+}
+
+# PQ codebooks have 256 centroids (8 bits per code): FAISS refuses to train them on fewer vectors
+MIN_PQ_TRAIN = 256
+
+class DocumentStore:
+    """
+    Append-only text store: all documents concatenated in `docs.bin` plus an int64
+    offsets array in `offsets.npy`. Loaded stores are memory-mapped, so a
+    Wikipedia-scale corpus doesn't have to fit in RAM as Python strings.
+    """
+
+    def __init__(self):
+        self._data = None                          # memory-mapped bytes of the saved part
+        self._offsets = np.zeros(1, dtype=np.int64) # offsets[i]:offsets[i+1] is doc i
+        self._tail = []                            # documents added since the last save
+        self._path = None                          # directory the saved part lives in
+
+    def __len__(self):
+        return len(self._offsets) - 1 + len(self._tail)
+
+    def __getitem__(self, i):
+        saved = len(self._offsets) - 1
+        if i < 0:
+            i += len(self)
+        if i >= saved:
+            return self._tail[i - saved]
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return bytes(self._data[start:end]).decode("utf-8")
+
+    def extend(self, documents):
+        self._tail.extend(documents)
+
+    def save(self, path):
+        """Appends the unsaved tail to docs.bin and rewrites the offsets atomically."""
+        os.makedirs(path, exist_ok=True)
+        data_path = os.path.join(path, "docs.bin")
+        offsets = [np.asarray(self._offsets)]
+        end = int(self._offsets[-1])
+        in_place = self._path is not None and os.path.realpath(self._path) == os.path.realpath(path)
+        with open(data_path, "ab") as f:
+            if not in_place:
+                # New location (or a new store): copy the saved part's raw bytes over in
+                # chunks, without decoding the documents into Python strings
+                f.truncate(0)
+                chunk = 64 * 1024 ** 2
+                for start in range(0, end, chunk):
+                    f.write(self._data[start:min(end, start + chunk)].tobytes())
+            elif f.tell() > end:
+                # A crash between the data append and the offsets rename left unreferenced bytes
+                f.truncate(end)
+            elif f.tell() < end:
+                raise ValueError(f"{data_path} is shorter than its offsets ({f.tell()} < {end} bytes)")
+            lengths = []
+            for doc in self._tail:
+                encoded = doc.encode("utf-8")
+                f.write(encoded)
+                lengths.append(len(encoded))
+        if lengths:
+            offsets.append(end + np.cumsum(lengths, dtype=np.int64))
+
+        tmp_path = os.path.join(path, "offsets.tmp.npy")
+        np.save(tmp_path, np.concatenate(offsets))
+        os.replace(tmp_path, os.path.join(path, "offsets.npy"))
+
+        # Re-open memory-mapped so the tail no longer lives in Python memory
+        loaded = DocumentStore.load(path)
+        self._data, self._offsets, self._tail, self._path = loaded._data, loaded._offsets, [], path
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        store._path = path
+        store._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        if store._offsets[-1] > 0:
+            store._data = np.memmap(os.path.join(path, "docs.bin"), dtype=np.uint8, mode="r")
+        return store
+
+def _load_encoder(model_name):
+    from sentence_transformers import SentenceTransformer # deferred: pulls in torch + transformers
+    return SentenceTransformer(model_name)
 
 class DenseRetriever:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        self.encoder = SentenceTransformer(model_name)
+    def __init__(self, model_name="all-MiniLM-L6-v2", index_type="flat", nlist=1024,
+                 hnsw_m=32, pq_m=16, nprobe=16, train_size=None, embedding_cache=None):
+        """
+        Args:
+            index_type: "flat" (exact), "ivf", "hnsw", "ivfpq", "hnswpq",
+                        or any faiss.index_factory string
+            nlist:  IVF cells (capped by the number of training vectors)
+            hnsw_m: HNSW graph degree
+            pq_m:   PQ sub-quantizers (must divide the embedding dimension)
+            nprobe: IVF cells visited per query (recall vs latency knob)
+            train_size: vectors collected before training IVF / PQ (default 39 * nlist);
+                        a PQ index trained on fewer than MIN_PQ_TRAIN vectors (a small
+                        corpus) falls back to an exact Flat index
+            embedding_cache: EmbeddingCache or a directory; documents this encoder
+                             has seen before are never re-encoded
+        """
+        self.model_name = model_name
+        self.index_type = index_type
+        self.nlist = nlist
+        self.hnsw_m = hnsw_m
+        self.pq_m = pq_m
+        self.nprobe = nprobe
+        self.train_size = train_size or 39 * nlist
+        if isinstance(embedding_cache, str):
+            embedding_cache = EmbeddingCache(embedding_cache, model_name)
+        self.embedding_cache = embedding_cache
         self.index = None
-        self.documents = []
+        self.documents = DocumentStore()
+        self._hashes = set()   # text hashes of the indexed documents (None = not computed yet)
+        self.encoded = 0       # documents actually run through the encoder
+
+    @property
+    def encoder(self):
+        # Loaded on first use and shared with any other retriever on the same model
+        return get_model(("sentence_encoder", self.model_name), lambda: _load_encoder(self.model_name))
+
+    def _factory(self, n_train):
+        return INDEX_FACTORIES.get(self.index_type, self.index_type).format(
+            nlist=max(1, min(self.nlist, n_train)), hnsw_m=self.hnsw_m, pq_m=self.pq_m
+        )
+
+    def _make_index(self, dimension, n_train):
+        import faiss
+        factory = self._factory(n_train)
+        if "PQ" in factory and n_train < MIN_PQ_TRAIN:
+            print(f"Only {n_train} vectors to train {factory} (PQ needs {MIN_PQ_TRAIN}): using an exact Flat index.")
+            return faiss.IndexFlatL2(dimension)
+        return faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+
+    def _configure(self):
+        import faiss
+        if hasattr(self.index, "nprobe"):
+            self.index.nprobe = self.nprobe
+        else:
+            ivf = faiss.try_extract_index_ivf(self.index)
+            if ivf is not None:
+                ivf.nprobe = self.nprobe
+
+    def encode(self, texts, batch_size=256):
+        return np.ascontiguousarray(
+            self.encoder.encode(texts, batch_size=batch_size, convert_to_numpy=True), dtype=np.float32
+        )
+
+    def _needs_training(self, dimension):
+        import faiss
+        return not faiss.index_factory(dimension, self._factory(self.nlist), faiss.METRIC_L2).is_trained
+
+    def _indexed_hashes(self):
+        if self._hashes is None:
+            # Loaded retriever: hash the stored documents once
+            self._hashes = {text_hash(self.documents[i]) for i in range(len(self.documents))}
+        return self._hashes
+
+    def _embed(self, docs, keys, batch_size):
+        """Embeddings for a batch, taking whatever the embedding cache already has."""
+        if self.embedding_cache is None:
+            self.encoded += len(docs)
+            return self.encode(docs, batch_size=batch_size)
+
+        cached = self.embedding_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            fresh = self.encode([docs[i] for i in missing], batch_size=batch_size)
+            self.embedding_cache.put_many([keys[i] for i in missing], fresh)
+            cached.update(zip((keys[i] for i in missing), fresh))
+            self.encoded += len(missing)
+        return np.stack([cached[key] for key in keys]).astype(np.float32)
+
+    def encode_stream(self, documents, batch_size=256):
+        """
+        Reads documents from any iterable in batches and yields (docs, keys, embeddings)
+        for the ones not indexed yet. Duplicate texts are dropped by hash.
+        """
+        indexed, seen = self._indexed_hashes(), set()
+        iterator = iter(documents)
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            docs, keys = [], []
+            for doc in batch:
+                key = text_hash(doc)
+                if key in indexed or key in seen:
+                    continue
+                seen.add(key)
+                docs.append(doc)
+                keys.append(key)
+            if docs:
+                yield docs, keys, self._embed(docs, keys, batch_size)
 
     def build_index(self, documents):
-        """Ingest a list of text documents."""
-        self.documents = documents
+        """Ingest text documents (a list or any iterable)."""
+        self.index = None
+        self.documents = DocumentStore()
+        self._hashes = set()
+        self.encoded = 0
         print("Encoding documents...")
-        embeddings = self.encoder.encode(documents, convert_to_numpy=True)
-        
-        # Initialize FAISS (L2 Distance)
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
+        self.add_documents(documents)
+        print(f"Index built with {len(self.documents)} documents ({self.encoded} newly encoded).")
+
+    def add_documents(self, documents, batch_size=256):
+        """
+        Streams documents into the existing index batch by batch. Already indexed texts
+        are skipped; returns the number of documents added.
+        """
+        added = 0
+        pending, pending_docs, pending_keys = [], [], []
+        for docs, keys, embeddings in self.encode_stream(documents, batch_size):
+            if self.index is None and (pending or self._needs_training(embeddings.shape[1])):
+                # IVF / PQ need a real training sample: hold batches back until we have one
+                pending.append(embeddings)
+                pending_docs.extend(docs)
+                pending_keys.extend(keys)
+                if len(pending_docs) < self.train_size:
+                    continue
+                embeddings, docs, keys = np.concatenate(pending), pending_docs, pending_keys
+                pending, pending_docs, pending_keys = [], [], []
+            self._add(docs, keys, embeddings)
+            added += len(docs)
+
+        if pending:
+            # Stream ended before train_size: train on what we have (Flat if too few for PQ)
+            self._add(pending_docs, pending_keys, np.concatenate(pending))
+            added += len(pending_docs)
+        return added
+
+    def _add(self, docs, keys, embeddings):
+        self.add_embeddings(embeddings)
+        self.documents.extend(docs)
+        self._indexed_hashes().update(keys)
+
+    def add_embeddings(self, embeddings):
+        """Adds precomputed embeddings; the first call creates (and trains) the index."""
+        if self.index is None:
+            # Initialize FAISS (L2 Distance); IVF / PQ variants are trained on the first batch
+            self.index = self._make_index(embeddings.shape[1], len(embeddings))
+            self._configure()
+        if not self.index.is_trained:
+            self.index.train(embeddings)
         self.index.add(embeddings)
-        print(f"Index built with {len(documents)} documents.")
 
     def retrieve(self, query, k=3):
         """Returns top-k documents for a query."""
-        query_vec = self.encoder.encode([query], convert_to_numpy=True)
-        distances, indices = self.index.search(query_vec, k)
-        
-        results = [self.documents[i] for i in indices[0]]
-        return results
\ No newline at end of file
+        return self.retrieve_many([query], k=k)[0]
+
+    def retrieve_many(self, queries, k=3, batch_size=256):
+        """Batch-encodes all queries and runs a single FAISS search. Returns one list per query."""
+        query_vecs = self.encode(queries, batch_size=batch_size)
+        distances, indices = self.index.search(query_vecs, k)
+        # FAISS pads with -1 when fewer than k neighbours exist
+        return [[self.documents[i] for i in row if i != -1] for row in indices]
+
+    def save(self, path):
+        """Writes the FAISS index, the document store and the settings to a directory."""
+        import faiss
+
+        os.makedirs(path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(path, "index.faiss"))
+        self.documents.save(path)
+        with open(os.path.join(path, "retriever.json"), "w") as f:
+            json.dump({
+                "model_name": self.model_name, "index_type": self.index_type, "nlist": self.nlist,
+                "hnsw_m": self.hnsw_m, "pq_m": self.pq_m, "nprobe": self.nprobe,
+                "train_size": self.train_size
+            }, f)
+
+    @classmethod
+    def load(cls, path, embedding_cache=None):
+        """Restores a saved retriever without re-encoding anything."""
+        import faiss
+
+        with open(os.path.join(path, "retriever.json"), "r") as f:
+            retriever = cls(**json.load(f), embedding_cache=embedding_cache)
+        retriever.index = faiss.read_index(os.path.join(path, "index.faiss"))
+        retriever._configure()
+        retriever.documents = DocumentStore.load(path)
+        retriever._hashes = None
+        return retriever
+
+def recall_latency_report(doc_embeddings, query_embeddings, k=10,
+                          index_types=("flat", "ivf", "hnsw", "ivfpq"), **index_kwargs):
+    """
+    Builds every index type over the same embeddings and compares it to exact
+    (Flat) search: recall@k and mean per-query search latency. Returns a list of dicts.
+    """
+    import faiss
+
+    doc_embeddings = np.ascontiguousarray(doc_embeddings, dtype=np.float32)
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+
+    exact = faiss.IndexFlatL2(doc_embeddings.shape[1])
+    exact.add(doc_embeddings)
+    _, truth = exact.search(query_embeddings, k)
+
+    report = []
+    for index_type in index_types:
+        retriever = DenseRetriever(index_type=index_type, **index_kwargs)
+        start = time.perf_counter()
+        retriever.add_embeddings(doc_embeddings)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, found = retriever.index.search(query_embeddings, k)
+        search_seconds = time.perf_counter() - start
+
+        hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+        report.append({
+            "index_type": index_type,
+            "recall_at_k": hits / truth.size,
+            "latency_ms": search_seconds / len(query_embeddings) * 1000,
+            "build_seconds": build_seconds
+        })
+
+    print(f"\n=== Recall@{k} vs latency ({len(doc_embeddings)} docs, {len(query_embeddings)} queries) ===")
+    for row in report:
+        print(f"{row['index_type']:<8} recall={row['recall_at_k']:.3f}  "
+              f"{row['latency_ms']:.3f} ms/query  build={row['build_seconds']:.2f}s")
+    return report
@@ -0,0 +1,530 @@
+# File: src/service.py
+"""
+Local HSB scoring service.
+
+Holds the generator (and optionally the NLI judge) once and serves JSON over
+HTTP on localhost or a Unix socket. Concurrent requests are coalesced into
+micro-batches: a batch runs as soon as it is full or its oldest request has
+waited max_wait seconds.
+
+    python -m src.service --model gpt2 --port 8765
+    python -m src.service --model gpt2 --socket /tmp/causalrag.sock
+
+Endpoints:
+    POST /score     {"context", "counterfactual" | "counterfactuals", "answer" | "answer_ids", ["question"], ["entailment"]}
+    POST /generate  {"context", "question", ["counterfactual"], ["entailment"], ["max_new_tokens"], ["stop_at_newline"]}
+    GET  /stats     latency percentiles and batch-size histograms per endpoint
+    GET  /health
+Both POST endpoints also take {"items": [...]} and answer {"results": [...]}.
+A /score request with a list of "counterfactuals" scores E once and answers {"scores": [...]},
+one entry per counterfactual (sweeps).
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+class MicroBatcher:
+    """
+    Collects submitted requests into batches for `fn` (list of requests -> list of results).
+    Every submit() returns a Future; latency (queueing + compute) and batch sizes are recorded.
+    """
+
+    def __init__(self, name, fn, max_batch_size=16, max_wait=0.01, history=10000):
+        self.name = name
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=history) # seconds, most recent requests only
+        self._batch_sizes = Counter()
+        self._requests = 0
+        self._errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self._queue.put((request, future, time.perf_counter()))
+        return future
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            # Fill the batch until it is full or the first request's deadline has passed
+            batch = [first]
+            deadline = first[2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.fn([request for request, _, _ in batch])
+            except Exception as e:
+                print(f"[service] {self.name} batch of {len(batch)} failed: {e}")
+                if len(batch) == 1:
+                    self._fail(batch, e)
+                    continue
+                # One bad request must not fail everyone it was batched with: rerun them one by one
+                for entry in batch:
+                    try:
+                        self._finish([entry], self.fn([entry[0]]))
+                    except Exception as single_error:
+                        self._fail([entry], single_error)
+                continue
+
+            self._finish(batch, results)
+
+    def _finish(self, batch, results):
+        done = time.perf_counter()
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+            self._requests += len(batch)
+            self._latencies.extend(done - submitted for _, _, submitted in batch)
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _fail(self, batch, error):
+        with self._lock:
+            self._errors += len(batch)
+        for _, future, _ in batch:
+            future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            sizes = dict(sorted(self._batch_sizes.items()))
+            requests, errors = self._requests, self._errors
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(round(q * (len(latencies) - 1))))] * 1000
+
+        batches = sum(sizes.values())
+        return {
+            "requests": requests,
+            "batches": batches,
+            "errors": errors,
+            "mean_batch_size": requests / batches if batches else 0.0,
+            "batch_size_histogram": sizes,
+            "latency_ms": {
+                "p50": percentile(0.50), "p90": percentile(0.90),
+                "p99": percentile(0.99), "max": percentile(1.0),
+            },
+        }
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5.0)
+
+
+class ScoringService:
+    """
+    The models plus one micro-batcher per endpoint. Both batchers share one model lock,
+    so a generate batch and a score batch never run on the model at the same time.
+    """
+
+    def __init__(self, gen, grader=None, max_batch_size=16, max_wait=0.01):
+        self.gen = gen
+        self.grader = grader
+        self._model_lock = threading.Lock()
+        self.batchers = {
+            "score": MicroBatcher("score", self._score_batch, max_batch_size, max_wait),
+            "generate": MicroBatcher("generate", self._generate_batch, max_batch_size, max_wait),
+        }
+
+    def submit(self, endpoint, request):
+        _validate(endpoint, request)
+        return self.batchers[endpoint].submit(request)
+
+    def stats(self):
+        return {name: batcher.stats() for name, batcher in self.batchers.items()}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+    # --- batch functions ---
+
+    def _answer_ids(self, request):
+        if request.get("answer_ids") is not None:
+            return list(request["answer_ids"])
+        return self.gen.tokenizer(request["answer"], add_special_tokens=False).input_ids
+
+    def _answer_text(self, request):
+        # The NLI hypothesis needs text: decode it when only answer_ids were sent
+        if request.get("answer") is not None:
+            return request["answer"]
+        return self.gen.tokenizer.decode(request["answer_ids"], skip_special_tokens=True).strip()
+
+    def _score_batch(self, requests):
+        """
+        Requests with a question are scored under the generation template (the same
+        path batch_runner uses), the rest with get_logits_pair's "{context}\\nAnswer: " template.
+        Every request is one E row plus one row per counterfactual, so E is scored once.
+        """
+        # 1. One forward row per context; logits[i] = [E, E'_1, E'_2, ...] of request i
+        logits = {}
+        qa_rows = [i for i, r in enumerate(requests) if r.get("question")]
+        plain_rows = [i for i, r in enumerate(requests) if not r.get("question")]
+
+        with self._model_lock:
+            if qa_rows:
+                contexts, questions, answer_ids, owners = [], [], [], []
+                for i in qa_rows:
+                    ids = self._answer_ids(requests[i])
+                    for ctx in [requests[i]["context"]] + _counterfactuals(requests[i]):
+                        contexts.append(ctx)
+                        questions.append(requests[i]["question"])
+                        answer_ids.append(ids)
+                        owners.append(i)
+                for i, row in zip(owners, self.gen.get_answer_logits_batch(contexts, questions, answer_ids)):
+                    logits.setdefault(i, []).append(row)
+            if plain_rows:
+                pairs, owners = [], []
+                for i in plain_rows:
+                    for ctx in [requests[i]["context"]] + _counterfactuals(requests[i]):
+                        pairs.append((ctx, requests[i]["answer"]))
+                        owners.append(i)
+                for i, row in zip(owners, self.gen.get_logits_rows(pairs)):
+                    logits.setdefault(i, []).append(row)
+
+        # 2. HSB and entailment per (request, counterfactual)
+        units = [(i, k, dict(r, counterfactual=cf)) for i, r in enumerate(requests) for k, cf in enumerate(_counterfactuals(r))]
+        scores = self._hsb_results([logits[i][0] for i, _, _ in units], [logits[i][k + 1] for i, k, _ in units])
+        self._add_entailment([unit for _, _, unit in units], [self._answer_text(unit) for _, _, unit in units], scores)
+
+        # 3. Back to one result per request
+        results = [{"scores": []} if "counterfactuals" in r else None for r in requests]
+        for (i, _, _), score in zip(units, scores):
+            if results[i] is None:
+                results[i] = score
+            else:
+                results[i]["scores"].append(score)
+        return results
+
+    def _generate_batch(self, requests):
+        """Greedy generation under E; requests with a counterfactual are scored against that answer too."""
+        results = [None] * len(requests)
+
+        # Only requests with the same generation settings can share a generate() call
+        groups = {}
+        for i, r in enumerate(requests):
+            groups.setdefault((r.get("max_new_tokens", 64), r.get("stop_at_newline", True)), []).append(i)
+
+        for (max_new_tokens, stop_at_newline), rows in groups.items():
+            with self._model_lock:
+                generations = self.gen.generate_and_score_batch(
+                    [requests[i]["context"] for i in rows], [requests[i]["question"] for i in rows],
+                    max_new_tokens=max_new_tokens, stop_at_newline=stop_at_newline
+                )
+                scored = [n for n, i in enumerate(rows) if requests[i].get("counterfactual")]
+                logits_E_prime = self.gen.get_answer_logits_batch(
+                    [requests[rows[n]]["counterfactual"] for n in scored],
+                    [requests[rows[n]]["question"] for n in scored],
+                    [generations[n]["answer_ids"] for n in scored]
+                ) if scored else []
+
+            for n, i in enumerate(rows):
+                results[i] = {"answer": generations[n]["answer"], "answer_ids": generations[n]["answer_ids"]}
+            if scored:
+                hsb = self._hsb_results([generations[n]["logits"] for n in scored], logits_E_prime)
+                for n, extra in zip(scored, hsb):
+                    results[rows[n]].update(extra)
+
+        scored_rows = [i for i, r in enumerate(requests) if r.get("counterfactual")]
+        self._add_entailment(
+            [requests[i] for i in scored_rows], [results[i]["answer"] for i in scored_rows],
+            [results[i] for i in scored_rows]
+        )
+        return results
+
+    def _hsb_results(self, logits_E, logits_E_prime):
+        from src.metrics import compute_hsb_batch, pad_answer_logits
+
+        if not logits_E:
+            return []
+        padded_E, mask = pad_answer_logits(logits_E)
+        padded_E_prime, _ = pad_answer_logits(logits_E_prime)
+        hsb = compute_hsb_batch(padded_E, padded_E_prime, mask)
+        lengths = mask.sum(dim=1).tolist()
+        return [
+            {
+                "hsb": hsb["per_item"][row].item(),
+                "hsb_per_token_mean": hsb["per_item_mean"][row].item(),
+                "per_token_kl": hsb["per_token"][row, :length].tolist(),
+                "answer_tokens": length,
+            }
+            for row, length in enumerate(lengths)
+        ]
+
+    def _add_entailment(self, requests, answers, results):
+        wanted = [n for n, r in enumerate(requests) if r.get("entailment")]
+        for n in range(len(requests)):
+            results[n]["delta_entailment"] = None
+        if not wanted or self.grader is None:
+            return
+        deltas = self.grader.compute_delta_entailment_batch([
+            (requests[n]["context"], requests[n]["counterfactual"], answers[n]) for n in wanted
+        ])
+        for n, delta in zip(wanted, deltas):
+            results[n]["delta_entailment"] = delta
+
+
+def _counterfactuals(request):
+    if "counterfactuals" in request:
+        return list(request["counterfactuals"])
+    return [request["counterfactual"]]
+
+
+def _validate(endpoint, request):
+    if not isinstance(request, dict):
+        raise ValueError("Each request must be a JSON object")
+    if endpoint == "score":
+        missing = [k for k in ("context",) if k not in request]
+        if "counterfactuals" in request:
+            if not isinstance(request["counterfactuals"], list) or not request["counterfactuals"]:
+                raise ValueError("counterfactuals must be a non-empty list")
+        elif "counterfactual" not in request:
+            missing.append("counterfactual")
+        if "answer" not in request and "answer_ids" not in request:
+            missing.append("answer")
+        elif "answer" not in request and not request.get("question"):
+            raise ValueError("answer_ids without answer needs a question (generation template)")
+    elif endpoint == "generate":
+        missing = [k for k in ("context", "question") if k not in request]
+    else:
+        raise ValueError(f"Unknown endpoint '{endpoint}'")
+    if missing:
+        raise ValueError(f"Missing fields for /{endpoint}: {missing}")
+
+
+# --- HTTP server ---
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None # set by make_server
+    timeout_seconds = 600
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"ok": True, "model": self.service.gen.model_name,
+                              "nli": self.service.grader.model_name if self.service.grader else None})
+        elif self.path == "/stats":
+            self._reply(200, self.service.stats())
+        else:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        endpoint = self.path.strip("/")
+        if endpoint not in self.service.batchers:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            many = isinstance(payload, dict) and "items" in payload
+            requests = payload["items"] if many else [payload]
+            futures = [self.service.submit(endpoint, request) for request in requests]
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        try:
+            results = [future.result(timeout=self.timeout_seconds) for future in futures]
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._reply(200, {"results": results} if many else results[0])
+
+    def log_message(self, format, *args):
+        pass # one line per request would drown the console
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0) # BaseHTTPRequestHandler expects a (host, port) address
+
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    handler = type("Handler", (_Handler,), {"service": service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return _UnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+# --- Client ---
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ScoringClient:
+    """
+    Client for the scoring service. `url` is "http://host:port" or "unix:///path/to.sock".
+    Thread-safe: every call opens its own connection, so concurrent callers get batched together.
+    """
+
+    def __init__(self, url=DEFAULT_URL, timeout=600):
+        self.url = url
+        self.timeout = timeout
+        parsed = urlparse(url)
+        self.socket_path = parsed.path if parsed.scheme == "unix" else None
+        self.host, self.port = parsed.hostname, parsed.port
+
+    def _connection(self):
+        if self.socket_path:
+            return _UnixHTTPConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method, path, payload=None):
+        conn = self._connection()
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"{}")
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"Scoring service {path} failed ({response.status}): {data.get('error')}")
+        return data
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+    def score(self, context, counterfactual, answer=None, question=None, answer_ids=None, entailment=False):
+        """
+        HSB of `answer` under E vs E' -> {hsb, hsb_per_token_mean, per_token_kl, answer_tokens, delta_entailment}.
+        With a list of counterfactuals, E is scored once -> {"scores": [one such dict per counterfactual]}.
+        """
+        request = {"context": context, "entailment": entailment}
+        if isinstance(counterfactual, (list, tuple)):
+            request["counterfactuals"] = list(counterfactual)
+        else:
+            request["counterfactual"] = counterfactual
+        if answer is not None:
+            request["answer"] = answer
+        if question is not None:
+            request["question"] = question
+        if answer_ids is not None:
+            request["answer_ids"] = list(answer_ids)
+        return self._request("POST", "/score", request)
+
+    def score_many(self, requests):
+        return self._request("POST", "/score", {"items": list(requests)})["results"]
+
+    def generate(self, context, question, counterfactual=None, entailment=False, **generation_kwargs):
+        """Answer under E ({answer, answer_ids}); with a counterfactual also its HSB (and delta entailment)."""
+        request = dict(generation_kwargs, context=context, question=question, entailment=entailment)
+        if counterfactual is not None:
+            request["counterfactual"] = counterfactual
+        return self._request("POST", "/generate", request)
+
+    def generate_many(self, requests):
+        return self._request("POST", "/generate", {"items": list(requests)})["results"]
+
+
+def print_stats(stats):
+    for name, s in stats.items():
+        latency = s["latency_ms"]
+        p50 = f"{latency['p50']:.1f}" if latency["p50"] is not None else "-"
+        p99 = f"{latency['p99']:.1f}" if latency["p99"] is not None else "-"
+        print(f"[service] {name:<8} requests={s['requests']:>6} batches={s['batches']:>5} "
+              f"mean batch={s['mean_batch_size']:5.2f} p50={p50}ms p99={p99}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local micro-batching HSB scoring service.")
+    parser.add_argument("--model", default="microsoft/Phi-3-mini-4k-instruct")
+    parser.add_argument("--nli-model", default="facebook/bart-large-mnli", help='"none" disables delta entailment')
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="Serve on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--precision", default=None, choices=["fp32", "fp16", "bf16", "int8"])
+    parser.add_argument("--generation-cache", default=None, help="GenerationCache directory (off by default)")
+    parser.add_argument("--stats-interval", type=float, default=60.0)
+    args = parser.parse_args()
+
+    from src.generator import CausalGenerator
+    from src.entailment import EntailmentGrader
+    from src.generation_cache import GenerationCache
+
+    gen = CausalGenerator(
+        model_name=args.model, precision=args.precision,
+        cache=GenerationCache(args.generation_cache) if args.generation_cache else None
+    )
+    grader = None
+    if args.nli_model.lower() != "none":
+        grader = EntailmentGrader(model_name=args.nli_model, precision=args.precision or "fp32")
+        grader.model # load now, not on the first request
+    gen.model
+
+    service = ScoringService(gen, grader, args.max_batch_size, args.max_wait_ms / 1000)
+    server = make_server(service, args.host, args.port, args.socket)
+    where = f"unix://{args.socket}" if args.socket else f"http://{args.host}:{args.port}"
+    print(f"=== Scoring service ready on {where} ===")
+
+    def report():
+        while True:
+            time.sleep(args.stats_interval)
+            print_stats(service.stats())
+    threading.Thread(target=report, daemon=True).start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        print_stats(service.stats())
@@ -0,0 +1,264 @@
+# File: src/sinks.py
+import glob
+import json
+import os
+import time
+from array import array
+
+
+class IdIndex:
+    """
+    Sidecar index of the ids already written to a results file.
+
+    Ids live in an append-only binary int64 file (`<prefix>.ids`), so resuming is a
+    single file read instead of re-parsing every record. `<prefix>.ids.json` records
+    how many bytes of the results file the index covers, so a crash between writing
+    records and updating the index is detected and only the uncovered tail is re-read.
+    """
+
+    def __init__(self, prefix):
+        self.ids_path = prefix + ".ids"
+        self.meta_path = prefix + ".ids.json"
+
+    def load(self):
+        ids = array("q")
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, "rb") as f:
+                ids.frombytes(f.read())
+        return set(ids)
+
+    def meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path, "r") as f:
+            return json.load(f)
+
+    def append(self, ids, **meta):
+        """Appends ids (fsynced) and then records the new coverage in the meta file."""
+        with open(self.ids_path, "ab") as f:
+            f.write(array("q", ids).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def reset(self):
+        for path in (self.ids_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class _BufferedSink:
+    """
+    Group commit: records are buffered and committed every `flush_every` records
+    or `flush_interval` seconds, whichever comes first, and always on close().
+    """
+
+    def __init__(self, flush_every=100, flush_interval=5.0):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_commit = time.monotonic()
+
+    def write(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_every or time.monotonic() - self._last_commit >= self.flush_interval:
+            self.commit()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def commit(self):
+        if self._buffer:
+            self._commit(self._buffer)
+            self._buffer = []
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class JsonlSink(_BufferedSink):
+    """Buffered JSONL writer: every commit is written, flushed and fsynced before the id index moves."""
+
+    def __init__(self, path, flush_every=100, flush_interval=5.0, fsync=True):
+        super().__init__(flush_every, flush_interval)
+        self.path = path
+        self.fsync = fsync
+        self.index = IdIndex(path)
+        self.processed_ids = self._recover()
+        self._f = open(path, "ab")
+
+    def _recover(self):
+        """Loads the id index and catches it up with whatever the results file holds beyond it."""
+        if not os.path.exists(self.path):
+            self.index.reset()
+            return set()
+
+        ids = self.index.load()
+        covered = self.index.meta().get("results_bytes", 0)
+        size = os.path.getsize(self.path)
+        if covered == size:
+            return ids
+        if covered == 0 or covered > size:
+            # No index yet, or the results file was replaced/truncated: rebuild from scratch
+            self.index.reset()
+            ids, covered = set(), 0
+
+        # Only parse the tail the index doesn't cover yet
+        tail_ids = []
+        with open(self.path, "rb") as f:
+            f.seek(covered)
+            tail = f.read()
+
+        # A crash mid-write can leave a partial last line: cut it off
+        end = tail.rfind(b"\n") + 1
+        if end < len(tail):
+            with open(self.path, "r+b") as f:
+                f.truncate(covered + end)
+        for line in tail[:end].splitlines():
+            try:
+                tail_ids.append(json.loads(line)['id'])
+            except (ValueError, KeyError):
+                continue
+
+        self.index.append(tail_ids, results_bytes=covered + end)
+        return ids | set(tail_ids)
+
+    def _commit(self, records):
+        self._f.write("".join(json.dumps(record) + "\n" for record in records).encode("utf-8"))
+        self._f.flush()
+        if self.fsync:
+            os.fsync(self._f.fileno())
+
+        ids = [record['id'] for record in records]
+        self.index.append(ids, results_bytes=self._f.tell())
+        self.processed_ids.update(ids)
+
+    def close(self):
+        super().close()
+        self._f.close()
+
+
+class ParquetSink(_BufferedSink):
+    """
+    Columnar writer. `path` is a directory of Parquet part files; every commit
+    becomes one part (one row group) written to a temp name and renamed into place,
+    so a crash can only lose the uncommitted buffer, never corrupt earlier parts.
+    """
+
+    def __init__(self, path, flush_every=1000, flush_interval=30.0):
+        super().__init__(flush_every, flush_interval)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index = IdIndex(os.path.join(path, "_results"))
+        self.processed_ids = self._recover()
+        self._session = time.strftime("%Y%m%d-%H%M%S")
+        self._part = 0
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def _recover(self):
+        import pyarrow.parquet as pq
+
+        parts = self._parts()
+        if self.index.meta().get("parts") == len(parts):
+            return self.index.load()
+
+        # Index missing or behind: rebuild it from the id column only
+        self.index.reset()
+        ids = []
+        for part in parts:
+            ids.extend(pq.read_table(part, columns=["id"]).column("id").to_pylist())
+        self.index.append(ids, parts=len(parts))
+        return set(ids)
+
+    def _commit(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        name = f"part-{self._session}-{os.getpid()}-{self._part:05d}.parquet"
+        self._part += 1
+        final_path = os.path.join(self.path, name)
+        tmp_path = final_path + ".tmp"
+        pq.write_table(pa.Table.from_pylist(records), tmp_path)
+        os.replace(tmp_path, final_path)
+
+        ids = [record['id'] for record in records]
+        self.index.append(ids, parts=len(self._parts()))
+        self.processed_ids.update(ids)
+
+
+def is_parquet(path):
+    return path.endswith(".parquet") or (os.path.isdir(path) and bool(glob.glob(os.path.join(path, "part-*.parquet"))))
+
+
+def open_sink(path, **kwargs):
+    """Picks the sink from the path: `*.parquet` -> ParquetSink, anything else -> JsonlSink."""
+    if is_parquet(path):
+        return ParquetSink(path, **kwargs)
+    return JsonlSink(path, **kwargs)
+
+
+def iter_record_batches(path, batch_size=10000, columns=None):
+    """Streams a results file (JSONL or Parquet directory) as lists of record dicts."""
+    if not os.path.exists(path):
+        return
+
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet"))) if os.path.isdir(path) else [path]
+        for part in parts:
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=batch_size, columns=columns):
+                yield batch.to_pylist()
+        return
+
+    batch = []
+    with open(path, "r") as f:
+        for line in f:
+            # robust read that handles potential empty or partial lines
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if columns is not None:
+                record = {key: record.get(key) for key in columns}
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def iter_records(path, columns=None):
+    for batch in iter_record_batches(path, columns=columns):
+        yield from batch
+
+
+def read_results(path, columns=None):
+    """Loads a results file of either format into a pandas DataFrame."""
+    import pandas as pd
+
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet"))) if os.path.isdir(path) else [path]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat([pq.read_table(part, columns=columns).to_pandas() for part in parts], ignore_index=True)
+
+    return pd.DataFrame(list(iter_records(path, columns=columns)))
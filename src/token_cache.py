@@ -0,0 +1,92 @@
+# File: src/token_cache.py
+import json
+import os
+from collections import Counter
+import numpy as np
+from src.cache import KeyedArrayStore, hash_key
+
+
+class TokenCache:
+    """
+    Append-only on-disk store of prompt token ids, keyed by (tokenizer name, text hash).
+
+    Layout under cache_dir/<tokenizer hash>/:
+        meta.json     tokenizer name
+        ids.i32       every prompt's token ids, concatenated; read back memory-mapped
+        lengths.i32   one length per row (row offsets are their running sum)
+        keys.txt      one text hash per line, line i <-> row i
+
+    For the QA template the answer span starts right after the prompt, so the first
+    answer logit of row i is at lengths[i] - 1. Storage and crash recovery are
+    KeyedArrayStore's (src/cache.py).
+
+    One writer at a time: processes sharing a cache (launch_workers.py shards) open it
+    read_only, and misses are tokenized without being stored.
+    """
+
+    def __init__(self, cache_dir="data/token_cache", tokenizer_name="microsoft/Phi-3-mini-4k-instruct", read_only=False):
+        self.tokenizer_name = tokenizer_name
+        self.read_only = read_only
+        self.dir = os.path.join(cache_dir, hash_key(tokenizer_name)[:16])
+        if not read_only:
+            os.makedirs(self.dir, exist_ok=True)
+            with open(os.path.join(self.dir, "meta.json"), "w") as f:
+                json.dump({"tokenizer_name": tokenizer_name}, f)
+        self._store = KeyedArrayStore(self.dir, "ids.i32", np.int32, read_only=read_only)
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def get_many(self, keys):
+        """Returns {key: token id list} for the keys that are cached."""
+        return {key: ids.tolist() for key, ids in self._store.get_many(keys).items()}
+
+    def lengths_many(self, keys):
+        """Returns {key: length} for cached keys, without touching the ids."""
+        return self._store.lengths_many(keys)
+
+    def put_many(self, keys, id_lists):
+        """Appends new (key, token ids) rows; keys that are already cached are skipped."""
+        self._store.put_many(keys, id_lists)
+
+    def length_buckets(self, keys=None, bucket_width=16):
+        """Histogram {bucket start: rows} of prompt lengths (all rows, or only `keys`)."""
+        counts = Counter(length // bucket_width * bucket_width for length in self._store.lengths(keys))
+        return dict(sorted(counts.items()))
+
+    def stats(self):
+        return dict(self._store.stats(), tokens=self._store.total_values())
+
+
+def pretokenize(cache, tokenizer, texts, batch_size=1024):
+    """
+    Tokenizes every text not yet in the cache, batch_size texts per (fast) tokenizer call.
+    Returns the number of newly stored texts.
+    """
+    keys = [hash_key(text) for text in texts]
+    todo = {key: text for key, text in zip(keys, texts) if key not in cache}
+    pending = list(todo.items())
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        cache.put_many([key for key, _ in chunk], tokenizer([text for _, text in chunk]).input_ids)
+    return len(todo)
+
+if __name__ == "__main__":
+    import tempfile
+
+    # --- Test block ---
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = TokenCache(tmp, "dummy-tokenizer")
+        keys = [hash_key(t) for t in ["a", "b", "c"]]
+        cache.put_many(keys, [[1, 2, 3], [4], list(range(40))])
+        cache.put_many(keys[:1], [[9, 9]]) # already cached: ignored
+
+        reopened = TokenCache(tmp, "dummy-tokenizer")
+        found = reopened.get_many(keys + [hash_key("d")])
+        assert len(reopened) == 3 and set(found) == set(keys)
+        assert found[keys[0]] == [1, 2, 3] and found[keys[2]] == list(range(40))
+        assert reopened.lengths_many(keys) == {keys[0]: 3, keys[1]: 1, keys[2]: 40}
+        print(f"Token cache OK: {reopened.stats()}, buckets {reopened.length_buckets()}")